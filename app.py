@@ -1,20 +1,24 @@
 import os
-import ssl
+import json
+import gzip
+import hashlib
+import asyncio
 import uuid
 import time
 import stripe
 import logging
 import uvicorn
-import smtplib
 from typing import Optional
 from pydantic import BaseModel
-from sqlalchemy.orm import Session
-from email.mime.text import MIMEText
+from sqlalchemy import event, inspect
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, object_session
 from fastapi.staticfiles import StaticFiles
-from email.mime.multipart import MIMEMultipart
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
-from fastapi import FastAPI, File, UploadFile, HTTPException, Depends, status
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse, PlainTextResponse, Response
+from fastapi import FastAPI, File, UploadFile, HTTPException, Depends, status, Request, Header
+from starlette.routing import Match
+from starlette.concurrency import run_in_threadpool
 from dotenv import load_dotenv
 
 # Cargar variables de entorno
@@ -29,13 +33,35 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-from hilos import generate_thread_image
-from database import get_db, engine
-from models import User, Purchase, Base
+from hilos import generate_thread_image, SOLVER_VERSION
+from generation_pool import GenerationPool, GenerationQueueFull, GENERATION_RETRY_AFTER
+from jobs import JobStore, generate_with_progress, FINISHED_STATUSES
+from result_cache import ResultCache
+from sequence_format import read_sequence
+from image_variants import (IMAGE_SIZES, IMAGE_FORMATS, MEDIA_TYPES, THUMBNAIL_WIDTH, variant_path, ensure_variant,
+                            encode_variant)
+from geometry import pin_circle, pin_coordinates
+from snapshots import SnapshotRenderer
+from storage import StorageManager, purchased_files
+from viewer_cache import TTLCache
+from uploads import MAX_UPLOAD_BYTES, UploadSizeLimitMiddleware, read_upload
+from metrics import (
+    REGISTRY, REQUEST_SECONDS, REQUESTS_IN_FLIGHT, GENERATIONS, Counter, Gauge, LoopLagMonitor, Profiler,
+    observe_call, record_generation, run_instrumented
+)
+from database import get_db, engine, SessionLocal, run_db, create_missing_indexes
+from models import User, Purchase, CheckoutPayment, Base
+from email_outbox import EmailOutbox, enqueue_email
 
 # Configuración de Stripe
+# Secreto con el que Stripe firma los webhooks; sin él, /stripe/webhook no existe
+STRIPE_WEBHOOK_SECRET = os.getenv('STRIPE_WEBHOOK_SECRET')
+
 stripe.api_key = os.getenv('STRIPE_SECRET_KEY', 'sk_test_51MZeZhFWYwy2FJ353OSQ58zQtmtKr52f1Ow9F1qdtUgMn8d0kqjcAElMXtsOqgufeCB9YchXp0RATaSAFx7FJahv00zlEq7BgO')
 
+# Servidor de la API de Stripe; loadtest.py lo apunta a un Stripe local
+stripe.api_base = os.getenv('STRIPE_API_BASE', stripe.api_base)
+
 # Crear la aplicación FastAPI
 app = FastAPI(
     title="Thread Image Generator",
@@ -52,6 +78,13 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Cortar las subidas demasiado grandes antes de que se lean completas
+app.add_middleware(
+    UploadSizeLimitMiddleware,
+    max_bytes=MAX_UPLOAD_BYTES,
+    paths=("/generate-thread-image/", "/api/jobs"),
+)
+
 # Montar archivos estáticos
 app.mount("/static", StaticFiles(directory="static"), name="static")
 app.mount("/thread_viewer", StaticFiles(directory="thread_viewer"), name="thread_viewer")
@@ -62,7 +95,221 @@ os.makedirs(OUTPUT_DIR, exist_ok=True)
 
 # Crear las tablas de la base de datos
 Base.metadata.create_all(bind=engine)
+create_missing_indexes(Base.metadata)
+
+# Parámetros del generador usados por el endpoint de producción
+THREAD_PINS = 180
+THREAD_LINES = 4500
+THREAD_PIXEL_WIDTH = 500
+
+# Corte temprano: parar cuando 100 líneas seguidas ya no oscurecen nada
+THREAD_MIN_GAIN = 0.0
+THREAD_PLATEAU_WINDOW = 100
+
+# Segundos máximos de una generación (sin contar la espera en la cola); al vencer se entrega
+# la mejor secuencia encontrada hasta ese momento. Sin definir no hay límite
+THREAD_DEADLINE = float(os.getenv('HILOS_GENERATION_DEADLINE', '0')) or None
+
+# Pool que ejecuta el generador fuera del event loop
+generation_pool = GenerationPool()
+
+# Estado de los trabajos de generación asíncronos
+job_store = JobStore()
+
+# Intervalo con el que el stream de eventos revisa el estado de un trabajo
+JOB_EVENTS_INTERVAL = 0.5
+
+# Referencias a las tareas en segundo plano para que no las recolecte el GC
+background_tasks = set()
+
+# Manifiesto de thread_outputs: sabe qué archivos usa una compra y borra las vistas previas huérfanas
+storage = StorageManager(OUTPUT_DIR, referenced_files=purchased_files(SessionLocal))
+storage.scan()
+
+# Resultados ya generados, indexados por el contenido de la subida
+result_cache = ResultCache(storage)
+
+# Trabajos en curso por clave de caché, para no generar dos veces la misma subida
+inflight_jobs = {}
+
+# Pasos de la secuencia por página del visualizador, y el máximo por solicitud
+VIEWER_STEPS_PAGE = 500
+VIEWER_STEPS_MAX_PAGE = 5000
+
+# Respuestas JSON más chicas que esto no se comprimen
+GZIP_MIN_BYTES = 1024
+
+# Las imágenes generadas nunca cambian bajo el mismo nombre: el navegador puede guardarlas un año
+IMAGE_CACHE_CONTROL = "private, max-age=31536000, immutable"
+
+# Correos pendientes, guardados en la base de datos y enviados por un worker en segundo plano
+email_outbox = EmailOutbox(SessionLocal)
+
+# Compras resueltas por enlace único y secuencias ya parseadas, para el visualizador
+purchase_cache = TTLCache()
+sequence_cache = TTLCache()
+
+# Ancho de las vistas parciales por tamaño; el visualizador muestra la miniatura
+SNAPSHOT_WIDTHS = {"full": 500, "thumb": THUMBNAIL_WIDTH}
+
+# Secuencias con sus keyframes renderizados, por archivo y tamaño; cada una ocupa como máximo
+# HILOS_SNAPSHOT_KEYFRAME_BYTES, así que la caché no pasa de HILOS_SNAPSHOT_CACHE_SIZE veces eso
+snapshot_cache = TTLCache(max_entries=int(os.getenv('HILOS_SNAPSHOT_CACHE_SIZE', '16')))
+
+@event.listens_for(Purchase, "after_update")
+def track_purchase_deactivation(mapper, connection, target):
+    """Anotar en la sesión los enlaces cuyo ``is_active`` cambió"""
+    if inspect(target).attrs.is_active.history.has_changes():
+        object_session(target).info.setdefault("changed_viewer_links", set()).add(target.unique_link)
+
+@event.listens_for(Session, "after_commit")
+def invalidate_viewer_links(session):
+    """Sacar de la caché los enlaces activados o desactivados, una vez confirmados"""
+    for unique_link in session.info.pop("changed_viewer_links", ()):
+        purchase_cache.invalidate(unique_link)
+
+@event.listens_for(Session, "after_rollback")
+def discard_viewer_links(session):
+    session.info.pop("changed_viewer_links", None)
+
+# Perfiles de cProfile muestreados, activables en caliente con /admin/profiling
+profiler = Profiler()
+
+# Retraso del event loop, cada HILOS_LOOP_LAG_INTERVAL segundos (0 lo desactiva)
+loop_lag_monitor = LoopLagMonitor()
+
+REGISTRY.register(Gauge(
+    'hilos_generation_in_flight', 'Generaciones ejecutándose en el pool',
+    function=lambda: generation_pool.running))
+REGISTRY.register(Gauge(
+    'hilos_generation_queue_depth', 'Generaciones esperando un worker libre',
+    function=lambda: generation_pool.queued))
+REGISTRY.register(Counter(
+    'hilos_result_cache_hits_total', 'Subidas resueltas desde la caché de resultados',
+    function=lambda: result_cache.hits))
+REGISTRY.register(Counter(
+    'hilos_result_cache_misses_total', 'Subidas que tuvieron que generarse',
+    function=lambda: result_cache.misses))
+REGISTRY.register(Gauge(
+    'hilos_storage_bytes', 'Espacio ocupado por los resultados en thread_outputs',
+    function=lambda: storage.total_bytes))
+REGISTRY.register(Counter(
+    'hilos_storage_reclaimed_bytes_total', 'Espacio liberado al borrar vistas previas huérfanas',
+    function=lambda: storage.reclaimed_bytes))
+REGISTRY.register(Counter(
+    'hilos_viewer_cache_hits_total', 'Enlaces del visualizador resueltos sin consultar la base de datos',
+    function=lambda: purchase_cache.hits))
+REGISTRY.register(Counter(
+    'hilos_viewer_cache_misses_total', 'Enlaces del visualizador que consultaron la base de datos',
+    function=lambda: purchase_cache.misses))
+REGISTRY.register(Gauge(
+    'hilos_event_loop_lag_max_seconds', 'Mayor retraso del event loop medido desde el arranque',
+    function=lambda: loop_lag_monitor.max_lag))
+
+def route_template(scope) -> str:
+    """Plantilla de la ruta (p. ej. /api/jobs/{job_id}) para no disparar la cardinalidad de las métricas"""
+    for route in app.router.routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return getattr(route, "path", "unknown")
+    return "unmatched"
+
+@app.middleware("http")
+async def instrument_requests(request: Request, call_next):
+    """Medir la latencia de cada ruta y, si está activo, perfilar una muestra de solicitudes"""
+    route = route_template(request.scope)
+    status_code = 500
+    start = time.perf_counter()
+    REQUESTS_IN_FLIGHT.inc()
+    try:
+        if profiler.should_sample():
+            with profiler.profile(profiler.new_path(f"{request.method}_{route}")):
+                response = await call_next(request)
+        else:
+            response = await call_next(request)
+        status_code = response.status_code
+        return response
+    finally:
+        REQUESTS_IN_FLIGHT.dec()
+        REQUEST_SECONDS.observe(
+            time.perf_counter() - start,
+            method=request.method,
+            route=route,
+            status=status_code
+        )
+
+def submit_generation(fn, *args, **kwargs):
+    """
+    Reservar lugar en el pool para una generación y devolver una corrutina con su resultado.
+
+    La reserva es inmediata (lanza ``GenerationQueueFull`` si no hay lugar); al
+    terminar, las fases medidas en el worker se registran en las métricas.
+    """
+    profile_path = profiler.new_path("generation") if profiler.should_sample() else None
+    future = generation_pool.submit(run_instrumented, fn, args, kwargs, profile_path)
+
+    async def wait_for_result():
+        try:
+            result, timings = await future
+        except Exception:
+            GENERATIONS.inc(outcome="error")
+            raise
+        record_generation(timings)
+        if profile_path:
+            profiler.prune()
+        return result
+
+    return wait_for_result()
+
+def result_cache_key(content: bytes) -> str:
+    return result_cache.key(
+        content,
+        pins=THREAD_PINS,
+        lines=THREAD_LINES,
+        pixel_width=THREAD_PIXEL_WIDTH,
+        min_gain=THREAD_MIN_GAIN,
+        plateau_window=THREAD_PLATEAU_WINDOW,
+        solver_version=SOLVER_VERSION,
+        # Solo cuando hay límite, para no invalidar los resultados ya cacheados
+        **({"deadline": THREAD_DEADLINE} if THREAD_DEADLINE else {})
+    )
+
+@app.on_event("startup")
+async def start_generation_pool():
+    """Levantar los workers y cargar la geometría antes de atender la primera subida"""
+    generation_pool.start(pins=THREAD_PINS)
+    await generation_pool.ready()
+
+@app.on_event("startup")
+async def start_storage_sweeps():
+    """Barrer thread_outputs periódicamente además de después de cada generación"""
+    storage.start()
+
+@app.on_event("shutdown")
+async def stop_storage_sweeps():
+    await storage.stop()
+
+@app.on_event("startup")
+async def start_email_outbox():
+    """Enviar en segundo plano los correos pendientes, incluidos los que quedaron de antes"""
+    email_outbox.start()
 
+@app.on_event("shutdown")
+async def stop_email_outbox():
+    await email_outbox.stop()
+
+@app.on_event("shutdown")
+async def stop_generation_pool():
+    generation_pool.shutdown()
+
+@app.on_event("startup")
+async def start_loop_lag_monitor():
+    """Medir el retraso del event loop para las métricas"""
+    loop_lag_monitor.start()
+
+@app.on_event("shutdown")
+async def stop_loop_lag_monitor():
+    await loop_lag_monitor.stop()
 
 
 @app.get("/")
@@ -74,30 +321,32 @@ async def read_root():
 async def generate_thread_image_endpoint(
     file: UploadFile = File(...)
 ):
-    """Generar imagen de hilos a partir de una imagen subida"""
+    """Generar imagen de hilos a partir de una imagen subida (bloquea hasta terminar; ver /api/jobs)"""
     try:
-        # Crear un nombre único para el archivo
-        unique_id = str(uuid.uuid4())[:8]
-        timestamp = int(time.time())
-        file_extension = os.path.splitext(file.filename)[1]
-        temp_filename = f"{timestamp}_{unique_id}{file_extension}"
-        temp_path = os.path.join(OUTPUT_DIR, temp_filename)
-
-        # Guardar el archivo temporalmente
-        with open(temp_path, "wb") as buffer:
-            content = await file.read()
-            buffer.write(content)
-
-        # Generar la imagen de hilos (sin callback para mejor rendimiento)
-        output_image_path, line_sequence_path = generate_thread_image(
-            temp_path,
-            output_dir=OUTPUT_DIR,
-            pins=180,
-            lines=4500
-        )
-
-        # Eliminar el archivo temporal
-        os.remove(temp_path)
+        content = await read_upload(file)
+
+        # Devolver el resultado existente si ya se generó esta misma imagen
+        cache_key = result_cache_key(content)
+        cached = result_cache.lookup(cache_key)
+        if cached:
+            output_image_path, line_sequence_path = cached
+        else:
+            # Generar la imagen de hilos en el pool a partir de los bytes, sin archivos temporales
+            output_image_path, line_sequence_path = await submit_generation(
+                generate_thread_image,
+                content,
+                output_dir=OUTPUT_DIR,
+                pins=THREAD_PINS,
+                lines=THREAD_LINES,
+                pixel_width=THREAD_PIXEL_WIDTH,
+                min_gain=THREAD_MIN_GAIN,
+                plateau_window=THREAD_PLATEAU_WINDOW,
+                deadline=THREAD_DEADLINE,
+                output_name=cache_key
+            )
+
+            storage.add(output_image_path, line_sequence_path)
+            await run_db(storage.enforce_quota)
 
         # Obtener el nombre del archivo de salida
         output_filename = os.path.basename(output_image_path)
@@ -109,10 +358,198 @@ async def generate_thread_image_endpoint(
             headers={"content-disposition": f"attachment; filename={output_filename}"}
         )
 
+    except HTTPException as he:
+        raise he
+    except GenerationQueueFull:
+        logger.warning("Cola de generación llena, solicitud rechazada")
+        raise queue_full_exception()
     except Exception as e:
         logger.error(f"Error generando imagen de hilos: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+def queue_full_exception():
+    return HTTPException(
+        status_code=503,
+        detail="El servidor está ocupado, intenta de nuevo en unos segundos",
+        headers={"Retry-After": str(GENERATION_RETRY_AFTER)}
+    )
+
+async def finish_generation_job(job_id: str, future, cache_key: str):
+    """Esperar la generación de un trabajo y registrar su resultado"""
+    try:
+        output_image_path, line_sequence_path = await future
+        job_store.update(
+            job_id,
+            status="done",
+            progress=1.0,
+            image_filename=os.path.basename(output_image_path),
+            sequence_filename=os.path.basename(line_sequence_path)
+        )
+        storage.add(output_image_path, line_sequence_path)
+        await run_db(storage.enforce_quota)
+    except Exception as e:
+        logger.error(f"Error en el trabajo de generación {job_id}: {str(e)}")
+        job_store.update(job_id, status="failed", error=str(e))
+    finally:
+        inflight_jobs.pop(cache_key, None)
+
+def job_urls(job_id: str) -> dict:
+    return {
+        "job_id": job_id,
+        "status_url": f"/api/jobs/{job_id}",
+        "events_url": f"/api/jobs/{job_id}/events",
+        "result_url": f"/api/jobs/{job_id}/result"
+    }
+
+@app.post("/api/jobs", status_code=202)
+async def create_generation_job(
+    file: UploadFile = File(...)
+):
+    """Encolar la generación de una imagen de hilos y devolver el id del trabajo"""
+    try:
+        content = await read_upload(file)
+        cache_key = result_cache_key(content)
+
+        # Reusar el trabajo en curso si la misma imagen ya se está generando
+        if cache_key in inflight_jobs:
+            return job_urls(inflight_jobs[cache_key])
+
+        # Si ya se generó, crear un trabajo terminado que apunte al resultado
+        cached = result_cache.lookup(cache_key)
+        if cached:
+            output_image_path, line_sequence_path = cached
+            job = job_store.create(
+                status="done",
+                progress=1.0,
+                lines_done=THREAD_LINES,
+                lines_total=THREAD_LINES,
+                image_filename=os.path.basename(output_image_path),
+                sequence_filename=os.path.basename(line_sequence_path)
+            )
+            return job_urls(job["id"])
+
+        if generation_pool.is_full():
+            logger.warning("Cola de generación llena, trabajo rechazado")
+            raise queue_full_exception()
+
+        job = job_store.create(lines_total=THREAD_LINES)
+
+        try:
+            future = submit_generation(
+                generate_with_progress,
+                job_store.directory,
+                job["id"],
+                content,
+                output_dir=OUTPUT_DIR,
+                pins=THREAD_PINS,
+                lines=THREAD_LINES,
+                pixel_width=THREAD_PIXEL_WIDTH,
+                min_gain=THREAD_MIN_GAIN,
+                plateau_window=THREAD_PLATEAU_WINDOW,
+                deadline=THREAD_DEADLINE,
+                output_name=cache_key
+            )
+        except GenerationQueueFull:
+            job_store.update(job["id"], status="failed", error="Cola de generación llena")
+            raise queue_full_exception()
+
+        inflight_jobs[cache_key] = job["id"]
+        task = asyncio.create_task(finish_generation_job(job["id"], future, cache_key))
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
+        job_store.prune_if_due()
+
+        return job_urls(job["id"])
+
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        logger.error(f"Error creando trabajo de generación: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+def get_job_or_404(job_id: str) -> dict:
+    job = job_store.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Trabajo no encontrado")
+    return job
+
+@app.get("/api/jobs/{job_id}")
+async def get_generation_job(job_id: str):
+    """Obtener el estado y el progreso de un trabajo de generación"""
+    return get_job_or_404(job_id)
+
+@app.get("/api/jobs/{job_id}/events")
+async def stream_generation_job(job_id: str):
+    """Enviar el progreso de un trabajo como Server-Sent Events hasta que termine"""
+    get_job_or_404(job_id)
+
+    async def events():
+        last_job = None
+        while True:
+            job = job_store.get(job_id)
+            if job is None:
+                yield "event: error\ndata: {}\n\n"
+                return
+            if job != last_job:
+                yield f"data: {json.dumps(job)}\n\n"
+                last_job = job
+            else:
+                # Comentario para mantener viva la conexión a través de proxies
+                yield ": ping\n\n"
+            if job["status"] in FINISHED_STATUSES:
+                return
+            await asyncio.sleep(JOB_EVENTS_INTERVAL)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.get("/api/jobs/{job_id}/result")
+async def get_generation_job_result(job_id: str, request: Request, format: str = "png", size: str = "full"):
+    """
+    Descargar la imagen o la secuencia de un trabajo terminado.
+
+    ``format`` es png, webp o image (la variante que admita el cliente según
+    Accept) para la imagen, con ``size`` full o thumb; json o seq (binario)
+    para la secuencia.
+    """
+    job = get_job_or_404(job_id)
+    if job["status"] != "done":
+        raise HTTPException(status_code=409, detail="El trabajo aún no ha terminado")
+
+    if format in ("png", "webp", "image"):
+        image_path = os.path.join(OUTPUT_DIR, job["image_filename"])
+        if not os.path.exists(image_path):
+            raise HTTPException(status_code=404, detail="Resultado no encontrado")
+        return await image_variant_response(
+            request, image_path, size, format=None if format == "image" else format, download=True
+        )
+    if format in ("json", "seq"):
+        filename, media_type = job["sequence_filename"], "application/octet-stream"
+    else:
+        raise HTTPException(status_code=400, detail="Formato no soportado")
+
+    path = os.path.join(OUTPUT_DIR, filename)
+    if not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="Resultado no encontrado")
+
+    if format == "json":
+        # La secuencia se guarda en binario; se convierte a la lista JSON de siempre
+        json_filename = f"{os.path.splitext(filename)[0]}.json"
+        return Response(
+            json.dumps(read_sequence(path).window()),
+            media_type="application/json",
+            headers={"content-disposition": f"attachment; filename={json_filename}"}
+        )
+
+    return FileResponse(
+        path,
+        media_type=media_type,
+        headers={"content-disposition": f"attachment; filename={filename}"}
+    )
+
 class ImageData(BaseModel):
     filename: str
     originalFile: str = None
@@ -127,80 +564,54 @@ class UserRegistration(BaseModel):
 class CheckoutRequest(BaseModel):
     imageData: ImageData
 
-def send_confirmation_email(email: str, viewer_url: str):
-    try:
-        # Configuración desde variables de entorno
-        smtp_server = os.getenv('EMAIL_HOST', 'smtp.gmail.com')
-        port = int(os.getenv('EMAIL_PORT', '587'))
-        smtp_username = os.getenv('EMAIL_USERNAME')
-        smtp_password = os.getenv('EMAIL_PASSWORD')
-        from_email_address = os.getenv('FROM_EMAIL_ADDRESS')
-
-        if not smtp_username or not smtp_password or not from_email_address:
-            logger.error("Credenciales de email o dirección de remitente no configuradas en variables de entorno")
-            return
-
-        message = MIMEMultipart("alternative")
-        message["Subject"] = "¡Tu imagen de hilos está lista!"
-        message["From"] = from_email_address
-        message["To"] = email
-
-        # Construir URL completa
-        full_viewer_url = f"{base_url}{viewer_url}"
-
-        html = f"""
-        <html>
-          <body>
-            <h2>¡Tu imagen de hilos está lista!</h2>
-            <p>¡Gracias por tu compra! Tu imagen personalizada de hilos ha sido procesada exitosamente.</p>
-            <p>Haz clic en el siguiente enlace para ver y descargar tu imagen:</p>
-            <p><a href="{full_viewer_url}" style="background-color: #3498db; color: white; padding: 10px 20px; text-decoration: none; border-radius: 5px;">Ver mi imagen de hilos</a></p>
-            <p>O copia y pega este enlace en tu navegador:</p>
-            <p>{full_viewer_url}</p>
-            <br>
-            <p>¡Esperamos que disfrutes tu imagen personalizada!</p>
-          </body>
-        </html>
-        """
-
-        html_part = MIMEText(html, "html")
-        message.attach(html_part)
-
-        context = ssl.create_default_context()
-        with smtplib.SMTP(smtp_server, port) as server:
-            server.starttls(context=context)
-            server.login(smtp_username, smtp_password)
-            server.sendmail(from_email_address, email, message.as_string())
-
-    except Exception as e:
-        logger.error(f"Error enviando correo: {str(e)}")
-        pass
+def confirmation_email(viewer_url: str):
+    """Asunto y HTML del correo con el enlace al visualizador"""
+    # Construir URL completa
+    full_viewer_url = f"{base_url}{viewer_url}"
+
+    html = f"""
+    <html>
+      <body>
+        <h2>¡Tu imagen de hilos está lista!</h2>
+        <p>¡Gracias por tu compra! Tu imagen personalizada de hilos ha sido procesada exitosamente.</p>
+        <p>Haz clic en el siguiente enlace para ver y descargar tu imagen:</p>
+        <p><a href="{full_viewer_url}" style="background-color: #3498db; color: white; padding: 10px 20px; text-decoration: none; border-radius: 5px;">Ver mi imagen de hilos</a></p>
+        <p>O copia y pega este enlace en tu navegador:</p>
+        <p>{full_viewer_url}</p>
+        <br>
+        <p>¡Esperamos que disfrutes tu imagen personalizada!</p>
+      </body>
+    </html>
+    """
+    return "¡Tu imagen de hilos está lista!", html
 
 @app.post('/create-checkout-session')
 async def create_checkout_session(request: CheckoutRequest):
     try:
-        # Crear sesión de checkout en Stripe
-        checkout_session = stripe.checkout.Session.create(
-            payment_method_types=['card'],
-            line_items=[{
-                'price_data': {
-                    'currency': 'usd',
-                    'product_data': {
-                        'name': f'Imagen de Hilos - 180 pines, 4500 líneas',
-                        'description': f'Imagen personalizada generada con 180 pines y 4500 líneas',
+        # Crear sesión de checkout en Stripe; la llamada es bloqueante, así que corre en el threadpool
+        with observe_call("stripe", "checkout_session_create"):
+            checkout_session = await run_in_threadpool(
+                stripe.checkout.Session.create,
+                payment_method_types=['card'],
+                line_items=[{
+                    'price_data': {
+                        'currency': 'usd',
+                        'product_data': {
+                            'name': f'Imagen de Hilos - 180 pines, 4500 líneas',
+                            'description': f'Imagen personalizada generada con 180 pines y 4500 líneas',
+                        },
+                        'unit_amount': 2500,  # $25.00 en centavos
                     },
-                    'unit_amount': 2500,  # $25.00 en centavos
-                },
-                'quantity': 1,
-            }],
-            mode='payment',
-            success_url=f'{base_url}/success?session_id={{CHECKOUT_SESSION_ID}}',
-            cancel_url=f'{base_url}/',
-            metadata={
-                'filename': request.imageData.filename,
-                'original_file': request.imageData.originalFile or ''
-            }
-        )
+                    'quantity': 1,
+                }],
+                mode='payment',
+                success_url=f'{base_url}/success?session_id={{CHECKOUT_SESSION_ID}}',
+                cancel_url=f'{base_url}/',
+                metadata={
+                    'filename': request.imageData.filename,
+                    'original_file': request.imageData.originalFile or ''
+                }
+            )
 
         return {"checkout_url": checkout_session.url}
 
@@ -213,6 +624,78 @@ async def success_page():
     """Servir la página de éxito después del pago"""
     return FileResponse('static/success.html')
 
+# Eventos de Stripe que confirman el pago de una sesión de checkout
+PAID_SESSION_EVENTS = ("checkout.session.completed", "checkout.session.async_payment_succeeded")
+
+def record_checkout_session(db: Session, session) -> CheckoutPayment:
+    """Guardar (o actualizar) una sesión de checkout de Stripe; repetirlo no duplica nada"""
+    payment = db.query(CheckoutPayment).filter(CheckoutPayment.session_id == session["id"]).first()
+    if payment is None:
+        payment = CheckoutPayment(session_id=session["id"])
+        db.add(payment)
+
+    metadata = session.get("metadata") or {}
+    payment.payment_intent_id = session.get("payment_intent")
+    # Stripe no garantiza el orden de los eventos: un evento tardío "unpaid" no deshace un pago
+    if payment.payment_status != "paid":
+        payment.payment_status = session.get("payment_status") or "unpaid"
+    payment.filename = metadata.get("filename", "")
+    payment.original_file = metadata.get("original_file", "")
+    try:
+        db.commit()
+    except IntegrityError:
+        # El mismo evento llegó dos veces a la vez; el otro ya guardó la sesión
+        db.rollback()
+        payment = db.query(CheckoutPayment).filter(CheckoutPayment.session_id == session["id"]).one()
+    return payment
+
+@app.post('/stripe/webhook')
+async def stripe_webhook(request: Request, stripe_signature: Optional[str] = Header(None)):
+    """Registrar las sesiones pagadas que notifica Stripe, para no consultarlas durante el registro"""
+    if not STRIPE_WEBHOOK_SECRET:
+        raise HTTPException(status_code=404, detail="Not Found")
+
+    payload = await request.body()
+    try:
+        stripe_event = stripe.Webhook.construct_event(payload, stripe_signature or "", STRIPE_WEBHOOK_SECRET)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Payload inválido")
+    except stripe.error.SignatureVerificationError:
+        logger.warning("Webhook de Stripe con firma inválida")
+        raise HTTPException(status_code=400, detail="Firma inválida")
+
+    if stripe_event["type"] in PAID_SESSION_EVENTS:
+        session = stripe_event["data"]["object"]
+        db = SessionLocal()
+        try:
+            await run_db(record_checkout_session, db, session)
+        finally:
+            db.close()
+        logger.info(f"Sesión de checkout registrada por webhook: {session['id']} ({session.get('payment_status')})")
+
+    return {"received": True}
+
+async def get_checkout_payment(session_id: str, db: Session) -> CheckoutPayment:
+    """
+    Sesión de checkout ya registrada por el webhook.
+
+    Si el webhook todavía no llegó, se consulta a Stripe una sola vez y se
+    guarda el resultado como lo haría el webhook.
+    """
+    payment = await run_db(
+        lambda: db.query(CheckoutPayment).filter(CheckoutPayment.session_id == session_id).first()
+    )
+    if payment is not None and payment.payment_status == "paid":
+        return payment
+
+    try:
+        with observe_call("stripe", "checkout_session_retrieve"):
+            session = await run_in_threadpool(stripe.checkout.Session.retrieve, session_id)
+    except stripe.error.StripeError as e:
+        logger.error(f"Error verificando sesión de Stripe: {str(e)}")
+        raise HTTPException(status_code=400, detail="Sesión de pago inválida")
+    return await run_db(record_checkout_session, db, session)
+
 @app.post('/complete-registration')
 async def complete_registration(
     request: dict,
@@ -224,20 +707,15 @@ async def complete_registration(
         if not session_id:
             raise HTTPException(status_code=400, detail="Session ID requerido")
 
-        # Verificar la sesión de pago con Stripe
-        try:
-            session = stripe.checkout.Session.retrieve(session_id)
-            if session.payment_status != 'paid':
-                raise HTTPException(status_code=400, detail="Pago no confirmado")
-        except stripe.error.StripeError as e:
-            logger.error(f"Error verificando sesión de Stripe: {str(e)}")
-            raise HTTPException(status_code=400, detail="Sesión de pago inválida")
+        # Verificar el pago con lo registrado por el webhook de Stripe
+        payment = await get_checkout_payment(session_id, db)
+        if payment.payment_status != 'paid':
+            raise HTTPException(status_code=400, detail="Pago no confirmado")
 
         # Extraer datos de la imagen desde los metadatos
-        metadata = session.metadata
         image_data = ImageData(
-            filename=metadata.get('filename', ''),
-            originalFile=metadata.get('original_file', '')
+            filename=payment.filename or '',
+            originalFile=payment.original_file or ''
         )
 
         # Crear datos de usuario
@@ -249,8 +727,8 @@ async def complete_registration(
             imageData=image_data
         )
 
-        # Procesar el registro (reutilizar lógica existente)
-        return await process_user_registration(user_data, db, session.payment_intent)
+        # Procesar el registro (reutilizar lógica existente); una sola compra por sesión
+        return await process_user_registration(user_data, db, payment.payment_intent_id, session_id)
 
     except HTTPException as he:
         raise he
@@ -258,11 +736,49 @@ async def complete_registration(
         logger.error(f"Error en complete_registration: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
-async def process_user_registration(user_data: UserRegistration, db: Session, payment_intent_id: str = None):
+async def process_user_registration(user_data: UserRegistration, db: Session, payment_intent_id: str = None,
+                                    checkout_session_id: str = None):
     """Función auxiliar para procesar el registro de usuario"""
     logger.info(f"Iniciando registro de usuario: {user_data.email}")
     logger.debug(f"Datos recibidos: {user_data.model_dump()}")
 
+    # Las consultas y los commits corren en el threadpool para no frenar el event loop
+    viewer_url = await run_db(register_purchase, user_data, db, payment_intent_id, checkout_session_id)
+
+    # El correo de confirmación ya quedó en el outbox; el worker lo envía en segundo plano
+    email_outbox.wake()
+
+    return {
+        "status": "success",
+        "message": "Usuario registrado correctamente",
+        "viewer_url": viewer_url
+    }
+
+def completed_purchase_link(db: Session, checkout_session_id: str) -> Optional[str]:
+    """Enlace único de la compra ya creada para una sesión de checkout, si existe"""
+    row = db.query(Purchase.unique_link) \
+        .join(CheckoutPayment, CheckoutPayment.purchase_id == Purchase.id) \
+        .filter(CheckoutPayment.session_id == checkout_session_id) \
+        .first()
+    return row.unique_link if row else None
+
+def register_purchase(user_data: UserRegistration, db: Session, payment_intent_id: str = None,
+                      checkout_session_id: str = None):
+    """
+    Crear (o reutilizar) el usuario y su compra con su correo de confirmación.
+
+    Con ``checkout_session_id`` la operación es idempotente: si la sesión ya
+    tiene compra se devuelve la misma URL sin crear otra ni reenviar el correo.
+
+    Returns:
+        str: URL del visualizador
+    """
+    if checkout_session_id:
+        existing_link = completed_purchase_link(db, checkout_session_id)
+        if existing_link:
+            logger.info(f"La sesión {checkout_session_id} ya tiene compra; se devuelve la existente")
+            return f"/viewer/{existing_link}"
+
     # Verificar si el usuario ya existe
     existing_user = db.query(User).filter(User.email == user_data.email).first()
     if not existing_user:
@@ -274,8 +790,13 @@ async def process_user_registration(user_data: UserRegistration, db: Session, pa
             address=user_data.address
         )
         db.add(user)
-        db.commit()
-        db.refresh(user)
+        try:
+            db.commit()
+            db.refresh(user)
+        except IntegrityError:
+            # Otra solicitud registró el mismo correo entre la consulta y el commit
+            db.rollback()
+            user = db.query(User).filter(User.email == user_data.email).one()
     else:
         logger.info("Usuario existente encontrado")
         user = existing_user
@@ -284,27 +805,26 @@ async def process_user_registration(user_data: UserRegistration, db: Session, pa
     image_filename = user_data.imageData.filename
     base_filename = image_filename.replace('_output.png', '')
 
-    # Buscar los archivos en el directorio OUTPUT_DIR
-    image_path = os.path.join(OUTPUT_DIR, image_filename)
-    json_path = os.path.join(OUTPUT_DIR, f"{base_filename}.json")
-
-    logger.debug(f"Buscando imagen en: {image_path}")
-    logger.debug(f"Buscando JSON en: {json_path}")
-
-    if not os.path.exists(image_path):
+    # Buscar los archivos en el manifiesto de OUTPUT_DIR
+    if not storage.exists(image_filename):
         logger.error(f"Imagen no encontrada: {image_filename}")
         raise HTTPException(
             status_code=404,
             detail=f"Imagen no encontrada: {image_filename}"
         )
 
-    if not os.path.exists(json_path):
-        logger.error(f"Archivo JSON no encontrado: {base_filename}.json")
+    # La columna se llama json_path, pero las secuencias nuevas se guardan en binario (.seq)
+    sequence_filename = storage.sequence_filename(base_filename)
+    if sequence_filename is None:
+        logger.error(f"Secuencia no encontrada: {base_filename}")
         raise HTTPException(
             status_code=404,
-            detail=f"Archivo JSON no encontrado: {base_filename}.json"
+            detail=f"Secuencia no encontrada: {base_filename}"
         )
 
+    image_path = os.path.join(OUTPUT_DIR, image_filename)
+    json_path = os.path.join(OUTPUT_DIR, sequence_filename)
+
     # Crear registro de compra
     unique_link = str(uuid.uuid4())
     purchase = Purchase(
@@ -315,29 +835,127 @@ async def process_user_registration(user_data: UserRegistration, db: Session, pa
         payment_intent_id=payment_intent_id
     )
     db.add(purchase)
-    db.commit()
+
+    if checkout_session_id:
+        # Reclamar la sesión para esta compra; si otra solicitud ganó, descartar la nuestra
+        db.flush()
+        claimed = db.query(CheckoutPayment) \
+            .filter(CheckoutPayment.session_id == checkout_session_id, CheckoutPayment.purchase_id.is_(None)) \
+            .update({"purchase_id": purchase.id}, synchronize_session=False)
+        if not claimed:
+            db.rollback()
+            logger.info(f"Registro duplicado para la sesión {checkout_session_id}; se devuelve la compra existente")
+            return f"/viewer/{completed_purchase_link(db, checkout_session_id)}"
 
     # Construir la URL del visualizador
     viewer_url = f"/viewer/{unique_link}"
     logger.info(f"URL del visualizador generada: {viewer_url}")
 
-    # Enviar correo de confirmación
-    send_confirmation_email(user.email, viewer_url)
+    # El correo se confirma en la misma transacción que la compra
+    subject, html = confirmation_email(viewer_url)
+    enqueue_email(db, user.email, subject, html)
+    db.commit()
 
-    return {
-        "status": "success",
-        "message": "Usuario registrado correctamente",
-        "viewer_url": viewer_url
-    }
+    return viewer_url
+
+async def resolve_purchase(unique_link: str, db: Session) -> dict:
+    """Compra activa de un enlace único con el nombre del usuario, o 404 (cacheada)"""
+    purchase = purchase_cache.get(unique_link)
+    if purchase is not None:
+        return purchase
+
+    row = await run_db(query_purchase, unique_link, db)
+    if not row or row.is_active is False:
+        raise HTTPException(status_code=404, detail="Enlace no válido o expirado")
+
+    purchase = {"name": row.name, "image_path": row.image_path, "json_path": row.json_path}
+    purchase_cache.put(unique_link, purchase)
+    return purchase
+
+def query_purchase(unique_link: str, db: Session):
+    return db.query(Purchase.image_path, Purchase.json_path, Purchase.is_active, User.name) \
+        .join(User, User.id == Purchase.user_id) \
+        .filter(Purchase.unique_link == unique_link) \
+        .first()
+
+def load_sequence(json_path: str):
+    """Secuencia de un resultado (binaria o JSON antiguo); los archivos no cambian, así que se leen una vez"""
+    sequence = sequence_cache.get(json_path)
+    if sequence is None:
+        try:
+            sequence = read_sequence(json_path)
+        except FileNotFoundError:
+            logger.error(f"Secuencia no encontrada: {json_path}")
+            raise HTTPException(status_code=404, detail="Datos de la imagen no encontrados")
+        sequence_cache.put(json_path, sequence)
+    return sequence
+
+def cacheable_json_response(request: Request, payload) -> Response:
+    """
+    Respuesta JSON con ETag fuerte, comprimida con gzip si el cliente lo acepta.
+
+    El ETag es el digest del cuerpo (con sufijo -gz para la versión comprimida),
+    así que un cliente que repite la solicitud con If-None-Match recibe un 304.
+    """
+    body = json.dumps(payload, separators=(",", ":")).encode()
+    use_gzip = len(body) >= GZIP_MIN_BYTES and "gzip" in request.headers.get("accept-encoding", "")
+    etag = hashlib.sha256(body).hexdigest()[:32] + ("-gz" if use_gzip else "")
+    headers = {"ETag": f'"{etag}"', "Vary": "Accept-Encoding", "Cache-Control": "private, no-cache"}
+
+    if_none_match = request.headers.get("if-none-match", "")
+    if f'"{etag}"' in (tag.strip() for tag in if_none_match.split(",")):
+        return Response(status_code=304, headers=headers)
+
+    if use_gzip:
+        body = gzip.compress(body, compresslevel=6)
+        headers["Content-Encoding"] = "gzip"
+    return Response(body, media_type="application/json", headers=headers)
+
+def negotiate_image_format(request: Request) -> str:
+    """WebP si el cliente lo anuncia en Accept (todos los navegadores actuales lo hacen), si no PNG"""
+    return "webp" if "image/webp" in request.headers.get("accept", "") else "png"
+
+async def image_variant_response(request: Request, image_path: str, size: str = "full",
+                                 format: Optional[str] = None, download: bool = False) -> Response:
+    """
+    Una variante de una imagen generada, con caché inmutable y 304 con If-None-Match.
+
+    Sin ``format`` se elige según Accept. Las imágenes anteriores a las
+    variantes solo tienen el PNG; sus variantes se crean la primera vez.
+    """
+    if size not in IMAGE_SIZES:
+        raise HTTPException(status_code=400, detail="Tamaño no soportado")
+    if format is not None and format not in IMAGE_FORMATS:
+        raise HTTPException(status_code=400, detail="Formato no soportado")
+
+    fmt = format or negotiate_image_format(request)
+    path = variant_path(image_path, size, fmt)
+    if not os.path.exists(path):
+        path = await run_in_threadpool(ensure_variant, image_path, size, fmt)
+        storage.add(path)
+    if path == image_path:
+        fmt = "png"
+
+    # El nombre y el tamaño bastan como ETag fuerte: los archivos no se reescriben
+    filename = os.path.basename(path)
+    etag = hashlib.sha256(f"{filename}:{os.path.getsize(path)}".encode()).hexdigest()[:32]
+    headers = {"ETag": f'"{etag}"', "Cache-Control": IMAGE_CACHE_CONTROL}
+    if format is None:
+        headers["Vary"] = "Accept"
+    if download:
+        headers["content-disposition"] = f"attachment; filename={filename}"
+
+    if_none_match = request.headers.get("if-none-match", "")
+    if f'"{etag}"' in (tag.strip() for tag in if_none_match.split(",")):
+        return Response(status_code=304, headers=headers)
+    return FileResponse(path, media_type=MEDIA_TYPES[fmt], headers=headers)
 
 @app.get('/viewer/{unique_link}')
 async def thread_viewer(unique_link: str, db: Session = Depends(get_db)):
     """Servir el thread viewer para un enlace único específico"""
     try:
-        # Verificar que el enlace único existe en la base de datos
-        purchase = db.query(Purchase).filter(Purchase.unique_link == unique_link).first()
-        if not purchase:
-            raise HTTPException(status_code=404, detail="Enlace no válido o expirado")
+        # Verificar que el enlace único existe y sigue activo
+        await resolve_purchase(unique_link, db)
 
         # Servir la página del thread viewer
         return FileResponse('thread_viewer/index.html')
@@ -348,26 +966,130 @@ async def thread_viewer(unique_link: str, db: Session = Depends(get_db)):
         logger.error(f"Error sirviendo thread viewer: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.get('/api/thread-data/{unique_link}')
-async def get_thread_data(unique_link: str, db: Session = Depends(get_db)):
-    """Obtener los datos JSON de la secuencia de hilos para un enlace único"""
+def palette_hex(sequence) -> Optional[list]:
+    """Colores de hilo de la secuencia como "#rrggbb", o None si es de un solo color"""
+    if sequence.palette is None:
+        return None
+    return [f"#{r:02x}{g:02x}{b:02x}" for r, g, b in sequence.palette]
+
+@app.get('/api/viewer/{unique_link}')
+async def get_viewer_bootstrap(
+    unique_link: str,
+    request: Request,
+    offset: int = 0,
+    limit: Optional[int] = None,
+    db: Session = Depends(get_db)
+):
+    """Todo lo que necesita el visualizador en una sola solicitud: nombre, pasos, colores, pines e imagen"""
     try:
-        # Verificar que el enlace único existe y obtener la información de la compra
-        purchase = db.query(Purchase).filter(Purchase.unique_link == unique_link).first()
-        if not purchase:
-            raise HTTPException(status_code=404, detail="Enlace no válido o expirado")
-
-        # Verificar que el archivo JSON existe
-        if not os.path.exists(purchase.json_path):
-            logger.error(f"Archivo JSON no encontrado: {purchase.json_path}")
-            raise HTTPException(status_code=404, detail="Datos de la imagen no encontrados")
+        purchase = await resolve_purchase(unique_link, db)
+        sequence = load_sequence(purchase["json_path"])
+        offset = min(max(offset, 0), len(sequence))
+
+        return cacheable_json_response(request, {
+            "name": purchase["name"],
+            "pins": sequence.pin_count or THREAD_PINS,
+            "total_steps": len(sequence),
+            "offset": offset,
+            "sequence": sequence.window(offset, limit),
+            "colors": sequence.color_window(offset, limit),
+            "palette": palette_hex(sequence),
+            "steps_url": f"/api/viewer/{unique_link}/steps",
+            "image_url": f"/api/thread-image/{unique_link}",
+            "thumbnail_url": f"/api/thread-image/{unique_link}?size=thumb",
+            "snapshot_url": f"/api/viewer/{unique_link}/snapshot"
+        })
+
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        logger.error(f"Error obteniendo datos del visualizador: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get('/api/viewer/{unique_link}/steps')
+async def get_viewer_steps(
+    unique_link: str,
+    request: Request,
+    offset: int = 0,
+    limit: int = VIEWER_STEPS_PAGE,
+    db: Session = Depends(get_db)
+):
+    """Una página de pasos de la secuencia, para no descargarla completa"""
+    try:
+        purchase = await resolve_purchase(unique_link, db)
+        sequence = load_sequence(purchase["json_path"])
+        offset = min(max(offset, 0), len(sequence))
+        limit = min(max(limit, 1), VIEWER_STEPS_MAX_PAGE)
+
+        return cacheable_json_response(request, {
+            "total_steps": len(sequence),
+            "offset": offset,
+            "sequence": sequence.window(offset, limit),
+            "colors": sequence.color_window(offset, limit)
+        })
+
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        logger.error(f"Error obteniendo pasos de la secuencia: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+def render_snapshot(json_path: str, sequence, step: int, size: str, fmt: str) -> bytes:
+    """Imagen codificada de los primeros ``step`` pasos, dibujada desde el keyframe más cercano"""
+    renderer = snapshot_cache.get((json_path, size))
+    if renderer is None:
+        pin_coords = pin_coordinates(sequence.pin_count or THREAD_PINS, *pin_circle(THREAD_PIXEL_WIDTH))
+        renderer = SnapshotRenderer(sequence, pin_coords, THREAD_PIXEL_WIDTH, SNAPSHOT_WIDTHS[size])
+        snapshot_cache.put((json_path, size), renderer)
+    return encode_variant(renderer.image(step), size, fmt)
+
+@app.get('/api/viewer/{unique_link}/snapshot')
+async def get_viewer_snapshot(
+    unique_link: str,
+    request: Request,
+    step: Optional[int] = None,
+    size: str = "thumb",
+    format: Optional[str] = None,
+    db: Session = Depends(get_db)
+):
+    """Cómo debe verse la pieza tras los primeros ``step`` pasos (size=full|thumb, formato según Accept)"""
+    try:
+        if size not in SNAPSHOT_WIDTHS:
+            raise HTTPException(status_code=400, detail="Tamaño no soportado")
+        if format is not None and format not in IMAGE_FORMATS:
+            raise HTTPException(status_code=400, detail="Formato no soportado")
+
+        purchase = await resolve_purchase(unique_link, db)
+        sequence = load_sequence(purchase["json_path"])
+        step = len(sequence) if step is None else min(max(step, 0), len(sequence))
+        fmt = format or negotiate_image_format(request)
+
+        # La secuencia no cambia bajo el mismo nombre, así que la imagen de un paso tampoco
+        filename = os.path.basename(purchase["json_path"])
+        etag = hashlib.sha256(f"{filename}:{step}:{size}:{fmt}".encode()).hexdigest()[:32]
+        headers = {"ETag": f'"{etag}"', "Cache-Control": IMAGE_CACHE_CONTROL}
+        if format is None:
+            headers["Vary"] = "Accept"
+
+        if_none_match = request.headers.get("if-none-match", "")
+        if f'"{etag}"' in (tag.strip() for tag in if_none_match.split(",")):
+            return Response(status_code=304, headers=headers)
+
+        body = await run_in_threadpool(render_snapshot, purchase["json_path"], sequence, step, size, fmt)
+        return Response(body, media_type=MEDIA_TYPES[fmt], headers=headers)
 
-        # Leer y retornar el contenido del JSON
-        import json
-        with open(purchase.json_path, 'r') as f:
-            thread_data = json.load(f)
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        logger.error(f"Error renderizando la vista parcial: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
 
-        return thread_data
+@app.get('/api/thread-data/{unique_link}')
+async def get_thread_data(unique_link: str, request: Request, db: Session = Depends(get_db)):
+    """Obtener los datos JSON de la secuencia de hilos para un enlace único"""
+    try:
+        purchase = await resolve_purchase(unique_link, db)
+        return cacheable_json_response(request, load_sequence(purchase["json_path"]).window())
 
     except HTTPException as he:
         raise he
@@ -379,15 +1101,7 @@ async def get_thread_data(unique_link: str, db: Session = Depends(get_db)):
 async def get_user_data(unique_link: str, db: Session = Depends(get_db)):
     """Obtener el nombre del usuario asociado a un enlace único"""
     try:
-        purchase = db.query(Purchase).filter(Purchase.unique_link == unique_link).first()
-        if not purchase:
-            raise HTTPException(status_code=404, detail="Enlace no válido o expirado")
-
-        user = db.query(User).filter(User.id == purchase.user_id).first()
-        if not user:
-            raise HTTPException(status_code=404, detail="Usuario no encontrado")
-
-        return {"name": user.name}
+        return {"name": (await resolve_purchase(unique_link, db))["name"]}
 
     except HTTPException as he:
         raise he
@@ -396,18 +1110,16 @@ async def get_user_data(unique_link: str, db: Session = Depends(get_db)):
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get('/api/thread-image/{unique_link}')
-async def get_thread_image(unique_link: str, db: Session = Depends(get_db)):
-    """Obtener la imagen de hilos para un enlace único"""
+async def get_thread_image(unique_link: str, request: Request, size: str = "full", db: Session = Depends(get_db)):
+    """Obtener la imagen de hilos para un enlace único (size=full|thumb, formato según Accept)"""
     try:
-        purchase = db.query(Purchase).filter(Purchase.unique_link == unique_link).first()
-        if not purchase:
-            raise HTTPException(status_code=404, detail="Enlace no válido o expirado")
+        purchase = await resolve_purchase(unique_link, db)
 
-        if not os.path.exists(purchase.image_path):
-            logger.error(f"Imagen no encontrada: {purchase.image_path}")
+        if not os.path.exists(purchase["image_path"]):
+            logger.error(f"Imagen no encontrada: {purchase['image_path']}")
             raise HTTPException(status_code=404, detail="Imagen no encontrada")
 
-        return FileResponse(purchase.image_path, media_type="image/png")
+        return await image_variant_response(request, purchase["image_path"], size)
 
     except HTTPException as he:
         raise he
@@ -430,6 +1142,27 @@ async def register_user(
         logger.error(f"Error en registro: {str(e)}", exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get('/metrics')
+async def metrics():
+    """Métricas del servicio en formato Prometheus"""
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+class ProfilingSettings(BaseModel):
+    sample_rate: float
+
+@app.post('/admin/profiling')
+async def set_profiling(settings: ProfilingSettings, x_admin_token: Optional[str] = Header(None)):
+    """Ajustar en caliente la fracción de solicitudes perfiladas con cProfile (0 lo desactiva)"""
+    admin_token = os.getenv('HILOS_ADMIN_TOKEN')
+    if not admin_token:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if x_admin_token != admin_token:
+        raise HTTPException(status_code=403, detail="Token de administración inválido")
+
+    profiler.sample_rate = min(max(settings.sample_rate, 0.0), 1.0)
+    logger.info(f"Muestreo de perfiles ajustado a {profiler.sample_rate}")
+    return {"sample_rate": profiler.sample_rate, "directory": profiler.directory}
+
 if __name__ == "__main__":
     # Obtener el puerto de las variables de entorno, con un valor por defecto
     port = int(os.getenv("PORT", 8000))
@@ -0,0 +1,175 @@
+"""
+Generate thread images for many input images in parallel.
+
+Examples:
+    python batch.py catalog/ --output-dir catalog_outputs
+    python batch.py "orders/*.jpg" --pins 180 --lines 4500 --workers 4
+    python batch.py --manifest orders.txt --summary summary.json
+    python batch.py catalog/ --palette cmyk
+"""
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from hilos import generate_thread_image, warm_up
+from palette import PALETTES
+from sequence_format import SEQUENCE_EXTENSION
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.webp', '.tif', '.tiff')
+
+def collect_inputs(patterns, manifest=None):
+    """
+    Expand directories, glob patterns and an optional manifest into image paths.
+
+    A manifest is either a JSON list of paths or a text file with one path per line.
+    """
+    entries = list(patterns)
+    if manifest:
+        with open(manifest, 'r') as f:
+            content = f.read()
+        try:
+            entries.extend(json.loads(content))
+        except ValueError:
+            entries.extend(line.strip() for line in content.splitlines()
+                           if line.strip() and not line.startswith('#'))
+
+    paths = []
+    for entry in entries:
+        if os.path.isdir(entry):
+            matches = [os.path.join(entry, name) for name in sorted(os.listdir(entry))]
+        else:
+            matches = sorted(glob.glob(entry)) or [entry]
+        paths.extend(path for path in matches if path.lower().endswith(IMAGE_EXTENSIONS))
+
+    # Keep the first occurrence of each image
+    return list(dict.fromkeys(paths))
+
+def output_paths(input_path, output_dir):
+    file_name = os.path.splitext(os.path.basename(input_path))[0]
+    return (
+        os.path.join(output_dir, f"{file_name}_output.png"),
+        os.path.join(output_dir, f"{file_name}{SEQUENCE_EXTENSION}")
+    )
+
+def is_up_to_date(input_path, output_dir):
+    """True if both outputs exist and are newer than the input image."""
+    try:
+        input_mtime = os.path.getmtime(input_path)
+        return all(os.path.getmtime(path) >= input_mtime for path in output_paths(input_path, output_dir))
+    except OSError:
+        return False
+
+def process_image(input_path, output_dir, options):
+    """Worker entry point: generate one image and report timing or the error."""
+    start = time.perf_counter()
+    try:
+        output_image_path, line_sequence_path = generate_thread_image(input_path, output_dir=output_dir, **options)
+        return {
+            'input': input_path,
+            'status': 'done',
+            'seconds': round(time.perf_counter() - start, 3),
+            'image': output_image_path,
+            'sequence': line_sequence_path,
+        }
+    except Exception as e:
+        return {
+            'input': input_path,
+            'status': 'failed',
+            'seconds': round(time.perf_counter() - start, 3),
+            'error': f"{type(e).__name__}: {e}",
+        }
+
+def run_batch(inputs, output_dir, options, workers=None, force=False):
+    """
+    Generate every input in a process pool, skipping outputs that are up to date.
+
+    The chord geometry is built (or mapped) once in this process before the pool
+    starts; workers map the same read-only file instead of rebuilding it.
+
+    Returns:
+        dict: Summary with one entry per input and aggregate counts
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    warm_up(pins=options['pins'], pixel_width=options['pixel_width'],
+            coarse_factor=options['coarse_factor'] if options['search'] == 'multires' else None)
+
+    results = []
+    pending = []
+    for input_path in inputs:
+        if not force and is_up_to_date(input_path, output_dir):
+            results.append({'input': input_path, 'status': 'skipped', 'seconds': 0.0})
+        else:
+            pending.append(input_path)
+
+    start = time.perf_counter()
+    if pending:
+        with ProcessPoolExecutor(max_workers=workers, initializer=warm_up,
+                                 initargs=(options['pins'], options['pixel_width'])) as executor:
+            futures = [executor.submit(process_image, path, output_dir, options) for path in pending]
+            for future in as_completed(futures):
+                result = future.result()
+                results.append(result)
+                print(f"[{len(results)}/{len(inputs)}] {result['status']}: {result['input']} ({result['seconds']}s)",
+                      file=sys.stderr)
+
+    counts = {status: sum(1 for r in results if r['status'] == status) for status in ('done', 'skipped', 'failed')}
+    order = {path: i for i, path in enumerate(inputs)}
+    return {
+        'options': options,
+        'output_dir': output_dir,
+        'wall_seconds': round(time.perf_counter() - start, 3),
+        'counts': counts,
+        'images': sorted(results, key=lambda r: order[r['input']]),
+    }
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Generate thread images for many input images in parallel.")
+    parser.add_argument('inputs', nargs='*', help="Image files, directories or glob patterns")
+    parser.add_argument('--manifest', help="JSON list or text file with one image path per line")
+    parser.add_argument('--output-dir', default='thread_outputs', help="Where outputs are written")
+    parser.add_argument('--pins', type=int, default=180)
+    parser.add_argument('--lines', type=int, default=4500)
+    parser.add_argument('--pixel-width', type=int, default=500)
+    parser.add_argument('--search', choices=('exhaustive', 'multires'), default='exhaustive')
+    parser.add_argument('--coarse-factor', type=int, default=4)
+    parser.add_argument('--top-k', type=int, default=16)
+    parser.add_argument('--palette', choices=sorted(PALETTES), help="Generate multi-color images with these threads")
+    parser.add_argument('--workers', type=int, default=None, help="Worker processes (default: CPU count)")
+    parser.add_argument('--force', action='store_true', help="Regenerate outputs that are already up to date")
+    parser.add_argument('--summary', help="Write the JSON summary to this file instead of stdout")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    inputs = collect_inputs(args.inputs, args.manifest)
+    if not inputs:
+        print("No input images found", file=sys.stderr)
+        return 1
+
+    options = {
+        'pins': args.pins,
+        'lines': args.lines,
+        'pixel_width': args.pixel_width,
+        'search': args.search,
+        'coarse_factor': args.coarse_factor,
+        'top_k': args.top_k,
+    }
+    if args.palette:
+        # Images already run in parallel, so each one solves its colors sequentially
+        options.update(palette=args.palette, color_workers=1)
+    summary = run_batch(inputs, args.output_dir, options, workers=args.workers, force=args.force)
+
+    if args.summary:
+        with open(args.summary, 'w') as f:
+            json.dump(summary, f, indent=2)
+    else:
+        print(json.dumps(summary, indent=2))
+
+    return 1 if summary['counts']['failed'] else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
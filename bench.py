@@ -0,0 +1,199 @@
+"""
+Benchmark generate_thread_image across pins, lines and resolution.
+
+Every case runs in a fresh process so peak RSS is per case. Results are JSON
+and can be compared against a stored baseline to flag regressions.
+
+Examples:
+    python bench.py --output baseline.json
+    python bench.py --pins 180 300 --lines 3500 10000 --pixel-width 500 1000
+    python bench.py --quick --baseline baseline.json --output current.json
+"""
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import cv2
+
+PHASES = ("decode", "mask", "geometry", "solve", "render", "encode")
+
+def synthetic_images(directory, size=1200):
+    """Write deterministic test images covering smooth, high-contrast and noisy content."""
+    y, x = np.mgrid[:size, :size].astype(np.float64)
+    rng = np.random.default_rng(0)
+
+    gradient = 255 * (x + y) / (2 * size)
+
+    portrait = np.full((size, size), 220.0)
+    cv2.ellipse(portrait, (size // 2, size // 2), (size // 4, size // 3), 0, 0, 360, 90, -1)
+    cv2.circle(portrait, (size // 2 - size // 10, size // 2 - size // 10), size // 25, 20, -1)
+    cv2.circle(portrait, (size // 2 + size // 10, size // 2 - size // 10), size // 25, 20, -1)
+    portrait = cv2.GaussianBlur(portrait, (0, 0), size / 200)
+
+    texture = 128 + 90 * np.sin(x / 37) * np.cos(y / 23) + rng.normal(0, 20, (size, size))
+
+    paths = {}
+    for name, image in (("gradient", gradient), ("portrait", portrait), ("texture", texture)):
+        paths[name] = os.path.join(directory, f"{name}.png")
+        cv2.imwrite(paths[name], np.clip(image, 0, 255).astype(np.uint8))
+    return paths
+
+def run_case(image_path, output_dir, options):
+    """Run one generation in this (fresh) process and report phase timings and peak RSS."""
+    from hilos import generate_thread_image
+
+    timings = {}
+    start = time.perf_counter()
+    generate_thread_image(image_path, output_dir=output_dir, timings=timings, **options)
+    total = time.perf_counter() - start
+
+    # ru_maxrss is in KiB on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak_mb = peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+    return {
+        "phases": {phase: round(timings.get(phase, 0.0), 4) for phase in PHASES},
+        "total_seconds": round(total, 4),
+        "lines": timings["lines"],
+        "lines_per_second": round(timings["lines"] / timings["solve"], 1) if timings.get("solve") else None,
+        "peak_rss_mb": round(peak_mb, 1),
+    }
+
+def run_isolated(image_path, output_dir, options):
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+        return executor.submit(run_case, image_path, output_dir, options).result()
+
+def summarize(runs):
+    """Median of each metric over repeated runs of a case."""
+    result = dict(runs[0])
+    result["phases"] = {phase: round(float(np.median([r["phases"][phase] for r in runs])), 4) for phase in PHASES}
+    for key in ("total_seconds", "lines_per_second", "peak_rss_mb"):
+        values = [r[key] for r in runs if r[key] is not None]
+        result[key] = round(float(np.median(values)), 4) if values else None
+    result["repeats"] = len(runs)
+    return result
+
+def run_benchmarks(images, pins_list, lines_list, widths, repeat=1, search="exhaustive", cold_geometry=False):
+    work_dir = tempfile.mkdtemp(prefix="hilos_bench_")
+    try:
+        if cold_geometry:
+            # Each case rebuilds its chord geometry instead of mapping a cached file
+            os.environ["HILOS_GEOMETRY_DIR"] = os.path.join(work_dir, "geometry")
+
+        cases = {}
+        for (name, path), pins, lines, width in itertools.product(images.items(), pins_list, lines_list, widths):
+            case_id = f"{name}-p{pins}-l{lines}-w{width}-{search}"
+            options = {"pins": pins, "lines": lines, "pixel_width": width, "search": search}
+            runs = []
+            for _ in range(repeat):
+                if cold_geometry:
+                    shutil.rmtree(os.environ["HILOS_GEOMETRY_DIR"], ignore_errors=True)
+                runs.append(run_isolated(path, os.path.join(work_dir, "out"), options))
+            cases[case_id] = dict(summarize(runs), image=name, **options)
+            print(f"{case_id}: {cases[case_id]['total_seconds']}s, "
+                  f"{cases[case_id]['lines_per_second']} lines/s, {cases[case_id]['peak_rss_mb']} MB",
+                  file=sys.stderr)
+        return cases
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def compare(current, baseline, threshold=0.1, min_seconds=0.05, min_mb=10.0):
+    """
+    Compare two benchmark reports and list the metrics that got worse.
+
+    A time counts as a regression when it grows by more than ``threshold`` and by
+    more than ``min_seconds``; memory likewise with ``min_mb``, so tiny phases and
+    allocator noise do not trigger false alarms.
+    """
+    regressions = []
+    for case_id, case in current["cases"].items():
+        base = baseline["cases"].get(case_id)
+        if base is None:
+            continue
+
+        metrics = [("total_seconds", case["total_seconds"], base["total_seconds"], min_seconds)]
+        metrics += [(f"phases.{phase}", case["phases"][phase], base["phases"][phase], min_seconds) for phase in PHASES]
+        metrics.append(("peak_rss_mb", case["peak_rss_mb"], base["peak_rss_mb"], min_mb))
+
+        for metric, value, reference, minimum in metrics:
+            if value - reference > max(reference * threshold, minimum):
+                regressions.append({
+                    "case": case_id,
+                    "metric": metric,
+                    "baseline": reference,
+                    "current": value,
+                    "change": round(value / reference - 1, 3) if reference else None,
+                })
+    return regressions
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the thread solver.")
+    parser.add_argument("--pins", type=int, nargs="+", default=[180, 300])
+    parser.add_argument("--lines", type=int, nargs="+", default=[3500, 10000])
+    parser.add_argument("--pixel-width", type=int, nargs="+", default=[500, 1000])
+    parser.add_argument("--search", choices=("exhaustive", "multires"), default="exhaustive")
+    parser.add_argument("--images", nargs="*", help="Extra image files to benchmark besides the synthetic ones")
+    parser.add_argument("--repeat", type=int, default=1, help="Runs per case; the median is reported")
+    parser.add_argument("--cold-geometry", action="store_true", help="Rebuild the chord geometry in every run")
+    parser.add_argument("--quick", action="store_true", help="Only the portrait image at 180 pins, 3500 lines, 500 px")
+    parser.add_argument("--output", help="Write the JSON report to this file instead of stdout")
+    parser.add_argument("--baseline", help="Report to compare against; exits with 1 on regressions")
+    parser.add_argument("--threshold", type=float, default=0.1, help="Relative slowdown that counts as a regression")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    image_dir = tempfile.mkdtemp(prefix="hilos_bench_images_")
+    try:
+        images = synthetic_images(image_dir)
+        if args.quick:
+            images = {"portrait": images["portrait"]}
+            args.pins, args.lines, args.pixel_width = [180], [3500], [500]
+        for path in args.images or []:
+            images[os.path.splitext(os.path.basename(path))[0]] = os.path.abspath(path)
+
+        report = {
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "machine": {
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "cpus": os.cpu_count(),
+                "numpy": np.__version__,
+                "opencv": cv2.__version__,
+            },
+            "cases": run_benchmarks(images, args.pins, args.lines, args.pixel_width, repeat=args.repeat,
+                                    search=args.search, cold_geometry=args.cold_geometry),
+        }
+    finally:
+        shutil.rmtree(image_dir, ignore_errors=True)
+
+    exit_code = 0
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            report["regressions"] = compare(report, json.load(f), threshold=args.threshold)
+        for regression in report["regressions"]:
+            print(f"REGRESSION {regression['case']} {regression['metric']}: "
+                  f"{regression['baseline']} -> {regression['current']}", file=sys.stderr)
+        exit_code = 1 if report["regressions"] else 0
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    return exit_code
+
+if __name__ == "__main__":
+    sys.exit(main())
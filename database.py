@@ -1,12 +1,43 @@
-from sqlalchemy import create_engine
+import os
+from sqlalchemy import create_engine, event
+from sqlalchemy.pool import QueuePool
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
+from starlette.concurrency import run_in_threadpool
 
-SQLALCHEMY_DATABASE_URL = "sqlite:///./hilos.db"
+SQLALCHEMY_DATABASE_URL = os.getenv('DATABASE_URL', "sqlite:///./hilos.db")
+
+# Conexiones del pool; con SQLite hay una por hilo del threadpool que toca la base
+DB_POOL_SIZE = int(os.getenv('HILOS_DB_POOL_SIZE', '10'))
+DB_MAX_OVERFLOW = int(os.getenv('HILOS_DB_MAX_OVERFLOW', '20'))
+DB_POOL_TIMEOUT = float(os.getenv('HILOS_DB_POOL_TIMEOUT', '30'))
+
+# Milisegundos que SQLite espera un lock de escritura antes de fallar con "database is locked"
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv('HILOS_SQLITE_BUSY_TIMEOUT_MS', '5000'))
+
+is_sqlite = SQLALCHEMY_DATABASE_URL.startswith("sqlite")
 
 engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
+    SQLALCHEMY_DATABASE_URL,
+    connect_args={"check_same_thread": False} if is_sqlite else {},
+    # SQLAlchemy usa NullPool con SQLite por defecto, que abre una conexión (y repite los PRAGMA) por sesión
+    poolclass=QueuePool,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_timeout=DB_POOL_TIMEOUT,
+    pool_pre_ping=not is_sqlite,
 )
+
+if is_sqlite:
+    @event.listens_for(engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        """WAL deja leer mientras otro escribe; con NORMAL solo se hace fsync en los checkpoints"""
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+        cursor.close()
+
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 Base = declarative_base()
@@ -16,4 +47,14 @@ def get_db():
     try:
         yield db
     finally:
-        db.close()
\ No newline at end of file
+        db.close()
+
+async def run_db(fn, *args, **kwargs):
+    """Ejecutar trabajo síncrono con la base de datos en el threadpool, fuera del event loop"""
+    return await run_in_threadpool(fn, *args, **kwargs)
+
+def create_missing_indexes(metadata):
+    """Crear los índices declarados en los modelos que falten en tablas ya existentes"""
+    for table in metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True)
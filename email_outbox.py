@@ -0,0 +1,299 @@
+import asyncio
+import logging
+import os
+import random
+import smtplib
+import ssl
+from datetime import datetime, timedelta
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+from sqlalchemy import or_
+
+from metrics import EMAILS, observe_call
+from models import OutboundEmail
+
+logger = logging.getLogger(__name__)
+
+# Conexiones SMTP que envían en paralelo
+EMAIL_WORKERS = int(os.getenv('HILOS_EMAIL_WORKERS', '1'))
+
+# Correos que un worker reclama y envía por la misma conexión
+EMAIL_BATCH_SIZE = int(os.getenv('HILOS_EMAIL_BATCH_SIZE', '20'))
+
+# Segundos entre revisiones del outbox cuando nadie avisa de correos nuevos
+EMAIL_POLL_INTERVAL = float(os.getenv('HILOS_EMAIL_POLL_INTERVAL', '30'))
+
+# Intentos antes de marcar un correo como fallido, y espera base/máxima entre ellos
+EMAIL_MAX_ATTEMPTS = int(os.getenv('HILOS_EMAIL_MAX_ATTEMPTS', '8'))
+EMAIL_BACKOFF_BASE = float(os.getenv('HILOS_EMAIL_BACKOFF_BASE', '30'))
+EMAIL_BACKOFF_MAX = float(os.getenv('HILOS_EMAIL_BACKOFF_MAX', '3600'))
+
+# Tiempo que un worker tiene reservado un correo; si se cae, otro lo retoma al vencer
+EMAIL_LEASE_SECONDS = 300
+
+# Segundos sin trabajo tras los que se cierra la conexión SMTP abierta
+SMTP_IDLE_TIMEOUT = 60
+
+class SmtpSettings:
+    """Configuración SMTP leída de las mismas variables de entorno de siempre"""
+
+    def __init__(self, host, port, username=None, password=None, from_address=None, starttls=True, timeout=30):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.from_address = from_address
+        self.starttls = starttls
+        self.timeout = timeout
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            host=os.getenv('EMAIL_HOST', 'smtp.gmail.com'),
+            port=int(os.getenv('EMAIL_PORT', '587')),
+            username=os.getenv('EMAIL_USERNAME'),
+            password=os.getenv('EMAIL_PASSWORD'),
+            from_address=os.getenv('FROM_EMAIL_ADDRESS'),
+            # Un servidor SMTP local de pruebas no suele ofrecer STARTTLS
+            starttls=os.getenv('EMAIL_STARTTLS', '1') != '0',
+        )
+
+    @property
+    def configured(self):
+        return bool(self.from_address and self.host)
+
+class SmtpConnection:
+    """Una conexión SMTP autenticada que se reutiliza entre lotes"""
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.server = None
+
+    def ensure(self):
+        if self.server is not None:
+            try:
+                self.server.noop()
+                return self.server
+            except smtplib.SMTPException:
+                self.close()
+
+        with observe_call("smtp", "connect"):
+            server = smtplib.SMTP(self.settings.host, self.settings.port, timeout=self.settings.timeout)
+            try:
+                if self.settings.starttls:
+                    server.starttls(context=ssl.create_default_context())
+                if self.settings.username and self.settings.password:
+                    server.login(self.settings.username, self.settings.password)
+            except Exception:
+                server.close()
+                raise
+        self.server = server
+        return server
+
+    def send(self, to_address, subject, html):
+        message = MIMEMultipart("alternative")
+        message["Subject"] = subject
+        message["From"] = self.settings.from_address
+        message["To"] = to_address
+        message.attach(MIMEText(html, "html"))
+
+        server = self.ensure()
+        with observe_call("smtp", "send"):
+            server.sendmail(self.settings.from_address, to_address, message.as_string())
+
+    def close(self):
+        if self.server is None:
+            return
+        try:
+            self.server.quit()
+        except Exception:
+            self.server.close()
+        self.server = None
+
+def enqueue_email(db, to_address, subject, html):
+    """
+    Agregar un correo al outbox en la sesión ``db`` sin hacer commit.
+
+    Así el correo se confirma en la misma transacción que el registro que lo
+    origina: o quedan los dos o no queda ninguno.
+    """
+    email = OutboundEmail(to_address=to_address, subject=subject, html=html)
+    db.add(email)
+    return email
+
+def retry_delay(attempts, base=EMAIL_BACKOFF_BASE, maximum=EMAIL_BACKOFF_MAX):
+    """Espera exponencial con jitter antes del intento número ``attempts + 1``"""
+    delay = min(base * 2 ** max(attempts - 1, 0), maximum)
+    return delay * random.uniform(0.8, 1.2)
+
+def is_permanent_error(error):
+    """Destinatario rechazado o mensaje rechazado con 5xx: reintentar no lo arregla"""
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return True
+    if isinstance(error, smtplib.SMTPDataError):
+        return not 400 <= error.smtp_code < 500
+    return False
+
+class EmailOutbox:
+    """
+    Worker en segundo plano que vacía la tabla ``outbound_emails``.
+
+    Cada worker reclama un lote con un lease (así varios procesos pueden
+    compartir la tabla), lo envía por su propia conexión SMTP y reprograma los
+    fallos con backoff exponencial. ``connection_factory`` permite usar otra
+    conexión en pruebas.
+    """
+
+    def __init__(self, session_factory, settings=None, workers=EMAIL_WORKERS, batch_size=EMAIL_BATCH_SIZE,
+                 poll_interval=EMAIL_POLL_INTERVAL, max_attempts=EMAIL_MAX_ATTEMPTS, connection_factory=SmtpConnection):
+        self.session_factory = session_factory
+        self.settings = settings or SmtpSettings.from_env()
+        self.workers = max(1, workers)
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.connection_factory = connection_factory
+        self._wake = None
+        self._tasks = []
+
+    def claim_batch(self):
+        """Reservar hasta ``batch_size`` correos pendientes y devolverlos como dicts"""
+        db = self.session_factory()
+        try:
+            now = datetime.utcnow()
+            candidates = db.query(OutboundEmail.id) \
+                .filter(or_(OutboundEmail.status == "pending", OutboundEmail.status == "sending")) \
+                .filter(OutboundEmail.next_attempt_at <= now) \
+                .order_by(OutboundEmail.next_attempt_at) \
+                .limit(self.batch_size) \
+                .all()
+
+            claimed = []
+            lease_until = now + timedelta(seconds=EMAIL_LEASE_SECONDS)
+            for (email_id,) in candidates:
+                # Solo se queda con el correo quien logra actualizarlo primero
+                updated = db.query(OutboundEmail) \
+                    .filter(OutboundEmail.id == email_id, OutboundEmail.next_attempt_at <= now) \
+                    .filter(or_(OutboundEmail.status == "pending", OutboundEmail.status == "sending")) \
+                    .update({"status": "sending", "next_attempt_at": lease_until}, synchronize_session=False)
+                if updated:
+                    claimed.append(email_id)
+            db.commit()
+
+            emails = db.query(OutboundEmail).filter(OutboundEmail.id.in_(claimed)).all() if claimed else []
+            return [
+                {"id": e.id, "to_address": e.to_address, "subject": e.subject, "html": e.html, "attempts": e.attempts}
+                for e in emails
+            ]
+        finally:
+            db.close()
+
+    def send_batch(self, connection, batch):
+        """Enviar un lote por ``connection`` y guardar el resultado de cada correo"""
+        results = []
+        for index, email in enumerate(batch):
+            try:
+                connection.send(email["to_address"], email["subject"], email["html"])
+                results.append((email, None))
+            except (smtplib.SMTPRecipientsRefused, smtplib.SMTPDataError) as e:
+                # Problema del destinatario o del mensaje: la conexión sigue sirviendo y solo
+                # se reintenta si el servidor respondió con un error temporal (4xx)
+                results.append((email, e))
+            except Exception as e:
+                # Problema de conexión o de login: se reintenta todo lo que faltaba
+                connection.close()
+                results.extend((pending, e) for pending in batch[index:])
+                break
+        self.record_results(results)
+        return results
+
+    def record_results(self, results):
+        db = self.session_factory()
+        try:
+            now = datetime.utcnow()
+            for email, error in results:
+                row = db.get(OutboundEmail, email["id"])
+                if row is None:
+                    continue
+                row.attempts = email["attempts"] + 1
+                if error is None:
+                    row.status = "sent"
+                    row.sent_at = now
+                    row.last_error = None
+                    EMAILS.inc(outcome="sent")
+                elif row.attempts >= self.max_attempts or is_permanent_error(error):
+                    row.status = "failed"
+                    row.last_error = str(error)[:500]
+                    EMAILS.inc(outcome="failed")
+                    logger.error(f"Correo {row.id} a {row.to_address} descartado tras {row.attempts} intentos: {error}")
+                else:
+                    row.status = "pending"
+                    row.next_attempt_at = now + timedelta(seconds=retry_delay(row.attempts))
+                    row.last_error = str(error)[:500]
+                    EMAILS.inc(outcome="retry")
+                    logger.warning(f"Error enviando correo {row.id}, se reintentará: {error}")
+            db.commit()
+        finally:
+            db.close()
+
+    def drain(self, connection=None):
+        """Enviar todo lo pendiente de forma síncrona; devuelve cuántos correos se enviaron"""
+        own_connection = connection is None
+        connection = connection or self.connection_factory(self.settings)
+        sent = 0
+        try:
+            while True:
+                batch = self.claim_batch()
+                if not batch:
+                    return sent
+                sent += sum(1 for _, error in self.send_batch(connection, batch) if error is None)
+        finally:
+            if own_connection:
+                connection.close()
+
+    def wake(self):
+        """Avisar a los workers de que hay correos nuevos en lugar de esperar al sondeo"""
+        if self._wake is not None:
+            self._wake.set()
+
+    async def _worker(self):
+        connection = self.connection_factory(self.settings)
+        idle_since = None
+        try:
+            while True:
+                # Se limpia antes de reclamar para no perder un aviso que llegue mientras tanto
+                self._wake.clear()
+                try:
+                    batch = await asyncio.to_thread(self.claim_batch)
+                    if batch:
+                        idle_since = None
+                        await asyncio.to_thread(self.send_batch, connection, batch)
+                        continue
+                except Exception as e:
+                    logger.error(f"Error en el worker del outbox de correo: {str(e)}")
+
+                loop = asyncio.get_running_loop()
+                idle_since = idle_since or loop.time()
+                if connection.server is not None and loop.time() - idle_since >= SMTP_IDLE_TIMEOUT:
+                    await asyncio.to_thread(connection.close)
+
+                try:
+                    await asyncio.wait_for(self._wake.wait(), timeout=self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            connection.close()
+
+    def start(self):
+        if not self.settings.configured:
+            logger.error("Dirección de remitente no configurada; los correos quedan en el outbox sin enviarse")
+            return
+        self._wake = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
@@ -0,0 +1,146 @@
+import asyncio
+import functools
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+logger = logging.getLogger(__name__)
+
+# "process" ejecuta cada generación en un proceso aparte; "thread" la ejecuta
+# en un hilo del mismo proceso (útil en desarrollo o con un solo núcleo)
+GENERATION_MODE = os.getenv('HILOS_GENERATION_MODE', 'process')
+
+# Generaciones simultáneas y solicitudes que pueden esperar turno
+GENERATION_WORKERS = int(os.getenv('HILOS_GENERATION_WORKERS', str(os.cpu_count() or 1)))
+GENERATION_QUEUE_SIZE = int(os.getenv('HILOS_GENERATION_QUEUE_SIZE', '8'))
+
+# Segundos sugeridos al cliente cuando la cola está llena
+GENERATION_RETRY_AFTER = int(os.getenv('HILOS_GENERATION_RETRY_AFTER', '15'))
+
+class GenerationQueueFull(Exception):
+    """No quedan lugares en la cola de generación"""
+
+def _init_worker(pins, pixel_width):
+    """Importar cv2/numpy y mapear la geometría una sola vez por proceso"""
+    from hilos import warm_up
+    warm_up(pins=pins, pixel_width=pixel_width)
+
+def _ready():
+    return os.getpid()
+
+class GenerationPool:
+    """
+    Ejecuta el generador fuera del event loop con concurrencia acotada.
+
+    Como mucho ``workers`` generaciones corren a la vez y otras ``queue_size``
+    esperan turno; cualquier solicitud adicional recibe ``GenerationQueueFull``
+    en lugar de quedarse bloqueada.
+    """
+
+    def __init__(self, workers=GENERATION_WORKERS, queue_size=GENERATION_QUEUE_SIZE, mode=GENERATION_MODE):
+        if mode not in ('process', 'thread'):
+            raise ValueError(f"Modo de generación no soportado: {mode}")
+        self.workers = max(1, workers)
+        self.queue_size = max(0, queue_size)
+        self.mode = mode
+        self.pending = 0
+        self.pins = 240
+        self.pixel_width = 500
+        self._executor = None
+        self._warm_up = []
+
+    @property
+    def running(self):
+        return min(self.pending, self.workers)
+
+    @property
+    def queued(self):
+        return max(self.pending - self.workers, 0)
+
+    def is_full(self):
+        return self.pending >= self.workers + self.queue_size
+
+    def _create_executor(self):
+        if self.mode == 'process':
+            # spawn evita heredar del padre el event loop, conexiones a la base de datos o sockets
+            return ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_worker,
+                initargs=(self.pins, self.pixel_width)
+            )
+        return ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='hilos')
+
+    def start(self, pins=240, pixel_width=500):
+        """Crear los workers por adelantado para no pagar el arranque en la primera subida (ver ``ready``)"""
+        if self._executor is not None:
+            return
+        self.pins = pins
+        self.pixel_width = pixel_width
+        self._executor = self._create_executor()
+        if self.mode == 'process':
+            # Cada envío sin workers libres lanza un proceso nuevo, hasta ``workers``
+            self._warm_up = [self._executor.submit(_ready) for _ in range(self.workers)]
+        else:
+            self._warm_up = [self._executor.submit(_init_worker, pins, pixel_width)]
+
+    async def ready(self):
+        """Esperar, sin bloquear el event loop, a que los workers terminen de arrancar"""
+        warm_up, self._warm_up = self._warm_up, []
+        try:
+            for future in warm_up:
+                await asyncio.wrap_future(future)
+        except BrokenProcessPool:
+            # ``submit`` reinicia el pool con la primera generación
+            logger.error("Un worker de generación terminó mientras arrancaba")
+            return
+        if warm_up:
+            logger.info(f"Pool de generación iniciado con {self.workers} workers ({self.mode})")
+
+    def _restart(self):
+        """Reemplazar un pool roto (un worker murió, p. ej. por falta de memoria) por uno nuevo"""
+        broken, self._executor = self._executor, self._create_executor()
+        broken.shutdown(wait=False, cancel_futures=True)
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Reservar un lugar y enviar ``fn`` al pool.
+
+        La reserva ocurre antes de devolver, así que quien llama sabe de inmediato
+        si fue aceptado. Lanza ``GenerationQueueFull`` si no hay lugar.
+
+        Returns:
+            asyncio.Future: Resultado de ``fn``
+        """
+        if self.is_full():
+            raise GenerationQueueFull()
+        if self._executor is None:
+            self.start()
+
+        loop = asyncio.get_running_loop()
+        call = functools.partial(fn, *args, **kwargs)
+        try:
+            future = loop.run_in_executor(self._executor, call)
+        except BrokenProcessPool:
+            # Las generaciones que corrían en el pool roto fallan; las nuevas van a uno nuevo
+            logger.error("Un worker de generación terminó de forma inesperada; se reinicia el pool")
+            self._restart()
+            future = loop.run_in_executor(self._executor, call)
+
+        self.pending += 1
+        future.add_done_callback(self._release)
+        return future
+
+    def _release(self, _future):
+        self.pending -= 1
+
+    async def run(self, fn, *args, **kwargs):
+        """Ejecutar ``fn`` en el pool, o lanzar ``GenerationQueueFull`` si no hay lugar"""
+        return await self.submit(fn, *args, **kwargs)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
@@ -0,0 +1,492 @@
+import functools
+import logging
+import math as m
+import os
+import tempfile
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Bump when the rasterisation changes so stale files on disk are ignored
+GEOMETRY_VERSION = 1
+
+# Directory shared by every worker for the memory-mapped chord indexes
+GEOMETRY_CACHE_DIR = os.getenv('HILOS_GEOMETRY_DIR', 'geometry_cache')
+
+# Number of chord indexes kept open per process
+GEOMETRY_CACHE_SIZE = int(os.getenv('HILOS_GEOMETRY_CACHE_SIZE', '4'))
+
+# Geometries whose ChordIndex would take more bytes than this use CompactChordIndex
+COMPACT_INDEX_BYTES = int(os.getenv('HILOS_COMPACT_INDEX_BYTES', str(512 * 1024 * 1024)))
+
+def pin_circle(pixel_width):
+    """Center and radius of the pin circle inscribed in the image."""
+    center = [pixel_width/2, pixel_width/2]
+    radius = pixel_width/2 - 1/2
+    return center, radius
+
+# Calculating the coordinates of each pin
+def pin_coordinates(PIN_NO, center, radius):
+    pinCoord = []
+    angleIncrement = 2 * m.pi / PIN_NO
+
+    for i in range(PIN_NO):
+        pinCoord.append((
+            m.floor(center[0] + radius * m.cos(i * angleIncrement)),
+            m.floor(center[1] + radius * m.sin(i * angleIncrement))
+        ))
+
+    return pinCoord
+
+class ChordIndex:
+    """
+    Flat CSR-style index of the pixels crossed by every candidate chord.
+
+    Row ``pin * K + k`` holds the chord from ``pin`` to
+    ``(pin + min_distance + k) % pin_no``, where ``K = pin_no - 2 * min_distance``
+    is the number of candidates per pin. Pixels are stored as flat indices into
+    the raveled ``pixel_width`` x ``pixel_width`` residual, so all the chords
+    leaving a pin are one contiguous slice of ``pixels``.
+    """
+
+    def __init__(self, pin_no, min_distance, pixel_width, offsets, pixels):
+        self.pin_no = pin_no
+        self.min_distance = min_distance
+        self.pixel_width = pixel_width
+        self.pin_coords = pin_coordinates(pin_no, *pin_circle(pixel_width))
+        self.candidate_count = max(pin_no - 2 * min_distance, 0)
+        self.offsets = offsets
+        self.pixels_flat = pixels
+
+    def candidates(self, pin):
+        """Candidate pins for ``pin``, ordered by increasing pin difference."""
+        steps = np.arange(self.min_distance, self.min_distance + self.candidate_count)
+        return (pin + steps) % self.pin_no
+
+    def pixels(self, pin, k):
+        """Flat pixel indices of the chord from ``pin`` to its ``k``-th candidate."""
+        row = pin * self.candidate_count + k
+        return self.pixels_flat[self.offsets[row]:self.offsets[row + 1]]
+
+    def score(self, residual, pin):
+        """
+        Sum ``residual`` along every candidate chord leaving ``pin``.
+
+        Args:
+            residual (np.ndarray): Raveled residual image
+            pin (int): Pin the next line starts from
+
+        Returns:
+            np.ndarray: One float64 score per candidate, in ``candidates(pin)`` order
+        """
+        rows = self.offsets[pin * self.candidate_count:(pin + 1) * self.candidate_count + 1]
+        values = residual[self.pixels_flat[rows[0]:rows[-1]]]
+        cumulative = np.concatenate(([0.0], np.cumsum(values, dtype=np.float64)))
+        bounds = rows - rows[0]
+        return cumulative[bounds[1:]] - cumulative[bounds[:-1]]
+
+    def score_subset(self, residual, pin, ks):
+        """
+        Sum ``residual`` along a few candidate chords leaving ``pin``.
+
+        Args:
+            residual (np.ndarray): Raveled residual image
+            pin (int): Pin the next line starts from
+            ks (np.ndarray): Candidate positions, as in ``candidates(pin)``
+
+        Returns:
+            np.ndarray: One float64 score per entry of ``ks``
+        """
+        if len(ks) == 0:
+            return np.zeros(0)
+        segments = [self.pixels(pin, k) for k in ks]
+        values = residual[np.concatenate(segments)]
+        cumulative = np.concatenate(([0.0], np.cumsum(values, dtype=np.float64)))
+        bounds = np.concatenate(([0], np.cumsum([len(segment) for segment in segments])))
+        return cumulative[bounds[1:]] - cumulative[bounds[:-1]]
+
+class CompactChordIndex:
+    """
+    Chord index for large images, about a quarter of the size of ``ChordIndex``.
+
+    Both directions of a chord share one entry: ``row_chords`` maps the row
+    ``pin * K + k`` of ``ChordIndex`` to it. An entry stores its first flat
+    pixel in ``starts`` and the int16 steps between consecutive pixels in
+    ``steps[offsets[c]:offsets[c + 1]]``; a step moves at most two rows, so it
+    fits for any ``pixel_width`` below 16000. Pixels are decoded on demand and
+    come out exactly as ``ChordIndex`` stores them, so scores are identical,
+    but decoding makes full scans slower: it is meant for the coarse residual
+    and the shortlist of the "multires" search.
+    """
+
+    def __init__(self, pin_no, min_distance, pixel_width, row_chords, starts, offsets, steps):
+        self.pin_no = pin_no
+        self.min_distance = min_distance
+        self.pixel_width = pixel_width
+        self.pin_coords = pin_coordinates(pin_no, *pin_circle(pixel_width))
+        self.candidate_count = max(pin_no - 2 * min_distance, 0)
+        self.row_chords = row_chords
+        self.starts = starts
+        self.offsets = offsets
+        self.steps = steps
+
+    def candidates(self, pin):
+        """Candidate pins for ``pin``, ordered by increasing pin difference."""
+        steps = np.arange(self.min_distance, self.min_distance + self.candidate_count)
+        return (pin + steps) % self.pin_no
+
+    def _decode(self, chord_ids):
+        """Flat pixels of several chords, concatenated, and the length of each."""
+        begins = self.offsets[chord_ids]
+        lengths = self.offsets[chord_ids + 1] - begins
+        ends = np.cumsum(lengths)
+        firsts = ends - lengths
+        index = np.arange(ends[-1] if len(ends) else 0) + np.repeat(begins - firsts, lengths)
+        cumulative = np.concatenate(([0], np.cumsum(self.steps[index], dtype=np.int64)))
+        # The first step of every chord is 0, so each one restarts from its first pixel
+        pixels = cumulative[1:] + np.repeat(self.starts[chord_ids] - cumulative[firsts], lengths)
+        return pixels, lengths
+
+    def _score_chords(self, residual, chord_ids):
+        pixels, lengths = self._decode(chord_ids)
+        cumulative = np.concatenate(([0.0], np.cumsum(residual[pixels], dtype=np.float64)))
+        bounds = np.concatenate(([0], np.cumsum(lengths)))
+        return cumulative[bounds[1:]] - cumulative[bounds[:-1]]
+
+    def pixels(self, pin, k):
+        """Flat pixel indices of the chord from ``pin`` to its ``k``-th candidate."""
+        row = pin * self.candidate_count + k
+        return self._decode(self.row_chords[row:row + 1])[0]
+
+    def score(self, residual, pin):
+        """Sum ``residual`` along every candidate chord leaving ``pin``, like ``ChordIndex.score``."""
+        count = self.candidate_count
+        return self._score_chords(residual, self.row_chords[pin * count:(pin + 1) * count])
+
+    def score_subset(self, residual, pin, ks):
+        """Sum ``residual`` along a few candidate chords leaving ``pin``, like ``ChordIndex.score_subset``."""
+        if len(ks) == 0:
+            return np.zeros(0)
+        return self._score_chords(residual, self.row_chords[pin * self.candidate_count + np.asarray(ks)])
+
+class PixelIndex:
+    """
+    Inverse of a ``ChordIndex``: the chord rows crossing each pixel.
+
+    ``rows[offsets[p]:offsets[p + 1]]`` lists every chord row whose pixels
+    include the flat pixel ``p``, once per occurrence, so a chord that visits
+    a pixel twice is listed twice, just as ``ChordIndex.score`` counts it.
+    """
+
+    def __init__(self, offsets, rows):
+        self.offsets = offsets
+        self.rows = rows
+
+    def rows_crossing(self, pixels):
+        """
+        Rows of the chords crossing ``pixels``, one entry per occurrence.
+
+        Args:
+            pixels (np.ndarray): Flat pixel indices; repeat a pixel to count it again
+
+        Returns:
+            np.ndarray: int32 chord rows, with repeats
+        """
+        starts = self.offsets[pixels]
+        lengths = self.offsets[pixels + 1] - starts
+        ends = np.cumsum(lengths)
+        index = np.arange(ends[-1] if len(ends) else 0) + np.repeat(starts - (ends - lengths), lengths)
+        return self.rows[index]
+
+def build_pixel_index(chords):
+    """
+    Invert a ``ChordIndex`` into a ``PixelIndex``.
+
+    Args:
+        chords (ChordIndex): Chord index to invert
+
+    Returns:
+        PixelIndex: Chord rows grouped by pixel
+    """
+    pixelCount = chords.pixel_width * chords.pixel_width
+    rowOfEntry = np.repeat(np.arange(len(chords.offsets) - 1, dtype=np.int32), np.diff(chords.offsets))
+    order = np.argsort(chords.pixels_flat, kind="stable")
+
+    offsets = np.zeros(pixelCount + 1, dtype=np.int64)
+    np.cumsum(np.bincount(chords.pixels_flat, minlength=pixelCount), out=offsets[1:])
+    return PixelIndex(offsets, rowOfEntry[order])
+
+def build_chord_index(pins, pixel_width, min_distance):
+    """
+    Rasterise every candidate chord between pins into a ``ChordIndex``.
+
+    Args:
+        pins (int): Number of pins
+        pixel_width (int): Width of the square residual image
+        min_distance (int): Minimum pin difference of a candidate chord
+
+    Returns:
+        ChordIndex: Flat index of all candidate chord pixels
+    """
+    PIN_NO = pins
+    pinCoord = pin_coordinates(PIN_NO, *pin_circle(pixel_width))
+    candidateCount = max(PIN_NO - 2 * min_distance, 0)
+
+    # Each chord is rasterised once, from the lower to the higher pin, so both
+    # directions cover exactly the same pixels
+    chordCache = {}
+
+    def chordPixels(point1, point2):
+        if point1 > point2:
+            point1, point2 = point2, point1
+        key = point1 * PIN_NO + point2
+        if key not in chordCache:
+            x0, y0 = pinCoord[point1]
+            x1, y1 = pinCoord[point2]
+
+            hypDistance = int(m.sqrt((x1-x0)**2 + (y1-y0)**2))
+
+            xCoords = np.linspace(x0, x1, hypDistance, dtype=int)
+            yCoords = np.linspace(y0, y1, hypDistance, dtype=int)
+
+            chordCache[key] = (yCoords * pixel_width + xCoords).astype(np.int32)
+        return chordCache[key]
+
+    rows = []
+    for pin in range(PIN_NO):
+        for k in range(candidateCount):
+            rows.append(chordPixels(pin, (pin + min_distance + k) % PIN_NO))
+
+    offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+    if rows:
+        np.cumsum([len(row) for row in rows], out=offsets[1:])
+        pixels = np.concatenate(rows)
+    else:
+        pixels = np.zeros(0, dtype=np.int32)
+
+    return ChordIndex(PIN_NO, min_distance, pixel_width, offsets, pixels)
+
+def chord_index_bytes(pins, pixel_width, min_distance):
+    """Size in bytes of the ``ChordIndex`` of a geometry, without building it."""
+    pinCoord = np.array(pin_coordinates(pins, *pin_circle(pixel_width)), dtype=np.int64)
+    candidateCount = max(pins - 2 * min_distance, 0)
+    fromPins = np.repeat(np.arange(pins), candidateCount)
+    toPins = (fromPins + min_distance + np.tile(np.arange(candidateCount), pins)) % pins
+    lengths = np.sqrt(((pinCoord[toPins] - pinCoord[fromPins]) ** 2).sum(axis=1)).astype(np.int64)
+    return 4 * int(lengths.sum()) + 8 * (len(lengths) + 1)
+
+def build_compact_chord_index(pins, pixel_width, min_distance, path):
+    """
+    Rasterise every chord into a ``CompactChordIndex`` stored at ``path``.
+
+    The steps are written straight to a memory-mapped file as each chord is
+    rasterised, so building never holds the whole index in memory.
+
+    Args:
+        pins (int): Number of pins
+        pixel_width (int): Width of the square residual image
+        min_distance (int): Minimum pin difference of a candidate chord
+        path (str): Base path of the ``.npy`` files, as returned by ``_compact_cache_path``
+    """
+    if 2 * pixel_width + 2 > np.iinfo(np.int16).max:
+        raise ValueError(f"pixel_width {pixel_width} is too large for int16 chord steps")
+
+    PIN_NO = pins
+    pinCoord = pin_coordinates(PIN_NO, *pin_circle(pixel_width))
+    candidateCount = max(PIN_NO - 2 * min_distance, 0)
+
+    # Chords are keyed by (lower pin, higher pin) and rasterised in that
+    # direction, as in build_chord_index
+    fromPins = np.repeat(np.arange(PIN_NO), candidateCount)
+    toPins = (fromPins + min_distance + np.tile(np.arange(candidateCount), PIN_NO)) % PIN_NO
+    keys = np.minimum(fromPins, toPins) * PIN_NO + np.maximum(fromPins, toPins)
+    chordKeys, rowChords = np.unique(keys, return_inverse=True)
+    lowPins, highPins = np.divmod(chordKeys, PIN_NO)
+
+    coords = np.array(pinCoord, dtype=np.int64).reshape(-1, 2)
+    lengths = np.sqrt(((coords[highPins] - coords[lowPins]) ** 2).sum(axis=1)).astype(np.int64)
+    offsets = np.zeros(len(chordKeys) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    starts = np.zeros(len(chordKeys), dtype=np.int32)
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.steps.{os.getpid()}.tmp"
+    steps = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.int16, shape=(int(offsets[-1]),))
+    for chord, (point1, point2) in enumerate(zip(lowPins.tolist(), highPins.tolist())):
+        if lengths[chord] == 0:
+            continue
+        x0, y0 = pinCoord[point1]
+        x1, y1 = pinCoord[point2]
+
+        xCoords = np.linspace(x0, x1, lengths[chord], dtype=int)
+        yCoords = np.linspace(y0, y1, lengths[chord], dtype=int)
+
+        pixels = yCoords * pixel_width + xCoords
+        starts[chord] = pixels[0]
+        steps[offsets[chord] + 1:offsets[chord + 1]] = np.diff(pixels)
+    steps.flush()
+    del steps
+    os.replace(tmp_path, f"{path}.steps.npy")
+
+    _save(path, {"rowchords": rowChords.astype(np.int32), "starts": starts, "offsets": offsets})
+
+def _cache_path(pins, pixel_width, min_distance):
+    name = f"chords_v{GEOMETRY_VERSION}_p{pins}_w{pixel_width}_d{min_distance}"
+    return os.path.join(GEOMETRY_CACHE_DIR, name)
+
+def _compact_cache_path(pins, pixel_width, min_distance, directory=None):
+    name = f"compact_v{GEOMETRY_VERSION}_p{pins}_w{pixel_width}_d{min_distance}"
+    return os.path.join(directory or GEOMETRY_CACHE_DIR, name)
+
+def _save(path, arrays):
+    """Write every array atomically so concurrent workers never see partial files."""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    for suffix, array in arrays.items():
+        tmp_path = f"{path}.{suffix}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, array)
+        os.replace(tmp_path, f"{path}.{suffix}.npy")
+
+def _load(path, pins, pixel_width, min_distance):
+    offsets = np.load(f"{path}.offsets.npy", mmap_mode="r")
+    pixels = np.load(f"{path}.pixels.npy", mmap_mode="r")
+    if len(offsets) != pins * max(pins - 2 * min_distance, 0) + 1 or offsets[-1] != len(pixels):
+        raise ValueError(f"Corrupt chord index: {path}")
+    return ChordIndex(pins, min_distance, pixel_width, offsets, pixels)
+
+@functools.lru_cache(maxsize=GEOMETRY_CACHE_SIZE)
+def get_chord_index(pins, pixel_width, min_distance):
+    """
+    Return the chord index for a geometry, building it at most once per host.
+
+    Indexes are kept in a per-process LRU and persisted as ``.npy`` files under
+    ``GEOMETRY_CACHE_DIR``. They are always opened read-only with ``mmap_mode``,
+    so every worker that maps the same file shares its pages with the others.
+
+    Args:
+        pins (int): Number of pins
+        pixel_width (int): Width of the square residual image
+        min_distance (int): Minimum pin difference of a candidate chord
+
+    Returns:
+        ChordIndex: Read-only chord index
+    """
+    path = _cache_path(pins, pixel_width, min_distance)
+    try:
+        return _load(path, pins, pixel_width, min_distance)
+    except (OSError, ValueError):
+        pass
+
+    chords = build_chord_index(pins, pixel_width, min_distance)
+
+    try:
+        _save(path, {"offsets": chords.offsets, "pixels": chords.pixels_flat})
+        return _load(path, pins, pixel_width, min_distance)
+    except (OSError, ValueError) as e:
+        logger.warning(f"Could not persist chord index to {path}: {e}")
+        chords.offsets.flags.writeable = False
+        chords.pixels_flat.flags.writeable = False
+        return chords
+
+def _load_inverted(path, chords):
+    offsets = np.load(f"{path}.offsets.npy", mmap_mode="r")
+    rows = np.load(f"{path}.rows.npy", mmap_mode="r")
+    if len(offsets) != chords.pixel_width * chords.pixel_width + 1 or offsets[-1] != len(rows) \
+            or len(rows) != len(chords.pixels_flat):
+        raise ValueError(f"Corrupt pixel index: {path}")
+    return PixelIndex(offsets, rows)
+
+@functools.lru_cache(maxsize=GEOMETRY_CACHE_SIZE)
+def get_pixel_index(pins, pixel_width, min_distance):
+    """
+    Return the ``PixelIndex`` of a geometry, built and shared like ``get_chord_index``.
+
+    Args:
+        pins (int): Number of pins
+        pixel_width (int): Width of the square residual image
+        min_distance (int): Minimum pin difference of a candidate chord
+
+    Returns:
+        PixelIndex: Read-only inverted index
+    """
+    chords = get_chord_index(pins, pixel_width, min_distance)
+    path = _cache_path(pins, pixel_width, min_distance) + "_inverted"
+    try:
+        return _load_inverted(path, chords)
+    except (OSError, ValueError):
+        pass
+
+    inverted = build_pixel_index(chords)
+
+    try:
+        _save(path, {"offsets": inverted.offsets, "rows": inverted.rows})
+        return _load_inverted(path, chords)
+    except (OSError, ValueError) as e:
+        logger.warning(f"Could not persist pixel index to {path}: {e}")
+        inverted.offsets.flags.writeable = False
+        inverted.rows.flags.writeable = False
+        return inverted
+
+def _load_compact(path, pins, pixel_width, min_distance):
+    arrays = {suffix: np.load(f"{path}.{suffix}.npy", mmap_mode="r")
+              for suffix in ("rowchords", "starts", "offsets", "steps")}
+    if len(arrays["rowchords"]) != pins * max(pins - 2 * min_distance, 0) \
+            or len(arrays["offsets"]) != len(arrays["starts"]) + 1 or arrays["offsets"][-1] != len(arrays["steps"]):
+        raise ValueError(f"Corrupt compact chord index: {path}")
+    return CompactChordIndex(pins, min_distance, pixel_width, arrays["rowchords"], arrays["starts"],
+                             arrays["offsets"], arrays["steps"])
+
+@functools.lru_cache(maxsize=GEOMETRY_CACHE_SIZE)
+def get_compact_chord_index(pins, pixel_width, min_distance):
+    """
+    Return the ``CompactChordIndex`` of a geometry, built and shared like ``get_chord_index``.
+
+    It is always memory-mapped from disk; when ``GEOMETRY_CACHE_DIR`` is not
+    writable it is built in the system temporary directory instead.
+
+    Args:
+        pins (int): Number of pins
+        pixel_width (int): Width of the square residual image
+        min_distance (int): Minimum pin difference of a candidate chord
+
+    Returns:
+        CompactChordIndex: Read-only chord index
+    """
+    path = _compact_cache_path(pins, pixel_width, min_distance)
+    try:
+        return _load_compact(path, pins, pixel_width, min_distance)
+    except (OSError, ValueError):
+        pass
+
+    try:
+        build_compact_chord_index(pins, pixel_width, min_distance, path)
+    except OSError as e:
+        logger.warning(f"Could not persist compact chord index to {path}: {e}")
+        path = _compact_cache_path(pins, pixel_width, min_distance, tempfile.gettempdir())
+        build_compact_chord_index(pins, pixel_width, min_distance, path)
+    return _load_compact(path, pins, pixel_width, min_distance)
+
+@functools.lru_cache(maxsize=None)
+def uses_compact_index(pins, pixel_width, min_distance):
+    """True when a geometry's ``ChordIndex`` would exceed ``COMPACT_INDEX_BYTES``."""
+    return chord_index_bytes(pins, pixel_width, min_distance) > COMPACT_INDEX_BYTES
+
+def get_geometry(pins, pixel_width, min_distance):
+    """``get_chord_index``, or ``get_compact_chord_index`` for geometries that ``uses_compact_index``."""
+    if uses_compact_index(pins, pixel_width, min_distance):
+        return get_compact_chord_index(pins, pixel_width, min_distance)
+    return get_chord_index(pins, pixel_width, min_distance)
+
+def warm_up(geometries):
+    """
+    Load or build the chord index of each ``(pins, pixel_width, min_distance)``.
+
+    Meant to run at startup so the first request does not pay for rasterising.
+    """
+    for pins, pixel_width, min_distance in geometries:
+        if uses_compact_index(pins, pixel_width, min_distance):
+            get_compact_chord_index(pins, pixel_width, min_distance)
+            continue
+        get_chord_index(pins, pixel_width, min_distance)
+        get_pixel_index(pins, pixel_width, min_distance)
@@ -1,55 +1,750 @@
 from PIL import Image, ImageDraw, ImageOps
 from tqdm import tqdm
 import collections
+import contextlib
 import numpy as np
 import math as m
 import cv2
+import io
 import os
 import json
 import uuid
 import time
 import random
+import tempfile
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+from geometry import (get_chord_index, get_compact_chord_index, get_geometry, get_pixel_index, pin_circle,
+                      pin_coordinates, uses_compact_index)
+from image_variants import write_variants
+from palette import allocate_lines, decompose, interleave, resolve_palette
+from render import render_color_sequences, render_sequence
+from sequence_format import SEQUENCE_EXTENSION, write_sequence
+
+# Bump whenever a change alters the generated sequence or image
+SOLVER_VERSION = 3
+
+# Solver tuning shared by every entry point
+MIN_PREVIOUS_PINS = 20
+LINE_WIDTH = 30
+MIN_DISTANCE = 20
+
+# Lines between full recomputations of the cached chord scores of a float residual
+SCORE_REFRESH_LINES = 250
+
+# JPEG decoders can downscale by these factors during decoding (DCT scaling)
+REDUCED_DECODE_FLAGS = (
+    (8, cv2.IMREAD_REDUCED_GRAYSCALE_8),
+    (4, cv2.IMREAD_REDUCED_GRAYSCALE_4),
+    (2, cv2.IMREAD_REDUCED_GRAYSCALE_2),
+)
+REDUCED_COLOR_DECODE_FLAGS = (
+    (8, cv2.IMREAD_REDUCED_COLOR_8),
+    (4, cv2.IMREAD_REDUCED_COLOR_4),
+    (2, cv2.IMREAD_REDUCED_COLOR_2),
+)
+
+# Processes solving the color layers of a multi-color image; 0 uses one per core
+COLOR_WORKERS = int(os.getenv('HILOS_COLOR_WORKERS', '0'))
+
+# Seconds of a ``deadline`` kept for rendering and saving once the solve is cut short,
+# plus the render and encode time of each line drawn (measured at 500 px output)
+DEADLINE_RESERVE = 0.25
+FINISH_SECONDS_PER_LINE = 5e-5
+
+# Geometries too large for a ChordIndex (see geometry.uses_compact_index) are solved with
+# the "multires" search on a coarse residual at most this wide
+LARGE_COARSE_WIDTH = 250
+
+# Directory for the memory-mapped residual of those images; None uses the system default
+SCRATCH_DIR = os.getenv('HILOS_SCRATCH_DIR') or None
+
+@contextlib.contextmanager
+def phase_timer(timings, phase):
+    """Add the wall time of the block to ``timings[phase]`` when ``timings`` is a dict."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if timings is not None:
+            timings[phase] = timings.get(phase, 0.0) + time.perf_counter() - start
+
+class CoarseLevel:
+    """
+    Downsampled copy of the residual, used to shortlist candidate chords.
+
+    Every coarse pixel holds the sum of the ``factor`` x ``factor`` full-resolution
+    pixels it covers and is kept in sync as lines are drawn, so coarse scores
+    track the full-resolution ones at a fraction of the chord length.
+    """
+
+    def __init__(self, residual, pixel_width, pins, factor):
+        self.factor = factor
+        self.pixel_width = -(-pixel_width // factor)
+        self.chords = get_geometry(pins, self.pixel_width, MIN_DISTANCE)
+
+        coarseAxis = (np.arange(pixel_width) // factor).astype(np.int32)
+        self.fine_to_coarse = (coarseAxis[:, None] * self.pixel_width + coarseAxis[None, :]).ravel()
+        self.residual = np.bincount(self.fine_to_coarse, weights=residual,
+                                    minlength=self.pixel_width * self.pixel_width)
+
+    def subtract(self, fine_pixels, amount):
+        """Mirror ``residual[fine_pixels] -= amount`` on the coarse residual."""
+        np.subtract.at(self.residual, self.fine_to_coarse[np.unique(fine_pixels)], amount)
+
+class ChordScores:
+    """
+    Cached residual sum of every chord, kept in sync as lines are drawn.
+
+    Drawing a line only changes the chords that cross its pixels, which the
+    ``PixelIndex`` lists, so a step costs the line length times the chords per
+    pixel instead of a rescan of every chord leaving the current pin. The
+    grayscale residual only ever holds integers, so the cached sums are exactly
+    what a rescan would return and the chosen lines do not change. The layers
+    of a multi-color image are floats, whose cached sums drift from a rescan
+    by rounding with every subtraction (around 1e-7 after a few thousand lines
+    on a 500 px layer, enough to break exact ties differently), so they are
+    recomputed every ``refresh_lines`` lines.
+
+    Args:
+        chords (ChordIndex): Chord geometry for the pin layout
+        residual (np.ndarray): Raveled residual image, updated in place by the caller
+        refresh_lines (int, optional): Lines between recomputations of a non-integer
+            residual. Defaults to ``SCORE_REFRESH_LINES``.
+    """
+
+    def __init__(self, chords, residual, refresh_lines=SCORE_REFRESH_LINES):
+        self.chords = chords
+        self.residual = residual
+        self.inverted = get_pixel_index(chords.pin_no, chords.pixel_width, chords.min_distance)
+        # Integer residuals (and integer line widths) keep the incremental sums exact
+        self.refresh_lines = None if np.array_equal(residual, np.round(residual)) else max(1, refresh_lines)
+        self._since_refresh = 0
+        self.refresh()
+
+    def refresh(self):
+        """Recompute every score from the residual."""
+        chords = self.chords
+        self.scores = np.concatenate([chords.score(self.residual, pin) for pin in range(chords.pin_no)]) \
+            if chords.candidate_count else np.zeros(0)
+        self._since_refresh = 0
+
+    def row(self, pin):
+        """Scores of the chords leaving ``pin``, as ``ChordIndex.score`` returns them (a copy)."""
+        count = self.chords.candidate_count
+        return self.scores[pin * count:(pin + 1) * count].copy()
+
+    def crossings(self, pixels):
+        """Chord rows crossing ``pixels`` once per line, matching ``residual[pixels] -= amount``."""
+        return self.inverted.rows_crossing(np.unique(pixels))
+
+    def subtract(self, pixels, amount):
+        """Mirror ``residual[pixels] -= amount`` on the cached scores."""
+        # A dense bincount is several times faster than np.subtract.at on the repeated rows
+        counts = np.bincount(self.crossings(pixels))
+        self.scores[:len(counts)] -= amount * counts
+        if self.refresh_lines is not None:
+            self._since_refresh += 1
+            if self._since_refresh >= self.refresh_lines:
+                self.refresh()
+
+def solve_lines(chords, residual, start_pin=0, coarse=None, top_k=16, planner=None, chord_scores=None):
+    """
+    Greedily choose lines one at a time, as a generator.
+
+    Each step scores every chord leaving the current pin, picks the darkest one
+    and subtracts it from ``residual`` in place. The generator only stops when
+    no candidate is left, so callers decide how many lines to take.
+
+    Args:
+        chords (ChordIndex): Chord geometry for the pin layout
+        residual (np.ndarray): Raveled float64 residual image, updated in place
+        start_pin (int, optional): Pin the thread starts from. Defaults to 0.
+        coarse (CoarseLevel, optional): When given, only the ``top_k`` best chords on the
+            coarse residual are rescored at full resolution. Defaults to None (exhaustive).
+        top_k (int, optional): Shortlist size for the coarse search. Defaults to 16.
+        planner (Lookahead, optional): Picks the line among the scored candidates instead of
+            the greedy maximum. Defaults to None.
+        chord_scores (ChordScores, optional): Cached scores of ``residual`` for the exhaustive
+            search; created here when not given. Ignored with ``coarse``.
+
+    Yields:
+        tuple: (from_pin, to_pin, score), where score is the residual summed along the chosen chord
+    """
+    currentPin = start_pin
+    previousPins = collections.deque(maxlen=MIN_PREVIOUS_PINS)
+    blockedPins = np.zeros(chords.pin_no, dtype=bool)
+    if coarse is None and chord_scores is None:
+        chord_scores = ChordScores(chords, residual)
+
+    while True:
+        candidates = chords.candidates(currentPin)
+        if len(candidates) == 0:
+            return
+
+        if coarse is None:
+            # Cached scores of every chord leaving the current pin
+            lineErrors = chord_scores.row(currentPin)
+            lineErrors[blockedPins[candidates]] = -m.inf
+
+            # argmax keeps the first maximum, i.e. the smallest pin difference
+            if planner is None:
+                best = int(np.argmax(lineErrors))
+            else:
+                best = planner.choose(residual, currentPin, lineErrors, blockedPins, previousPins)
+            score = lineErrors[best]
+        else:
+            # Shortlist on the coarse residual, then rescore the survivors at full resolution
+            coarseErrors = coarse.chords.score(coarse.residual, currentPin)
+            coarseErrors[blockedPins[candidates]] = -m.inf
+            keep = min(top_k, len(coarseErrors))
+            shortlist = np.sort(np.argpartition(-coarseErrors, keep - 1)[:keep])
+            shortlist = shortlist[coarseErrors[shortlist] > -m.inf]
+            if len(shortlist) == 0:
+                return
+
+            fineErrors = chords.score_subset(residual, currentPin, shortlist)
+            if planner is None:
+                best = int(shortlist[np.argmax(fineErrors)])
+                score = fineErrors.max()
+            else:
+                lineErrors = np.full(len(candidates), -m.inf)
+                lineErrors[shortlist] = fineErrors
+                best = planner.choose(residual, currentPin, lineErrors, blockedPins, previousPins)
+                score = lineErrors[best]
+
+        if score == -m.inf:
+            return
+        bestPin = int(candidates[best])
+
+        # The residual is not clipped, so over-drawn pixels turn negative
+        # and penalise chords that cross them again
+        linePixels = chords.pixels(currentPin, best)
+        residual[linePixels] -= LINE_WIDTH
+        if coarse is not None:
+            coarse.subtract(linePixels, LINE_WIDTH)
+        else:
+            chord_scores.subtract(linePixels, LINE_WIDTH)
+
+        if len(previousPins) == previousPins.maxlen:
+            blockedPins[previousPins[0]] = False
+        previousPins.append(bestPin)
+        blockedPins[bestPin] = True
+
+        yield currentPin, bestPin, float(score)
+        currentPin = bestPin
+
+class Lookahead:
+    """
+    Beam search over the next ``depth`` lines, committing only the first one.
+
+    The ``beam_width`` best chords from the current pin are extended one line
+    at a time; each level keeps the ``beam_width`` best partial paths by total
+    score. Branches never copy or modify the residual: the lines drawn along a
+    path are marked in a per-thread scratch image and a chord's score is its
+    residual sum minus ``LINE_WIDTH`` times its marked pixels, which is exactly
+    what it would score after drawing them. The branches of a level are scored
+    in parallel threads, since numpy releases the GIL in the reductions.
+
+    With ``chord_scores`` (the exhaustive search) a branch starts from the
+    cached scores and only the chords crossing its lines are corrected, found
+    through the inverted index instead of a scratch image.
+
+    With a ``headroom`` callback the search only runs while the measured cost
+    of a searched line still fits the time budget, and otherwise falls back to
+    the greedy choice, so a deadline is never missed because of it.
+    ``last_seconds`` is the time the last choice spent searching (0 when greedy).
+    """
 
-def generate_thread_image(file_path, output_dir=None, pins=240, lines=3500, pixel_width=500):
+    def __init__(self, chords, beam_width=4, depth=2, workers=1, headroom=None, chord_scores=None):
+        self.chords = chords
+        self.chord_scores = chord_scores
+        self.beam_width = max(1, beam_width)
+        self.depth = max(1, depth)
+        self.headroom = headroom
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="lookahead") if workers > 1 else None
+        self.seconds_per_line = None
+        self.last_seconds = 0.0
+        self.searched = 0
+        self.greedy = 0
+        self._scratch = threading.local()
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def _mask(self):
+        mask = getattr(self._scratch, "mask", None)
+        if mask is None:
+            mask = self._scratch.mask = np.zeros(self.chords.pixel_width * self.chords.pixel_width)
+        return mask
+
+    def _branches(self, scores, pin, total, first, blocked, previous, lines):
+        """The ``beam_width`` best one-line extensions of a path."""
+        keep = min(self.beam_width, int(np.count_nonzero(scores > -m.inf)))
+        if keep == 0:
+            return []
+        # Best first; ties keep the smaller pin difference, as argmax does
+        top = np.argsort(-scores, kind="stable")[:keep]
+        candidates = self.chords.candidates(pin)
+
+        branches = []
+        for k in top:
+            nextPin = int(candidates[k])
+            nextBlocked = blocked.copy()
+            nextPrevious = collections.deque(previous, maxlen=MIN_PREVIOUS_PINS)
+            if len(nextPrevious) == nextPrevious.maxlen:
+                nextBlocked[nextPrevious[0]] = False
+            nextPrevious.append(nextPin)
+            nextBlocked[nextPin] = True
+            branches.append((
+                total + float(scores[k]), int(k) if first is None else first, nextPin,
+                nextBlocked, nextPrevious, lines + [self.chords.pixels(pin, k)]
+            ))
+        return branches
+
+    def _expand(self, residual, branch):
+        total, first, pin, blocked, previous, lines = branch
+        if self.chord_scores is not None:
+            count = self.chords.candidate_count
+            rows = np.concatenate([self.chord_scores.crossings(pixels) for pixels in lines]) - pin * count
+            rows = rows[(rows >= 0) & (rows < count)]
+            scores = self.chord_scores.row(pin) - LINE_WIDTH * np.bincount(rows, minlength=count)
+        else:
+            mask = self._mask()
+            for pixels in lines:
+                # Fancy-index assignment counts a pixel once per line, like the residual update
+                mask[pixels] += 1
+            scores = self.chords.score(residual, pin) - LINE_WIDTH * self.chords.score(mask, pin)
+            for pixels in lines:
+                mask[pixels] = 0
+        scores[blocked[self.chords.candidates(pin)]] = -m.inf
+        return self._branches(scores, pin, total, first, blocked, previous, lines)
+
+    def choose(self, residual, pin, scores, blocked, previous):
+        """
+        Pick the candidate to draw from ``pin``.
+
+        Args:
+            residual (np.ndarray): Current residual, read only
+            pin (int): Pin the next line starts from
+            scores (np.ndarray): Score of every candidate from ``pin``, -inf when not allowed
+            blocked (np.ndarray): Pins that cannot be used, as kept by ``solve_lines``
+            previous (collections.deque): Recently used pins, as kept by ``solve_lines``
+
+        Returns:
+            int: Position of the chosen pin in ``chords.candidates(pin)``
+        """
+        greedyChoice = int(np.argmax(scores))
+        if self.beam_width == 1 or self.depth == 1 or \
+                (self.headroom is not None and self.seconds_per_line is not None
+                 and not self.headroom(self.seconds_per_line)):
+            self.greedy += 1
+            self.last_seconds = 0.0
+            return greedyChoice
+
+        start = time.perf_counter()
+        beam = self._branches(scores, pin, 0.0, None, blocked, previous, [])
+        for _ in range(self.depth - 1):
+            if self.executor is None:
+                expanded = [self._expand(residual, branch) for branch in beam]
+            else:
+                expanded = list(self.executor.map(lambda branch: self._expand(residual, branch), beam))
+            extended = [branch for branches in expanded for branch in branches]
+            if not extended:
+                break
+            # Stable, so equal totals keep the order of their parents
+            beam = sorted(extended, key=lambda branch: -branch[0])[:self.beam_width]
+
+        elapsed = time.perf_counter() - start
+        self.last_seconds = elapsed
+        self.seconds_per_line = elapsed if self.seconds_per_line is None else 0.9 * self.seconds_per_line + 0.1 * elapsed
+        self.searched += 1
+        return beam[0][1] if beam else greedyChoice
+
+# Safety factor on the measured greedy cost per line reserved by ``StoppingPolicy.has_headroom``,
+# which varies by a few percent from line to line
+GREEDY_COST_MARGIN = 1.25
+
+class StoppingPolicy:
+    """
+    Decide when consuming more lines from ``solve_lines`` stops paying off.
+
+    Stops after ``max_lines`` lines, once ``plateau_window`` consecutive lines
+    have all scored below ``min_gain``, or when ``deadline`` (a ``time.monotonic``
+    value) has passed. With ``min_gain`` None only the cap and the deadline apply.
+    Every line drawn so far is a valid sequence, so stopping at the deadline
+    returns the best result found in the time available. Each line drawn moves
+    the deadline ``finish_seconds_per_line`` earlier, the time it will take to
+    render and save.
+
+    The time between lines, minus what was spent searching, is tracked as the
+    cost of a greedy line, which ``has_headroom`` reserves for every line still
+    to draw.
+    """
+
+    def __init__(self, max_lines, min_gain=None, plateau_window=1, deadline=None, finish_seconds_per_line=0.0):
+        self.max_lines = max_lines
+        self.min_gain = min_gain
+        self.plateau_window = max(1, plateau_window)
+        self.deadline = deadline
+        self.finish_seconds_per_line = finish_seconds_per_line
+        self.lines = 0
+        self.low_gain_streak = 0
+        self.greedy_seconds_per_line = None
+        self._last_line_at = None
+
+    def should_stop(self, score, search_seconds=0.0):
+        """
+        Record the line just drawn and return True to stop.
+
+        Args:
+            score (float): Score of the line
+            search_seconds (float, optional): Part of the line's time spent in a ``Lookahead`` search
+        """
+        now = time.monotonic()
+        # The first line also pays for the setup, so timing starts from it
+        if self._last_line_at is not None:
+            elapsed = max(now - self._last_line_at - search_seconds, 0.0)
+            self.greedy_seconds_per_line = elapsed if self.greedy_seconds_per_line is None \
+                else 0.9 * self.greedy_seconds_per_line + 0.1 * elapsed
+        self._last_line_at = now
+
+        self.lines += 1
+        if self.min_gain is not None and score < self.min_gain:
+            self.low_gain_streak += 1
+        else:
+            self.low_gain_streak = 0
+        return self.lines >= self.max_lines or self.low_gain_streak >= self.plateau_window \
+            or (self.deadline is not None and now + self.lines * self.finish_seconds_per_line >= self.deadline)
+
+    def has_headroom(self, seconds_per_line):
+        """
+        True if one more search step of ``seconds_per_line`` still fits before the deadline.
+
+        The time left must also cover every remaining line at the greedy cost
+        and rendering all ``max_lines`` lines, so searching never costs lines.
+        """
+        if self.deadline is None:
+            return True
+        greedy = GREEDY_COST_MARGIN * (self.greedy_seconds_per_line or 0.0)
+        reserve = (self.max_lines - self.lines) * greedy \
+            + self.max_lines * self.finish_seconds_per_line
+        return self.deadline - time.monotonic() > reserve + seconds_per_line
+
+def solve_layer(chords, residual, lines, start_pin=0, coarse=None, top_k=16, min_gain=None,
+                plateau_window=1, progress_callback=None, deadline=None, beam_width=1, lookahead=1,
+                search_workers=1, stats=None, finish_seconds_per_line=0.0):
+    """
+    Draw up to ``lines`` lines on one residual and return the pins visited.
+
+    Args:
+        chords (ChordIndex): Chord geometry for the pin layout
+        residual (np.ndarray): Raveled float64 residual image, updated in place
+        lines (int): Maximum number of lines
+        progress_callback (callable, optional): Called as ``progress_callback(lines_done, lines)``
+        beam_width (int, optional): Paths kept by the ``Lookahead`` search. Defaults to 1 (greedy).
+        lookahead (int, optional): Lines searched ahead before committing one. Defaults to 1 (greedy).
+        search_workers (int, optional): Threads scoring the search branches. Defaults to 1.
+        stats (dict, optional): Filled with the number of ``searched`` and ``greedy`` lines when
+            the search is enabled.
+
+    The other arguments are those of ``solve_lines`` and ``StoppingPolicy``.
+
+    Returns:
+        list: Pins visited, starting with ``start_pin``
+    """
+    lineSequence = [start_pin]
+    if lines <= 0:
+        return lineSequence
+    stopping = StoppingPolicy(lines, min_gain=min_gain, plateau_window=plateau_window, deadline=deadline,
+                              finish_seconds_per_line=finish_seconds_per_line)
+    chordScores = ChordScores(chords, residual) if coarse is None else None
+    planner = None
+    if beam_width > 1 and lookahead > 1:
+        planner = Lookahead(chords, beam_width, lookahead, workers=search_workers, headroom=stopping.has_headroom,
+                            chord_scores=chordScores)
+
+    try:
+        for fromPin, toPin, score in solve_lines(chords, residual, start_pin=start_pin, coarse=coarse,
+                                                 top_k=top_k, planner=planner, chord_scores=chordScores):
+            lineSequence.append(toPin)
+
+            if progress_callback is not None:
+                progress_callback(len(lineSequence) - 1, lines)
+
+            if stopping.should_stop(score, search_seconds=planner.last_seconds if planner is not None else 0.0):
+                break
+    finally:
+        if planner is not None:
+            planner.close()
+            if stats is not None:
+                stats["searched"] = stats.get("searched", 0) + planner.searched
+                stats["greedy"] = stats.get("greedy", 0) + planner.greedy
+    return lineSequence
+
+def _geometry_plan(pins, pixel_width, search, coarse_factor):
+    """(compact, search, coarse_factor) actually used for a geometry, see ``layer_geometry``."""
+    if search not in ("exhaustive", "multires"):
+        raise ValueError(f"Unknown search mode: {search}")
+    if uses_compact_index(pins, pixel_width, MIN_DISTANCE):
+        return True, "multires", max(coarse_factor, -(-pixel_width // LARGE_COARSE_WIDTH))
+    return False, search, coarse_factor
+
+def layer_geometry(residual, pins, pixel_width, search="exhaustive", coarse_factor=4):
+    """
+    Chord index and coarse level to solve one residual with.
+
+    Geometries whose ``ChordIndex`` would exceed ``geometry.COMPACT_INDEX_BYTES``
+    (1000 pins at 2000 px needs about 5 GB) get a ``CompactChordIndex`` and the
+    "multires" search whatever ``search`` asks for, since the exhaustive search
+    keeps a score and an inverted index entry per chord pixel. Their coarse
+    residual is at most ``LARGE_COARSE_WIDTH`` wide, so a step decodes a few
+    hundred thousand pixels at most.
+
+    Args:
+        residual (np.ndarray): Raveled residual image
+        pins (int): Number of pins
+        pixel_width (int): Width of the square residual image
+        search (str, optional): "exhaustive" or "multires". Defaults to "exhaustive".
+        coarse_factor (int, optional): Downsampling factor for "multires". Defaults to 4.
+
+    Returns:
+        tuple: (chords, coarse); coarse is None for the exhaustive search
+    """
+    compact, search, coarse_factor = _geometry_plan(pins, pixel_width, search, coarse_factor)
+    if compact:
+        chords = get_compact_chord_index(pins, pixel_width, MIN_DISTANCE)
+    else:
+        chords = get_chord_index(pins, pixel_width, MIN_DISTANCE)
+    coarse = CoarseLevel(residual, pixel_width, pins, coarse_factor) if search == "multires" else None
+    return chords, coarse
+
+def prepare_geometry(pins, pixel_width, search="exhaustive", coarse_factor=4):
+    """Load or build what ``layer_geometry`` maps for these settings, e.g. before starting workers."""
+    compact, search, coarse_factor = _geometry_plan(pins, pixel_width, search, coarse_factor)
+    if compact:
+        get_compact_chord_index(pins, pixel_width, MIN_DISTANCE)
+    else:
+        get_chord_index(pins, pixel_width, MIN_DISTANCE)
+        if search == "exhaustive":
+            get_pixel_index(pins, pixel_width, MIN_DISTANCE)
+    if search == "multires":
+        get_geometry(pins, -(-pixel_width // coarse_factor), MIN_DISTANCE)
+
+def scratch_residual(size):
+    """
+    Zeroed float64 residual backed by an unlinked file in ``SCRATCH_DIR``.
+
+    Used for images that ``uses_compact_index``: the pages are file-backed, so
+    the kernel can write them out instead of the worker holding them all.
+    """
+    with tempfile.TemporaryFile(dir=SCRATCH_DIR) as f:
+        return np.memmap(f, dtype=np.float64, mode="w+", shape=(size,))
+
+def _solve_color_layer(residual, pins, pixel_width, lines, search, coarse_factor, **options):
+    """Solve one color layer in a worker; the chord index is memory-mapped, not sent."""
+    chords, coarse = layer_geometry(residual, pins, pixel_width, search, coarse_factor)
+    return solve_layer(chords, residual, lines, coarse=coarse, **options)
+
+# (workers, executor) of the pool shared by every multi-color image in this process
+_color_pool = (0, None)
+
+def color_executor(workers):
+    """Process pool for color layers, created once and reused by later images."""
+    global _color_pool
+    current_workers, executor = _color_pool
+    if executor is None or current_workers != workers:
+        if executor is not None:
+            executor.shutdown(wait=False)
+        # spawn, like the generation pool: forking a process that runs threads is unsafe
+        executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+        _color_pool = (workers, executor)
+    return executor
+
+def solve_color_layers(layers, pins, pixel_width, line_counts, workers=None, progress_callback=None, **options):
+    """
+    Solve every color layer, in parallel worker processes when there are several.
+
+    The parent builds and persists the chord geometry first (see ``prepare_geometry``),
+    so every worker maps the same files instead of rebuilding or receiving a copy.
+
+    Args:
+        layers (np.ndarray): ``(colors, pixels)`` residuals from ``palette.decompose``
+        pins (int): Number of pins
+        pixel_width (int): Width of the square residual images
+        line_counts (list): Lines to draw on each layer
+        workers (int, optional): Worker processes; defaults to ``COLOR_WORKERS`` or one per core
+        progress_callback (callable, optional): Called as ``progress_callback(lines_done, total_lines)``
+            each time a layer finishes
+        **options: ``search`` and ``coarse_factor``, plus the options of ``solve_layer``
+
+    Returns:
+        list: Pins visited by each color's thread
+    """
+    search, coarse_factor = options.pop("search"), options.pop("coarse_factor")
+    prepare_geometry(pins, pixel_width, search, coarse_factor)
+    args = [(layer, pins, pixel_width, count, search, coarse_factor) for layer, count in zip(layers, line_counts)]
+
+    busy = [i for i, count in enumerate(line_counts) if count > 0]
+    workers = min(workers or COLOR_WORKERS or os.cpu_count() or 1, len(busy))
+    sequences = [[0] for _ in layers]
+    total, done = sum(line_counts), 0
+
+    if workers <= 1:
+        for i in busy:
+            sequences[i] = _solve_color_layer(*args[i], **options)
+            done += len(sequences[i]) - 1
+            if progress_callback is not None:
+                progress_callback(done, total)
+        return sequences
+
+    executor = color_executor(workers)
+    futures = {executor.submit(_solve_color_layer, *args[i], **options): i for i in busy}
+    for future in as_completed(futures):
+        sequences[futures[future]] = future.result()
+        done += len(sequences[futures[future]]) - 1
+        if progress_callback is not None:
+            progress_callback(done, total)
+    return sequences
+
+def load_image(source, pixel_width, color=False):
+    """
+    Decode an image to grayscale, downscaling during decoding when possible.
+
+    The image header is read first and the largest reduction factor that still
+    leaves both sides at least ``pixel_width`` is used, so a large JPEG is never
+    fully decoded only to be thrown away by the resize that follows.
+
+    Args:
+        source (str | bytes | np.ndarray): Path, encoded image bytes or an already decoded image
+        pixel_width (int): Width the solver works at
+        color (bool, optional): Decode to BGR instead of grayscale. Defaults to False.
+
+    Returns:
+        np.ndarray: uint8 grayscale (or BGR) image owned by the caller
+    """
+    if isinstance(source, np.ndarray):
+        if color:
+            return cv2.cvtColor(source, cv2.COLOR_GRAY2BGR) if source.ndim == 2 else np.array(source, dtype=np.uint8)
+        if source.ndim == 3:
+            return cv2.cvtColor(source, cv2.COLOR_BGR2GRAY)
+        return np.array(source, dtype=np.uint8)
+
+    encoded = isinstance(source, (bytes, bytearray, memoryview))
+    flag = cv2.IMREAD_COLOR if color else cv2.IMREAD_GRAYSCALE
+    try:
+        # Only the header is parsed here; the pixels are decoded by OpenCV below
+        with Image.open(io.BytesIO(source) if encoded else source) as probe:
+            width, height = probe.size
+        for factor, reduced_flag in (REDUCED_COLOR_DECODE_FLAGS if color else REDUCED_DECODE_FLAGS):
+            if min(width, height) // factor >= pixel_width:
+                flag = reduced_flag
+                break
+    except (OSError, ValueError):
+        pass
+
+    if encoded:
+        img = cv2.imdecode(np.frombuffer(source, dtype=np.uint8), flag)
+    else:
+        img = cv2.imread(source, flag)
+    if img is None:
+        raise ValueError("Could not decode the input image")
+    return img
+
+def generate_thread_image(file_path, output_dir=None, pins=240, lines=3500, pixel_width=500,
+                          progress_callback=None, output_name=None, render=True, output_width=500,
+                          min_gain=None, plateau_window=1, search="exhaustive", coarse_factor=4, top_k=16,
+                          timings=None, palette=None, color_workers=None, deadline=None, beam_width=1,
+                          lookahead=1, search_workers=None):
     """
     Generate a thread-like representation of an input image.
     
     Args:
-        file_path (str): Path to the input image
-        output_dir (str, optional): Directory to save output files. Defaults to same directory as input.
+        file_path (str | bytes | np.ndarray): Path to the input image, its encoded bytes or a
+            decoded image. Bytes and arrays are never written to disk.
+        output_dir (str, optional): Directory to save output files. Defaults to same directory as input,
+            or the current directory when the input is not a path.
         pins (int, optional): Number of pins. Defaults to 240.
         lines (int, optional): Number of lines to draw. Defaults to 3500.
         pixel_width (int, optional): Size of resulting image. Defaults to 500.
+        progress_callback (callable, optional): Called as ``progress_callback(lines_done, total_lines)``
+            after every line. Defaults to None.
+        output_name (str, optional): Base name of the output files. Defaults to the input file name,
+            or "thread" when the input is not a path.
+        render (bool, optional): Render and save the output image. Defaults to True.
+        output_width (int, optional): Size of the rendered image. Defaults to 500.
+        min_gain (float, optional): Stop early once lines score below this residual sum.
+            Defaults to None, which always draws ``lines`` lines.
+        plateau_window (int, optional): Consecutive low-gain lines needed to stop early. Defaults to 1.
+        search (str, optional): "exhaustive" scores every candidate at full resolution.
+            "multires" shortlists ``top_k`` candidates on a residual downsampled by
+            ``coarse_factor`` and rescores only those at full resolution. Large geometries always
+            use "multires", see ``layer_geometry``. Defaults to "exhaustive".
+        coarse_factor (int, optional): Downsampling factor for "multires". Defaults to 4.
+        top_k (int, optional): Candidates rescored at full resolution for "multires". Defaults to 16.
+        timings (dict, optional): Filled with the seconds spent in each phase (decode, mask,
+            geometry, solve, render, encode), the number of lines drawn and, with the lookahead
+            search, the number of lines it chose. Defaults to None.
+        palette (str | list, optional): Thread colors for a multi-color image, as accepted by
+            ``palette.resolve_palette`` (e.g. "cmyk"). The ``lines`` are shared between the colors
+            and every color is solved in its own worker process. Defaults to None (black only).
+        color_workers (int, optional): Worker processes for the color layers. Defaults to
+            ``COLOR_WORKERS``, or one per core.
+        deadline (float, optional): Seconds the whole call may take. The solve stops early with the
+            lines drawn so far, leaving ``DEADLINE_RESERVE`` seconds plus ``FINISH_SECONDS_PER_LINE``
+            per line to render and save. Defaults to None (no time limit).
+        beam_width (int, optional): Paths kept by the lookahead search. Defaults to 1 (greedy).
+        lookahead (int, optional): Lines searched ahead before committing each one. Both this and
+            ``beam_width`` must be above 1 to search; under a ``deadline`` the search only runs
+            while it still fits. Defaults to 1 (greedy).
+        search_workers (int, optional): Threads scoring the search branches. Defaults to one per
+            core, or 1 per color layer since those already run in parallel.
     
     Returns:
-        tuple: (output_image_path, line_sequence_path)
+        tuple: (output_image_path, line_sequence_path); output_image_path is None when ``render`` is False.
+            The line sequence is saved in the packed format of ``sequence_format``; multi-color
+            sequences tag every pin with its color.
     """
+    # The deadline covers the whole call, so it starts before decoding
+    deadline_at = time.monotonic() + deadline - DEADLINE_RESERVE if deadline is not None else None
+    finishSeconds = FINISH_SECONDS_PER_LINE if render else 0.0
+
     # Validate and use passed parameters
     PIN_NO = max(10, min(pins, 1000))  # Constrain between 10 and 1000
     LINE_NO = max(100, min(lines, 10000))  # Constrain between 100 and 10000
     PIXEL_WIDTH = pixel_width
-    MIN_PREVIOUS_PINS = 20
-    LINE_WIDTH = 30
-    MIN_DISTANCE = 20
-    SCALE = 50
 
     # Log the actual values being used
     print(f"Generating thread image with: pins={PIN_NO}, lines={LINE_NO}")
 
+    is_path = isinstance(file_path, (str, os.PathLike))
+
     # Determine output directory
     if output_dir is None:
-        output_dir = os.path.dirname(file_path)
-    os.makedirs(output_dir, exist_ok=True)
+        output_dir = os.path.dirname(file_path) if is_path else '.'
+    os.makedirs(output_dir or '.', exist_ok=True)
 
     # Filename handling
-    file_name = os.path.splitext(os.path.basename(file_path))[0]
+    if output_name:
+        file_name = output_name
+    elif is_path:
+        file_name = os.path.splitext(os.path.basename(file_path))[0]
+    else:
+        file_name = "thread"
 
     # Read input image
-    img = cv2.imread(file_path, cv2.IMREAD_GRAYSCALE)
+    colors = resolve_palette(palette) if palette is not None else None
 
-    # Resize image if necessary
-    if img.shape[0] > pixel_width or img.shape[1] > pixel_width:
-        img = cv2.resize(img, (pixel_width, pixel_width), interpolation=cv2.INTER_AREA)
+    with phase_timer(timings, "decode"):
+        img = load_image(file_path, pixel_width, color=colors is not None)
+
+        # Resize image if necessary
+        if img.shape[0] > pixel_width or img.shape[1] > pixel_width:
+            img = cv2.resize(img, (pixel_width, pixel_width), interpolation=cv2.INTER_AREA)
 
     # Crop image
     def crop(image):
@@ -66,114 +761,131 @@ def generate_thread_image(file_path, output_dir=None, pins=240, lines=3500, pixe
         resized[mask] = 255
         return resized
 
-    # Calculating the coordinates of each pin
-    def pinCoordinates(PIN_NO, center, radius):
-        pinCoord = []
-        angleIncrement = 2 * m.pi / PIN_NO
-
-        for i in range(PIN_NO):
-            pinCoord.append((
-                m.floor(center[0] + radius * m.cos(i * angleIncrement)),
-                m.floor(center[1] + radius * m.sin(i * angleIncrement))
-            ))
-
-        return pinCoord
-
     # Dimensions and center
     dim = (PIXEL_WIDTH, PIXEL_WIDTH)
-    center = [PIXEL_WIDTH/2, PIXEL_WIDTH/2]
-    radius = PIXEL_WIDTH/2 - 1/2
-
-    # Mask the image to be circular
-    imgMasked = circularMask(PIXEL_WIDTH, img, center, radius)
-
-    # Defining the pin coordinates
-    pinCoord = pinCoordinates(PIN_NO, center, radius)
-
-    # Finding the coordinates between two points
-    lineY = [None] * PIN_NO * PIN_NO
-    lineX = [None] * PIN_NO * PIN_NO
-
-    for point1 in range(PIN_NO):
-        for point2 in range(point1 + MIN_DISTANCE, PIN_NO):
-            x0, y0 = pinCoord[point1]
-            x1, y1 = pinCoord[point2]
-
-            hypDistance = int(m.sqrt((x1-x0)**2 + (y1-y0)**2))
-
-            xCoords = np.linspace(x0, x1, hypDistance, dtype=int)
-            yCoords = np.linspace(y0, y1, hypDistance, dtype=int)
-
-            lineY[point2*PIN_NO + point1] = yCoords
-            lineY[point1*PIN_NO + point2] = yCoords
-            lineX[point2*PIN_NO + point1] = xCoords
-            lineX[point1*PIN_NO + point2] = xCoords
+    center, radius = pin_circle(PIXEL_WIDTH)
+
+    with phase_timer(timings, "mask"):
+        # Mask the image to be circular
+        imgMasked = circularMask(PIXEL_WIDTH, img, center, radius)
+
+    if colors is not None:
+        return _generate_color_image(imgMasked, colors, output_dir, file_name, PIN_NO, LINE_NO, PIXEL_WIDTH,
+                                     progress_callback, render, output_width, timings, color_workers,
+                                     search=search, coarse_factor=coarse_factor, top_k=top_k,
+                                     min_gain=min_gain, plateau_window=plateau_window, deadline=deadline_at,
+                                     finish_seconds_per_line=finishSeconds,
+                                     beam_width=beam_width, lookahead=lookahead, search_workers=search_workers or 1)
+
+    with phase_timer(timings, "mask"):
+        # Inverting the image for processing
+        if uses_compact_index(PIN_NO, PIXEL_WIDTH, MIN_DISTANCE):
+            residual = scratch_residual(imgMasked.size)
+            np.subtract(255.0, imgMasked.ravel(), out=residual)
+        else:
+            invertedImg = np.ones((imgMasked.shape)) * 255 - imgMasked.copy()
+            residual = invertedImg.ravel()
+
+    with phase_timer(timings, "geometry"):
+        # Pin coordinates and the pixels crossed by every candidate chord
+        chords, coarse = layer_geometry(residual, PIN_NO, PIXEL_WIDTH, search, coarse_factor)
+        pinCoord = chords.pin_coords
+
+    searchStats = {}
+    with phase_timer(timings, "solve"):
+        lineSequence = solve_layer(chords, residual, LINE_NO, coarse=coarse, top_k=top_k, min_gain=min_gain,
+                                   plateau_window=plateau_window, progress_callback=progress_callback,
+                                   deadline=deadline_at, finish_seconds_per_line=finishSeconds,
+                                   beam_width=beam_width, lookahead=lookahead,
+                                   search_workers=search_workers or os.cpu_count() or 1, stats=searchStats)
+
+    # Render output image
+    resultImg = None
+    if render:
+        with phase_timer(timings, "render"):
+            resultImg = render_sequence(lineSequence, pinCoord, PIXEL_WIDTH, output_width)
+
+    with phase_timer(timings, "encode"):
+        # Save output image
+        output_image_path = None
+        if resultImg is not None:
+            output_image_path = os.path.join(output_dir, f"{file_name}_output.png")
+            cv2.imwrite(output_image_path, resultImg)
+            # WebP and thumbnail variants served instead of the PNG when they suffice
+            write_variants(resultImg, output_image_path)
+
+        # Save line sequence
+        line_sequence_path = os.path.join(output_dir, f"{file_name}{SEQUENCE_EXTENSION}")
+        write_sequence(line_sequence_path, lineSequence, PIN_NO, SOLVER_VERSION)
+
+    if timings is not None:
+        timings["lines"] = len(lineSequence) - 1
+        if searchStats:
+            timings["searched_lines"] = searchStats["searched"]
 
-    # Inverting the image for processing
-    invertedImg = np.ones((imgMasked.shape)) * 255 - imgMasked.copy()
-
-    # Resultant image canvas
-    result = np.ones((imgMasked.shape[0] * SCALE, imgMasked.shape[1] * SCALE), np.uint8) * 255
-
-    lineSequence = []
-    currentPin = 0
-    previousPins = collections.deque(maxlen=MIN_PREVIOUS_PINS)
-
-    lineSequence.append(currentPin)
-
-    for _ in tqdm(range(LINE_NO), desc="Creating lines", unit='Lines'):
-        maxError = -m.inf
-        bestPin = -1
-        for difference in range(MIN_DISTANCE, PIN_NO-MIN_DISTANCE):
-            testPin = (currentPin + difference) % PIN_NO
-            if testPin in previousPins:
-                continue
-
-            xCoords = lineX[testPin*PIN_NO + currentPin]
-            yCoords = lineY[testPin*PIN_NO + currentPin]
-
-            lineError = np.sum(invertedImg[yCoords, xCoords])
-
-            if lineError > maxError:
-                maxError = lineError
-                bestPin = testPin
-
-        lineSequence.append(bestPin)
-
-        xCoords = lineX[bestPin * PIN_NO + currentPin]
-        yCoords = lineY[bestPin * PIN_NO + currentPin]
-
-        lineMask = np.zeros(imgMasked.shape, np.float64)
-        lineMask[yCoords, xCoords] = LINE_WIDTH
-        invertedImg = invertedImg - lineMask
-        invertedImg.clip(0, 255)
-
-        cv2.line(result, 
-                 (pinCoord[currentPin][0] * SCALE, pinCoord[currentPin][1] * SCALE),
-                 (pinCoord[bestPin][0] * SCALE, pinCoord[bestPin][1] * SCALE), 
-                 color=0, thickness=4, lineType=8)
-
-        previousPins.append(bestPin)
-        currentPin = bestPin
+    return output_image_path, line_sequence_path
 
-    # Resize output image
-    resultImg = cv2.resize(result, (500, 500), interpolation=cv2.INTER_AREA)
+def _generate_color_image(imgMasked, colors, output_dir, file_name, PIN_NO, LINE_NO, PIXEL_WIDTH,
+                          progress_callback, render, output_width, timings, workers, **options):
+    """Multi-color half of ``generate_thread_image``, from the masked BGR image on."""
+    with phase_timer(timings, "mask"):
+        # One darkness layer per thread color, sharing the lines by amount of ink
+        layers = decompose(cv2.cvtColor(imgMasked, cv2.COLOR_BGR2RGB), colors)
+        lineCounts = allocate_lines(LINE_NO, layers)
+
+    with phase_timer(timings, "geometry"):
+        prepare_geometry(PIN_NO, PIXEL_WIDTH, options["search"], options["coarse_factor"])
+        pinCoord = pin_coordinates(PIN_NO, *pin_circle(PIXEL_WIDTH))
+
+    with phase_timer(timings, "solve"):
+        sequences = solve_color_layers(layers, PIN_NO, PIXEL_WIDTH, lineCounts, workers=workers,
+                                       progress_callback=progress_callback, **options)
+
+    rgb = [color for _, color in colors]
+    resultImg = None
+    if render:
+        with phase_timer(timings, "render"):
+            resultImg = render_color_sequences(sequences, rgb, pinCoord, PIXEL_WIDTH, output_width)
+
+    with phase_timer(timings, "encode"):
+        output_image_path = None
+        if resultImg is not None:
+            output_image_path = os.path.join(output_dir, f"{file_name}_output.png")
+            cv2.imwrite(output_image_path, resultImg)
+            write_variants(resultImg, output_image_path)
+
+        # Layers interleaved into one build order, every pin tagged with its color
+        pins, pinColors = interleave(sequences)
+        line_sequence_path = os.path.join(output_dir, f"{file_name}{SEQUENCE_EXTENSION}")
+        write_sequence(line_sequence_path, pins, PIN_NO, SOLVER_VERSION, colors=pinColors, palette=rgb)
+
+    if timings is not None:
+        timings["lines"] = sum(len(sequence) - 1 for sequence in sequences)
 
-    # Save output image
-    output_image_path = os.path.join(output_dir, f"{file_name}_output.png")
-    cv2.imwrite(output_image_path, resultImg)
+    return output_image_path, line_sequence_path
 
-    # Save line sequence
-    line_sequence_path = os.path.join(output_dir, f"{file_name}.json")
-    with open(line_sequence_path, "w") as f:
-        json.dump(lineSequence, f)
+def warm_up(pins=240, pixel_width=500, coarse_factor=None):
+    """
+    Load the chord geometry used by ``generate_thread_image`` ahead of time.
 
-    return output_image_path, line_sequence_path
+    Args:
+        pins (int, optional): Number of pins. Defaults to 240.
+        pixel_width (int, optional): Size of resulting image. Defaults to 500.
+        coarse_factor (int, optional): Also load the coarse geometry of the "multires" search.
+    """
+    PIN_NO = max(10, min(pins, 1000))
+    prepare_geometry(PIN_NO, pixel_width)
+    if coarse_factor:
+        prepare_geometry(PIN_NO, pixel_width, "multires", coarse_factor)
 
 def main():
     # Example usage
     input_image = "img/tigre.jpg"
-    output_image, line_sequence = generate_thread_image(input_image)
+    with tqdm(total=3500, desc="Creating lines", unit='Lines') as progress:
+        output_image, line_sequence = generate_thread_image(
+            input_image,
+            progress_callback=lambda done, total: progress.update(done - progress.n)
+        )
     print(f"Output image saved as: {output_image}")
     print(f"Line sequence saved as: {line_sequence}")
 
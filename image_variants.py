@@ -0,0 +1,111 @@
+"""
+Smaller encodings of a rendered thread image, stored next to its PNG.
+
+For ``{name}_output.png`` the variants are::
+
+    {name}_output.webp   full size, lossy WebP
+    {name}_thumb.webp    THUMBNAIL_WIDTH wide, lossy WebP
+    {name}_thumb.png     THUMBNAIL_WIDTH wide, for clients without WebP
+
+The renders are anti-aliased grey lines on white, which WebP compresses to a
+fraction of the PNG at a quality where the threads still look sharp.
+"""
+import os
+
+import cv2
+
+# Width of the thumbnail; the viewer and landing page show it at 250 CSS px
+THUMBNAIL_WIDTH = 320
+
+# Lossy WebP quality (0-100) of each size
+WEBP_QUALITY = {"full": 80, "thumb": 60}
+
+IMAGE_SIZES = ("full", "thumb")
+IMAGE_FORMATS = ("png", "webp")
+MEDIA_TYPES = {"png": "image/png", "webp": "image/webp"}
+
+IMAGE_SUFFIX = "_output.png"
+VARIANT_SUFFIXES = {
+    ("full", "png"): IMAGE_SUFFIX,
+    ("full", "webp"): "_output.webp",
+    ("thumb", "webp"): "_thumb.webp",
+    ("thumb", "png"): "_thumb.png",
+}
+
+def variant_path(image_path, size="full", fmt="png"):
+    """
+    Path of one variant of ``image_path``.
+
+    Args:
+        image_path (str): The full-size PNG, named ``{name}_output.png``
+        size (str, optional): One of ``IMAGE_SIZES``. Defaults to "full".
+        fmt (str, optional): One of ``IMAGE_FORMATS``. Defaults to "png".
+
+    Returns:
+        str: The variant's path; ``image_path`` itself if it is not named like an output
+    """
+    if (size, fmt) not in VARIANT_SUFFIXES:
+        raise ValueError(f"Unknown image variant: {size}/{fmt}")
+    if not image_path.endswith(IMAGE_SUFFIX):
+        return image_path
+    return image_path[:-len(IMAGE_SUFFIX)] + VARIANT_SUFFIXES[size, fmt]
+
+def encode_variant(image, size, fmt):
+    """Encode a grayscale or BGR render as the given variant and return the bytes."""
+    if size == "thumb" and image.shape[1] > THUMBNAIL_WIDTH:
+        height = max(1, round(image.shape[0] * THUMBNAIL_WIDTH / image.shape[1]))
+        image = cv2.resize(image, (THUMBNAIL_WIDTH, height), interpolation=cv2.INTER_AREA)
+
+    if fmt == "webp":
+        ok, data = cv2.imencode(".webp", image, [cv2.IMWRITE_WEBP_QUALITY, WEBP_QUALITY[size]])
+    else:
+        ok, data = cv2.imencode(".png", image, [cv2.IMWRITE_PNG_COMPRESSION, 9])
+    if not ok:
+        raise ValueError(f"Could not encode {size}/{fmt} variant")
+    return data.tobytes()
+
+def write_variants(image, image_path):
+    """
+    Write every variant of a render except the full-size PNG itself.
+
+    Each file is written to a temporary name and renamed, so a request never
+    sees a partially written variant.
+
+    Args:
+        image (np.ndarray): The rendered image saved at ``image_path``
+        image_path (str): The full-size PNG, named ``{name}_output.png``
+
+    Returns:
+        list: Paths of the variants written
+    """
+    paths = []
+    for size, fmt in VARIANT_SUFFIXES:
+        path = variant_path(image_path, size, fmt)
+        if path == image_path:
+            continue
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(encode_variant(image, size, fmt))
+        os.replace(tmp_path, path)
+        paths.append(path)
+    return paths
+
+def ensure_variant(image_path, size="full", fmt="png"):
+    """
+    Path of a variant, creating the variants from the PNG if they are missing.
+
+    Outputs rendered before variants existed only have the PNG; they get their
+    variants the first time one is requested.
+
+    Returns:
+        str: The variant's path, or ``image_path`` if the PNG cannot be decoded
+    """
+    path = variant_path(image_path, size, fmt)
+    if os.path.exists(path):
+        return path
+
+    image = cv2.imread(image_path, cv2.IMREAD_UNCHANGED)
+    if image is None:
+        return image_path
+    write_variants(image, image_path)
+    return path
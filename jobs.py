@@ -0,0 +1,133 @@
+import json
+import os
+import re
+import time
+import uuid
+
+# Directorio donde se guarda el estado de cada trabajo de generación
+JOBS_DIR = os.getenv('HILOS_JOBS_DIR', os.path.join('thread_outputs', 'jobs'))
+
+# Tiempo que se conserva un trabajo terminado (segundos)
+JOB_TTL = int(os.getenv('HILOS_JOB_TTL', str(24 * 60 * 60)))
+
+# Intervalo mínimo entre barridos de trabajos vencidos (segundos)
+JOB_PRUNE_INTERVAL = max(JOB_TTL // 10, 1)
+
+# Intervalo mínimo entre escrituras de progreso desde el worker (segundos)
+PROGRESS_INTERVAL = 0.25
+
+JOB_ID_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+
+FINISHED_STATUSES = ('done', 'failed')
+
+class JobStore:
+    """
+    Estado de los trabajos de generación, un archivo JSON por trabajo.
+
+    Los archivos se reemplazan de forma atómica, así que el proceso que genera
+    la imagen puede reportar progreso mientras la API lo lee, y el estado
+    sobrevive a reconexiones del cliente y a reinicios del servidor.
+    """
+
+    def __init__(self, directory=JOBS_DIR, prune_interval=JOB_PRUNE_INTERVAL):
+        self.directory = directory
+        self.prune_interval = prune_interval
+        self._last_prune = None
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, job_id):
+        return os.path.join(self.directory, f"{job_id}.json")
+
+    def _write(self, job):
+        tmp_path = f"{self._path(job['id'])}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(job, f)
+        os.replace(tmp_path, self._path(job['id']))
+
+    def create(self, **fields):
+        now = time.time()
+        job = {
+            'id': uuid.uuid4().hex,
+            'status': 'queued',
+            'progress': 0.0,
+            'lines_done': 0,
+            'lines_total': None,
+            'created_at': now,
+            'updated_at': now,
+        }
+        job.update(fields)
+        self._write(job)
+        return job
+
+    def get(self, job_id):
+        if not JOB_ID_PATTERN.match(job_id):
+            return None
+        try:
+            with open(self._path(job_id), 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def update(self, job_id, **fields):
+        job = self.get(job_id)
+        if job is None:
+            return None
+        job.update(fields)
+        job['updated_at'] = time.time()
+        self._write(job)
+        return job
+
+    def prune(self, max_age=JOB_TTL):
+        """Eliminar trabajos terminados hace más de ``max_age`` segundos"""
+        cutoff = time.time() - max_age
+        self._last_prune = time.monotonic()
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if not entry.name.endswith('.json'):
+                    continue
+                # Otro worker puede borrar el mismo archivo mientras tanto; eso no debe fallar la solicitud
+                try:
+                    # Cada escritura reemplaza el archivo, así que uno reciente no puede estar vencido
+                    if entry.stat().st_mtime >= cutoff:
+                        continue
+                    job = self.get(entry.name[:-len('.json')])
+                    if job and job['status'] in FINISHED_STATUSES and job['updated_at'] < cutoff:
+                        os.remove(self._path(job['id']))
+                except FileNotFoundError:
+                    continue
+
+    def prune_if_due(self):
+        """Llamar a ``prune`` como mucho una vez cada ``prune_interval`` segundos"""
+        if self._last_prune is not None and time.monotonic() - self._last_prune < self.prune_interval:
+            return False
+        self.prune()
+        return True
+
+def generate_with_progress(jobs_dir, job_id, source, **kwargs):
+    """
+    Ejecutar ``generate_thread_image`` reportando el avance en el ``JobStore``.
+
+    Pensada para correr dentro del pool de generación: recibe el directorio en
+    lugar del store para que los argumentos se puedan serializar. ``source`` es
+    la ruta o los bytes de la imagen, como en ``generate_thread_image``.
+    """
+    from hilos import generate_thread_image
+
+    store = JobStore(jobs_dir)
+    store.update(job_id, status='running')
+    last_write = 0.0
+
+    def report(lines_done, lines_total):
+        nonlocal last_write
+        now = time.monotonic()
+        if now - last_write < PROGRESS_INTERVAL and lines_done < lines_total:
+            return
+        last_write = now
+        store.update(
+            job_id,
+            lines_done=lines_done,
+            lines_total=lines_total,
+            progress=round(lines_done / lines_total, 4)
+        )
+
+    return generate_thread_image(source, progress_callback=report, **kwargs)
@@ -0,0 +1,709 @@
+"""
+Load-test the purchase flow end to end against a local server.
+
+The app runs under uvicorn in a scratch directory with its own SQLite
+database, next to a fake Stripe API (checkout sessions) and an SMTP sink, so
+nothing leaves the machine. Virtual customers then loop over weighted
+scenarios until the time is up:
+
+    purchase   upload a photo, check out, pay (a signed webhook, as
+               stripe_stub.py sends it), register and open the viewer
+    viewer     reopen the viewer of an earlier purchase and step through it
+    preview    upload a photo and leave without buying
+
+Latency is measured per endpoint on the client and event-loop lag is read
+from the server's /metrics. The report is JSON and can be compared against a
+stored baseline to flag regressions.
+
+Examples:
+    python loadtest.py --customers 50 --duration 60 --output baseline.json
+    python loadtest.py --quick
+    python loadtest.py --env HILOS_GENERATION_WORKERS=2 --baseline baseline.json --output current.json
+"""
+import argparse
+import collections
+import json
+import os
+import platform
+import random
+import re
+import shutil
+import socket
+import socketserver
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import cv2
+
+from stripe_stub import checkout_session_event, replay
+
+SCENARIOS = ("purchase", "viewer", "preview")
+
+# Webhook secret shared by the app and the simulated Stripe payments
+WEBHOOK_SECRET = "whsec_loadtest"
+
+# Upload attempts per customer while the generation queue answers 503
+UPLOAD_ATTEMPTS = 5
+
+# Steps per page, as thread_viewer/script.js requests them
+VIEWER_STEPS_PAGE = 500
+
+JSON_HEADERS = {"Content-Type": "application/json"}
+
+# The browser's Accept for images, so the app negotiates WebP as it would for a real viewer
+IMAGE_HEADERS = {"Accept": "image/avif,image/webp,image/*,*/*;q=0.8"}
+
+class _StripeHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _not_found(self, message):
+        self._send(404, {"error": {"type": "invalid_request_error", "message": message}})
+
+    def do_POST(self):
+        fake = self.server.fake
+        time.sleep(fake.latency)
+        if self.path != "/v1/checkout/sessions":
+            return self._not_found(f"Unrecognized request URL (POST: {self.path})")
+
+        form = urllib.parse.parse_qs(self.rfile.read(int(self.headers.get("Content-Length", 0))).decode())
+        metadata = {key[len("metadata["):-1]: values[0] for key, values in form.items() if key.startswith("metadata[")}
+        self._send(200, fake.create(metadata))
+
+    def do_GET(self):
+        fake = self.server.fake
+        time.sleep(fake.latency)
+        match = re.fullmatch(r"/v1/checkout/sessions/([\w-]+)", self.path)
+        session = fake.get(match.group(1)) if match else None
+        if session is None:
+            return self._not_found(f"No such checkout.session: {self.path}")
+        self._send(200, session)
+
+class FakeStripe:
+    """
+    Just enough of the Stripe API for ``create_checkout_session`` and the session lookup.
+
+    Sessions are kept in memory and start unpaid; ``pay`` marks one as paid,
+    which is what a later retrieve returns. Every call sleeps ``latency``
+    seconds, like a round trip to Stripe.
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.sessions = {}
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), _StripeHandler)
+        self.server.daemon_threads = True
+        self.server.fake = self
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def create(self, metadata):
+        session_id = f"cs_test_{uuid.uuid4().hex}"
+        session = {
+            "id": session_id,
+            "object": "checkout.session",
+            "mode": "payment",
+            "url": f"{self.url}/pay/{session_id}",
+            "payment_intent": f"pi_{uuid.uuid4().hex}",
+            "payment_status": "unpaid",
+            "metadata": metadata,
+        }
+        with self._lock:
+            self.sessions[session_id] = session
+        return session
+
+    def get(self, session_id):
+        with self._lock:
+            session = self.sessions.get(session_id)
+            return dict(session) if session else None
+
+    def pay(self, session_id):
+        """Mark a session as paid and return it, or None if it does not exist."""
+        with self._lock:
+            session = self.sessions.get(session_id)
+            if session is not None:
+                session["payment_status"] = "paid"
+                return dict(session)
+        return None
+
+    @property
+    def paid(self):
+        with self._lock:
+            return sum(session["payment_status"] == "paid" for session in self.sessions.values())
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+class _SmtpHandler(socketserver.StreamRequestHandler):
+    def _reply(self, line):
+        self.wfile.write(f"{line}\r\n".encode())
+
+    def handle(self):
+        self._reply("220 localhost SMTP sink")
+        in_data = False
+        for raw in self.rfile:
+            line = raw.decode("utf-8", "replace").rstrip("\r\n")
+            if in_data:
+                if line == ".":
+                    in_data = False
+                    self.server.sink.received()
+                    self._reply("250 OK")
+                continue
+
+            command = line[:4].upper()
+            if command == "EHLO":
+                self.wfile.write(b"250-localhost\r\n250 SIZE 10485760\r\n")
+            elif command == "DATA":
+                in_data = True
+                self._reply("354 End data with <CR><LF>.<CR><LF>")
+            elif command == "QUIT":
+                self._reply("221 Bye")
+                return
+            else:
+                # HELO, MAIL, RCPT, RSET and NOOP are all accepted
+                self._reply("250 OK")
+
+class SmtpSink:
+    """SMTP server that accepts every message without TLS or login and only counts them."""
+
+    def __init__(self):
+        self.messages = 0
+        self._lock = threading.Lock()
+        self.server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), _SmtpHandler)
+        self.server.daemon_threads = True
+        self.server.sink = self
+        self.port = self.server.server_address[1]
+
+    def received(self):
+        with self._lock:
+            self.messages += 1
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def start_app(work_dir, stripe_url, smtp_port, extra_env=None, timeout=120):
+    """
+    Start the app with uvicorn in ``work_dir``, wired to the local Stripe and SMTP stand-ins.
+
+    Outputs and the database go to ``work_dir``; the chord geometry cache is
+    shared with the repository unless ``HILOS_GEOMETRY_DIR`` is set.
+
+    Returns:
+        tuple: (process, base URL)
+    """
+    repo = os.path.dirname(os.path.abspath(__file__))
+    for name in ("static", "thread_viewer"):
+        os.symlink(os.path.join(repo, name), os.path.join(work_dir, name))
+
+    port = free_port()
+    env = dict(os.environ)
+    # Without a username the outbox does not log in to the SMTP server
+    env.pop("EMAIL_USERNAME", None)
+    env.pop("EMAIL_PASSWORD", None)
+    env.setdefault("HILOS_GEOMETRY_DIR", os.path.join(repo, "geometry_cache"))
+    env.update({
+        "PYTHONPATH": os.pathsep.join(filter(None, (repo, env.get("PYTHONPATH")))),
+        "DATABASE_URL": f"sqlite:///{os.path.join(work_dir, 'loadtest.db')}",
+        "BASE_URL": f"http://127.0.0.1:{port}",
+        "STRIPE_API_BASE": stripe_url,
+        "STRIPE_SECRET_KEY": "sk_test_loadtest",
+        "STRIPE_WEBHOOK_SECRET": WEBHOOK_SECRET,
+        "EMAIL_HOST": "127.0.0.1",
+        "EMAIL_PORT": str(smtp_port),
+        "EMAIL_STARTTLS": "0",
+        "FROM_EMAIL_ADDRESS": "hilos@localhost",
+        "HILOS_EMAIL_POLL_INTERVAL": "1",
+        "HILOS_LOOP_LAG_INTERVAL": "0.05",
+        "HILOS_PROFILE_DIR": os.path.join(work_dir, "profiles"),
+    })
+    env.update(extra_env or {})
+
+    with open(os.path.join(work_dir, "app.log"), "wb") as log:
+        process = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "app:app", "--host", "127.0.0.1", "--port", str(port),
+             "--log-level", "warning"],
+            cwd=work_dir, env=env, stdout=log, stderr=subprocess.STDOUT,
+        )
+
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"The app exited with code {process.returncode}; see {work_dir}/app.log")
+        try:
+            urllib.request.urlopen(f"{base_url}/metrics", timeout=2).close()
+            return process, base_url
+        except OSError:
+            time.sleep(0.25)
+    process.terminate()
+    raise RuntimeError(f"The app did not start within {timeout} s; see {work_dir}/app.log")
+
+def stop_app(process, timeout=30):
+    process.terminate()
+    try:
+        process.wait(timeout)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+def customer_photos(count, size=800, seed=0):
+    """
+    Distinct JPEG photos for the customers to upload.
+
+    There are fewer photos than uploads, so some uploads repeat a photo and hit
+    the app's result cache, as a customer uploading the same picture again would.
+    """
+    rng = np.random.default_rng(seed)
+    photos = []
+    for _ in range(count):
+        image = np.full((size, size), rng.uniform(150, 240))
+        for _ in range(6):
+            center = tuple(int(v) for v in rng.integers(0, size, 2))
+            axes = tuple(int(v) for v in rng.integers(size // 10, size // 3, 2))
+            cv2.ellipse(image, center, axes, float(rng.uniform(0, 180)), 0, 360, float(rng.uniform(0, 200)), -1)
+        image = cv2.GaussianBlur(image, (0, 0), size / 100) + rng.normal(0, 8, image.shape)
+        ok, data = cv2.imencode(".jpg", np.clip(image, 0, 255).astype(np.uint8), [cv2.IMWRITE_JPEG_QUALITY, 90])
+        photos.append(data.tobytes())
+    return photos
+
+def multipart(field, filename, content, content_type):
+    """Body and headers of a multipart/form-data upload with a single file."""
+    boundary = uuid.uuid4().hex
+    head = (f'--{boundary}\r\nContent-Disposition: form-data; name="{field}"; filename="{filename}"\r\n'
+            f'Content-Type: {content_type}\r\n\r\n').encode()
+    return head + content + f"\r\n--{boundary}--\r\n".encode(), \
+        {"Content-Type": f"multipart/form-data; boundary={boundary}"}
+
+class Recorder:
+    """Latency and status samples by name, shared by every customer thread."""
+
+    def __init__(self):
+        self.samples = collections.defaultdict(list)
+        self._lock = threading.Lock()
+
+    def record(self, name, seconds, status):
+        with self._lock:
+            self.samples[name].append((seconds, status))
+
+class Client:
+    """Blocking HTTP client of one customer; every request is recorded under its endpoint name."""
+
+    def __init__(self, base_url, recorder, timeout=300):
+        self.base_url = base_url
+        self.recorder = recorder
+        self.timeout = timeout
+
+    def request(self, method, path, endpoint, body=None, headers=None):
+        """
+        Send one request and record its latency.
+
+        Returns:
+            tuple: (status, headers, body); status is 0 when the connection failed
+        """
+        request = urllib.request.Request(self.base_url + path, data=body, method=method, headers=headers or {})
+        start = time.perf_counter()
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                status, response_headers, data = response.status, response.headers, response.read()
+        except urllib.error.HTTPError as e:
+            status, response_headers, data = e.code, e.headers, e.read()
+        except OSError:
+            status, response_headers, data = 0, {}, b""
+        self.recorder.record(endpoint, time.perf_counter() - start, status)
+        return status, response_headers, data
+
+class Scenarios:
+    """
+    The customer journeys, run concurrently by ``run_load``.
+
+    Each method takes the customer's ``Client`` and ``random.Random`` and
+    returns True when the journey finished as a customer would expect.
+    """
+
+    def __init__(self, stripe, photos, recorder, viewer_steps=5, think_time=0.2):
+        self.stripe = stripe
+        self.photos = photos
+        self.recorder = recorder
+        self.viewer_steps = viewer_steps
+        self.think_time = think_time
+        self.links = []
+        self._lock = threading.Lock()
+
+    def _think(self, rng):
+        if self.think_time > 0:
+            time.sleep(rng.uniform(0.5, 1.5) * self.think_time)
+
+    def upload(self, client, rng):
+        """Upload a photo, waiting out 503s like the landing page retrying; returns the image filename."""
+        for _ in range(UPLOAD_ATTEMPTS):
+            body, headers = multipart("file", "photo.jpg", rng.choice(self.photos), "image/jpeg")
+            status, response_headers, _ = client.request(
+                "POST", "/generate-thread-image/", "POST /generate-thread-image/", body, headers)
+            if status == 503:
+                time.sleep(float(response_headers.get("Retry-After", 1)))
+                continue
+            match = re.search(r"filename=(\S+)", response_headers.get("content-disposition", "")) \
+                if status == 200 else None
+            return match.group(1) if match else None
+        return None
+
+    def pay(self, client, session_id):
+        """Pay a checkout session and deliver its signed webhook, as Stripe would."""
+        session = self.stripe.pay(session_id)
+        if session is None:
+            return False
+        event = checkout_session_event(
+            session_id, session["metadata"].get("filename", ""), session["metadata"].get("original_file", ""),
+            payment_intent=session["payment_intent"],
+        )
+        start = time.perf_counter()
+        status, _ = replay(f"{client.base_url}/stripe/webhook", event, WEBHOOK_SECRET, timeout=client.timeout)
+        self.recorder.record("POST /stripe/webhook", time.perf_counter() - start, status)
+        return status == 200
+
+    def purchase(self, client, rng):
+        filename = self.upload(client, rng)
+        if filename is None:
+            return False
+        self._think(rng)
+
+        checkout = {"imageData": {"filename": filename, "originalFile": "photo.jpg"}}
+        status, _, data = client.request("POST", "/create-checkout-session", "POST /create-checkout-session",
+                                         json.dumps(checkout).encode(), JSON_HEADERS)
+        if status != 200:
+            return False
+        session_id = json.loads(data)["checkout_url"].rsplit("/", 1)[-1]
+        if not self.pay(client, session_id):
+            return False
+
+        registration = {
+            "session_id": session_id,
+            "name": "Cliente de prueba",
+            "email": f"{uuid.uuid4().hex[:12]}@example.com",
+            "phone": "5555555555",
+            "address": "Calle 1, Ciudad",
+        }
+        status, _, data = client.request("POST", "/complete-registration", "POST /complete-registration",
+                                         json.dumps(registration).encode(), JSON_HEADERS)
+        if status != 200:
+            return False
+        link = json.loads(data)["viewer_url"].rsplit("/", 1)[-1]
+        with self._lock:
+            self.links.append(link)
+        return self.view(client, rng, link)
+
+    def view(self, client, rng, link=None):
+        """Open a viewer and step through it like thread_viewer/script.js, one snapshot per step."""
+        if link is None:
+            with self._lock:
+                link = rng.choice(self.links) if self.links else None
+            if link is None:
+                # Nothing has been bought yet, so this customer buys first
+                return self.purchase(client, rng)
+
+        status, _, _ = client.request("GET", f"/viewer/{link}", "GET /viewer/{unique_link}")
+        if status != 200:
+            return False
+        status, _, data = client.request("GET", f"/api/viewer/{link}?offset=0&limit={VIEWER_STEPS_PAGE}",
+                                         "GET /api/viewer/{unique_link}")
+        if status != 200:
+            return False
+        total_steps = json.loads(data)["total_steps"]
+        client.request("GET", f"/api/thread-image/{link}?size=thumb", "GET /api/thread-image/{unique_link}",
+                       headers=IMAGE_HEADERS)
+
+        # A returning customer resumes somewhere in the sequence
+        step = rng.randrange(max(total_steps - self.viewer_steps, 1))
+        pages = {0}
+        for _ in range(self.viewer_steps):
+            self._think(rng)
+            page = step // VIEWER_STEPS_PAGE
+            if page not in pages:
+                pages.add(page)
+                client.request("GET", f"/api/viewer/{link}/steps?offset={page * VIEWER_STEPS_PAGE}"
+                                      f"&limit={VIEWER_STEPS_PAGE}", "GET /api/viewer/{unique_link}/steps")
+            status, _, _ = client.request("GET", f"/api/viewer/{link}/snapshot?step={step + 1}",
+                                          "GET /api/viewer/{unique_link}/snapshot", headers=IMAGE_HEADERS)
+            if status != 200:
+                return False
+            step = min(step + 1, total_steps - 1)
+        return True
+
+    def preview(self, client, rng):
+        return self.upload(client, rng) is not None
+
+def run_load(base_url, scenarios, weights, customers, duration, ramp_up=0.0, seed=0):
+    """
+    Run ``customers`` concurrent customers for ``duration`` seconds.
+
+    Returns:
+        tuple: (elapsed seconds, Recorder of scenario durations)
+    """
+    names = [name for name in SCENARIOS if weights.get(name, 0) > 0]
+    journeys = Recorder()
+    start = time.monotonic()
+    stop_at = start + ramp_up + duration
+
+    def customer(index):
+        rng = random.Random(seed * 100003 + index)
+        client = Client(base_url, scenarios.recorder)
+        time.sleep(ramp_up * index / max(customers, 1))
+        while time.monotonic() < stop_at:
+            name = rng.choices(names, [weights[name] for name in names])[0]
+            journey_start = time.perf_counter()
+            try:
+                ok = getattr(scenarios, "view" if name == "viewer" else name)(client, rng)
+            except (ValueError, KeyError):
+                # An unexpected response body; the endpoint sample was already recorded
+                ok = False
+            journeys.record(name, time.perf_counter() - journey_start, 200 if ok else 0)
+
+    with ThreadPoolExecutor(max_workers=customers) as executor:
+        list(executor.map(customer, range(customers)))
+    return time.monotonic() - start, journeys
+
+def scrape_loop_lag(base_url):
+    """Cumulative event-loop lag histogram and maximum from the app's /metrics."""
+    with urllib.request.urlopen(f"{base_url}/metrics", timeout=10) as response:
+        text = response.read().decode()
+
+    buckets, total, count, maximum = {}, 0.0, 0.0, None
+    for line in text.splitlines():
+        name, _, value = line.rpartition(" ")
+        if name.startswith("hilos_event_loop_lag_seconds_bucket"):
+            buckets[float(re.search(r'le="([^"]+)"', name).group(1))] = float(value)
+        elif name == "hilos_event_loop_lag_seconds_sum":
+            total = float(value)
+        elif name == "hilos_event_loop_lag_seconds_count":
+            count = float(value)
+        elif name == "hilos_event_loop_lag_max_seconds":
+            maximum = float(value)
+    return {"buckets": sorted(buckets.items()), "sum": total, "count": count, "max": maximum}
+
+def histogram_quantile(q, buckets):
+    """Quantile of cumulative ``(upper_bound, count)`` buckets, interpolated within a bucket like Prometheus."""
+    if not buckets or buckets[-1][1] <= 0:
+        return None
+    rank = q * buckets[-1][1]
+    lower, below = 0.0, 0.0
+    for bound, cumulative in buckets:
+        if cumulative >= rank:
+            if bound == float("inf"):
+                return lower
+            return lower + (bound - lower) * (rank - below) / max(cumulative - below, 1e-12)
+        lower, below = bound, cumulative
+    return lower
+
+def loop_lag_report(before, after):
+    """Event-loop lag during the run, from two scrapes of the app's histogram."""
+    previous = dict(before["buckets"])
+    buckets = [(bound, count - previous.get(bound, 0.0)) for bound, count in after["buckets"]]
+    count = after["count"] - before["count"]
+    report = {"samples": int(count), "mean_ms": round(1000 * (after["sum"] - before["sum"]) / count, 2) if count else None}
+    for q in (0.5, 0.95, 0.99):
+        value = histogram_quantile(q, buckets)
+        report[f"p{round(q * 100)}_ms"] = round(1000 * value, 2) if value is not None else None
+    # The maximum since the app started; the app is fresh, so it is essentially the run's
+    report["max_ms"] = round(1000 * after["max"], 2) if after["max"] is not None else None
+    return report
+
+def summarize(samples, elapsed):
+    """Count, throughput, latency percentiles and status codes of one endpoint or scenario."""
+    seconds = np.array([sample for sample, _ in samples])
+    statuses = collections.Counter(str(status) for _, status in samples)
+    milliseconds = lambda value: round(1000 * float(value), 2)
+    return {
+        "count": len(samples),
+        "errors": sum(count for status, count in statuses.items() if status == "0" or int(status) >= 400),
+        "throughput_rps": round(len(samples) / elapsed, 3),
+        "mean_ms": milliseconds(seconds.mean()),
+        "p50_ms": milliseconds(np.percentile(seconds, 50)),
+        "p95_ms": milliseconds(np.percentile(seconds, 95)),
+        "p99_ms": milliseconds(np.percentile(seconds, 99)),
+        "max_ms": milliseconds(seconds.max()),
+        "statuses": dict(sorted(statuses.items())),
+    }
+
+def compare(current, baseline, threshold=0.2, min_ms=5.0):
+    """
+    Compare two load-test reports and list the metrics that got worse.
+
+    A latency counts as a regression when it grows by more than ``threshold``
+    and by more than ``min_ms``; throughput when it drops by more than ``threshold``.
+    """
+    regressions = []
+
+    def check(name, metric, value, reference, higher_is_worse=True):
+        if value is None or reference is None:
+            return
+        change = value - reference if higher_is_worse else reference - value
+        if change > max(abs(reference) * threshold, min_ms if higher_is_worse else 0):
+            regressions.append({
+                "name": name,
+                "metric": metric,
+                "baseline": reference,
+                "current": value,
+                "change": round(value / reference - 1, 3) if reference else None,
+            })
+
+    for endpoint, stats in current["endpoints"].items():
+        base = baseline["endpoints"].get(endpoint)
+        if base is None:
+            continue
+        for metric in ("p50_ms", "p95_ms", "p99_ms"):
+            check(endpoint, metric, stats[metric], base[metric])
+    check("total", "throughput_rps", current["throughput_rps"], baseline["throughput_rps"], higher_is_worse=False)
+    for metric in ("p95_ms", "p99_ms"):
+        check("event_loop_lag", metric, current["event_loop_lag"][metric], baseline["event_loop_lag"][metric])
+    return regressions
+
+def parse_weights(values):
+    weights = {name: 0.0 for name in SCENARIOS}
+    for value in values:
+        name, _, weight = value.partition("=")
+        if name not in weights:
+            raise argparse.ArgumentTypeError(f"Unknown scenario: {name}")
+        weights[name] = float(weight)
+    return weights
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Load-test the purchase flow with local Stripe and SMTP stand-ins.")
+    parser.add_argument("--customers", type=int, default=50, help="Concurrent virtual customers")
+    parser.add_argument("--duration", type=float, default=60, help="Seconds of traffic after the ramp-up")
+    parser.add_argument("--ramp-up", type=float, default=5, help="Seconds over which customers start")
+    parser.add_argument("--weights", nargs="+", default=["purchase=1", "viewer=3", "preview=1"],
+                        help="Relative frequency of each scenario, as name=weight")
+    parser.add_argument("--photos", type=int, default=10, help="Distinct photos uploaded; repeats hit the result cache")
+    parser.add_argument("--viewer-steps", type=int, default=5, help="Steps each viewer visit walks through")
+    parser.add_argument("--think-time", type=float, default=0.2, help="Mean seconds a customer waits between actions")
+    parser.add_argument("--stripe-latency", type=float, default=0.1, help="Seconds added to every fake Stripe call")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE",
+                        help="Extra environment for the app, e.g. HILOS_GENERATION_WORKERS=2")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--quick", action="store_true", help="5 customers for 15 seconds")
+    parser.add_argument("--keep-workdir", action="store_true", help="Keep the app's scratch directory and log")
+    parser.add_argument("--output", help="Write the JSON report to this file instead of stdout")
+    parser.add_argument("--baseline", help="Report to compare against; exits with 1 on regressions")
+    parser.add_argument("--threshold", type=float, default=0.2, help="Relative change that counts as a regression")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.quick:
+        args.customers, args.duration, args.ramp_up = 5, 15, 1
+    weights = parse_weights(args.weights)
+    extra_env = dict(value.split("=", 1) for value in args.env)
+
+    work_dir = tempfile.mkdtemp(prefix="hilos_loadtest_")
+    stripe = FakeStripe(latency=args.stripe_latency)
+    smtp = SmtpSink()
+    stripe.start()
+    smtp.start()
+    process = None
+    try:
+        process, base_url = start_app(work_dir, stripe.url, smtp.port, extra_env)
+        print(f"App running at {base_url}; {args.customers} customers for {args.duration} s", file=sys.stderr)
+
+        recorder = Recorder()
+        scenarios = Scenarios(stripe, customer_photos(args.photos, seed=args.seed), recorder,
+                              viewer_steps=args.viewer_steps, think_time=args.think_time)
+        lag_before = scrape_loop_lag(base_url)
+        elapsed, journeys = run_load(base_url, scenarios, weights, args.customers, args.duration,
+                                     ramp_up=args.ramp_up, seed=args.seed)
+        lag_after = scrape_loop_lag(base_url)
+
+        # Give the outbox a moment to deliver the last confirmations
+        purchases = len(scenarios.links)
+        wait_until = time.monotonic() + 10
+        while smtp.messages < purchases and time.monotonic() < wait_until:
+            time.sleep(0.25)
+
+        total = sum(len(samples) for samples in recorder.samples.values())
+        report = {
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "machine": {
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "cpus": os.cpu_count(),
+            },
+            "config": {
+                "customers": args.customers,
+                "duration": args.duration,
+                "ramp_up": args.ramp_up,
+                "weights": weights,
+                "photos": args.photos,
+                "viewer_steps": args.viewer_steps,
+                "think_time": args.think_time,
+                "stripe_latency": args.stripe_latency,
+                "env": extra_env,
+            },
+            "elapsed_seconds": round(elapsed, 2),
+            "requests": total,
+            "errors": sum(summarize(samples, elapsed)["errors"] for samples in recorder.samples.values()),
+            "throughput_rps": round(total / elapsed, 3),
+            "endpoints": {name: summarize(samples, elapsed) for name, samples in sorted(recorder.samples.items())},
+            "scenarios": {name: summarize(samples, elapsed) for name, samples in sorted(journeys.samples.items())},
+            "event_loop_lag": loop_lag_report(lag_before, lag_after),
+            "purchases": purchases,
+            "stripe_sessions_paid": stripe.paid,
+            "emails_delivered": smtp.messages,
+        }
+    finally:
+        if process is not None:
+            stop_app(process)
+        stripe.stop()
+        smtp.stop()
+        if args.keep_workdir:
+            print(f"Work directory kept at {work_dir}", file=sys.stderr)
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    exit_code = 0
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            report["regressions"] = compare(report, json.load(f), threshold=args.threshold)
+        for regression in report["regressions"]:
+            print(f"REGRESSION {regression['name']} {regression['metric']}: "
+                  f"{regression['baseline']} -> {regression['current']}", file=sys.stderr)
+        exit_code = 1 if report["regressions"] else 0
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    return exit_code
+
+if __name__ == "__main__":
+    sys.exit(main())
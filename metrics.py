@@ -0,0 +1,309 @@
+import asyncio
+import bisect
+import contextlib
+import cProfile
+import os
+import threading
+import time
+
+# Directorio donde se guardan los perfiles muestreados con cProfile
+PROFILE_DIR = os.getenv('HILOS_PROFILE_DIR', 'profiles')
+
+# Perfiles que se conservan antes de borrar los más viejos
+PROFILE_KEEP = int(os.getenv('HILOS_PROFILE_KEEP', '50'))
+
+# Fases de generate_thread_image que se miden en segundos
+GENERATION_PHASES = ('decode', 'mask', 'geometry', 'solve', 'render', 'encode')
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Segundos entre mediciones del retraso del event loop
+LOOP_LAG_INTERVAL = float(os.getenv('HILOS_LOOP_LAG_INTERVAL', '0.5'))
+LOOP_LAG_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in labels.values())
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + '}'
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} espera las etiquetas {self.labelnames}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _samples(self):
+        raise NotImplementedError
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, labels, value in self._samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(labels)} {value}")
+        return '\n'.join(lines)
+
+class Counter(_Metric):
+    """Contador incrementado a mano o leído de ``function`` en cada scrape"""
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=(), function=None):
+        super().__init__(name, documentation, labelnames)
+        self.function = function
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self):
+        if self.function is not None:
+            return [('', {}, self.function())]
+        with self._lock:
+            items = list(self._values.items())
+        return [('', dict(zip(self.labelnames, key)), value) for key, value in items]
+
+class Gauge(_Metric):
+    """Gauge con valor fijado a mano o leído de ``function`` en cada scrape"""
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), function=None):
+        super().__init__(name, documentation, labelnames)
+        self.function = function
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def _samples(self):
+        if self.function is not None:
+            return [('', {}, self.function())]
+        with self._lock:
+            items = list(self._values.items())
+        return [('', dict(zip(self.labelnames, key)), value) for key, value in items]
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _samples(self):
+        with self._lock:
+            items = [(key, (list(counts), total)) for key, (counts, total) in self._values.items()]
+        samples = []
+        for key, (counts, total) in items:
+            labels = dict(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(float(bound))
+                samples.append(('_bucket', dict(labels, le=le), cumulative))
+            samples.append(('_sum', labels, total))
+            samples.append(('_count', labels, cumulative))
+        return samples
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Todas las métricas en el formato de texto de Prometheus"""
+        return '\n'.join(metric.render() for metric in self._metrics) + '\n'
+
+REGISTRY = Registry()
+
+REQUEST_SECONDS = REGISTRY.register(Histogram(
+    'hilos_http_request_duration_seconds', 'Latencia de las solicitudes HTTP por ruta',
+    ('method', 'route', 'status')))
+REQUESTS_IN_FLIGHT = REGISTRY.register(Gauge(
+    'hilos_http_requests_in_flight', 'Solicitudes HTTP en curso'))
+GENERATION_PHASE_SECONDS = REGISTRY.register(Histogram(
+    'hilos_generation_phase_seconds', 'Tiempo de cada fase de generate_thread_image', ('phase',)))
+GENERATION_LINES = REGISTRY.register(Counter(
+    'hilos_generation_lines_total', 'Líneas trazadas por el generador'))
+GENERATION_SEARCHED_LINES = REGISTRY.register(Counter(
+    'hilos_generation_searched_lines_total', 'Líneas elegidas con la búsqueda con anticipación'))
+GENERATIONS = REGISTRY.register(Counter(
+    'hilos_generations_total', 'Generaciones terminadas por resultado', ('outcome',)))
+OUTBOUND_SECONDS = REGISTRY.register(Histogram(
+    'hilos_outbound_call_duration_seconds', 'Latencia de las llamadas a servicios externos',
+    ('service', 'operation', 'outcome')))
+EMAILS = REGISTRY.register(Counter(
+    'hilos_emails_total', 'Correos del outbox por resultado (sent, retry, failed)', ('outcome',)))
+EVENT_LOOP_LAG = REGISTRY.register(Histogram(
+    'hilos_event_loop_lag_seconds', 'Retraso del event loop al despertar de un sleep', buckets=LOOP_LAG_BUCKETS))
+
+@contextlib.contextmanager
+def observe_call(service, operation):
+    """Medir una llamada saliente (Stripe, SMTP) distinguiendo éxito y error"""
+    start = time.perf_counter()
+    outcome = 'error'
+    try:
+        yield
+        outcome = 'ok'
+    finally:
+        OUTBOUND_SECONDS.observe(time.perf_counter() - start, service=service, operation=operation, outcome=outcome)
+
+def record_generation(timings):
+    """Registrar las fases reportadas por ``generate_thread_image(timings=...)``"""
+    for phase in GENERATION_PHASES:
+        if phase in timings:
+            GENERATION_PHASE_SECONDS.observe(timings[phase], phase=phase)
+    # Los conteos viajan en el mismo dict pero no son duraciones
+    GENERATION_LINES.inc(timings.get('lines', 0))
+    GENERATION_SEARCHED_LINES.inc(timings.get('searched_lines', 0))
+    GENERATIONS.inc(outcome='ok')
+
+class LoopLagMonitor:
+    """
+    Mide cada ``interval`` segundos cuánto tarda el event loop en despertar de más.
+
+    Una corrutina duerme ``interval`` y registra en ``EVENT_LOOP_LAG`` el tiempo
+    extra que pasó hasta volver a correr: es lo que espera cualquier solicitud
+    cuando algo bloquea el loop.
+    """
+
+    def __init__(self, interval=LOOP_LAG_INTERVAL):
+        self.interval = interval
+        self.max_lag = 0.0
+        self._task = None
+
+    async def _run(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            lag = max(time.perf_counter() - start - self.interval, 0.0)
+            self.max_lag = max(self.max_lag, lag)
+            EVENT_LOOP_LAG.observe(lag)
+
+    def start(self):
+        if self.interval > 0:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+class Profiler:
+    """
+    Muestreo de perfiles con cProfile que se puede ajustar en caliente.
+
+    ``sample_rate`` es la fracción de solicitudes perfiladas (0 lo desactiva).
+    cProfile mide todo el hilo del event loop, no una corrutina, así que se
+    perfila una sola solicitud a la vez: mientras hay una activa no se muestrea
+    otra, y el perfil incluye lo que el loop ejecute en paralelo.
+    """
+
+    def __init__(self, directory=PROFILE_DIR, keep=PROFILE_KEEP):
+        self.directory = directory
+        self.keep = keep
+        self.sample_rate = 0.0
+        self._counter = 0.0
+        self._active = threading.Lock()
+
+    def should_sample(self):
+        """Muestreo determinista: exactamente ``sample_rate`` de las solicitudes"""
+        if self.sample_rate <= 0 or self._active.locked():
+            return False
+        self._counter += self.sample_rate
+        if self._counter >= 1:
+            self._counter -= 1
+            return True
+        return False
+
+    def new_path(self, name):
+        os.makedirs(self.directory, exist_ok=True)
+        safe_name = ''.join(c if c.isalnum() else '_' for c in name).strip('_') or 'request'
+        return os.path.join(self.directory, f"{time.strftime('%Y%m%d-%H%M%S')}_{os.getpid()}_{safe_name}.prof")
+
+    def prune(self):
+        if not os.path.isdir(self.directory):
+            return
+        paths = sorted(
+            (os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.endswith('.prof')),
+            key=os.path.getmtime
+        )
+        for path in paths[:-self.keep] if self.keep else paths:
+            os.remove(path)
+
+    @contextlib.contextmanager
+    def profile(self, path):
+        """Perfilar el bloque en ``path``; si ya hay otro perfil activo, ejecutarlo sin perfilar"""
+        if not self._active.acquire(blocking=False):
+            yield
+            return
+        try:
+            profiler = cProfile.Profile()
+            profiler.enable()
+            try:
+                yield
+            finally:
+                profiler.disable()
+                profiler.dump_stats(path)
+                self.prune()
+        finally:
+            self._active.release()
+
+def run_instrumented(fn, args, kwargs, profile_path=None):
+    """
+    Ejecutar ``fn`` en un worker del pool midiendo sus fases.
+
+    ``fn`` debe aceptar ``timings`` como ``generate_thread_image``. Si se indica
+    ``profile_path`` se guarda ahí un perfil de cProfile de la ejecución.
+
+    Returns:
+        tuple: (resultado de ``fn``, timings)
+    """
+    timings = {}
+    kwargs = dict(kwargs, timings=timings)
+    if profile_path is None:
+        return fn(*args, **kwargs), timings
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        result = fn(*args, **kwargs)
+    finally:
+        profiler.disable()
+        os.makedirs(os.path.dirname(profile_path) or '.', exist_ok=True)
+        profiler.dump_stats(profile_path)
+    return result, timings
@@ -1,6 +1,6 @@
 from datetime import datetime
 import uuid
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Boolean
+from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Boolean, Text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 
@@ -23,9 +23,39 @@ class Purchase(Base):
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"))
     unique_link = Column(String, unique=True, index=True, default=lambda: str(uuid.uuid4()))
-    image_path = Column(String, nullable=False)
+    image_path = Column(String, nullable=False, index=True)
     json_path = Column(String, nullable=False)
     payment_intent_id = Column(String)
     created_at = Column(DateTime, default=datetime.utcnow)
     is_active = Column(Boolean, default=True)
-    user = relationship("User", back_populates="purchases")
\ No newline at end of file
+    user = relationship("User", back_populates="purchases")
+
+class CheckoutPayment(Base):
+    __tablename__ = "checkout_payments"
+
+    id = Column(Integer, primary_key=True, index=True)
+    # La sesión de Stripe es la clave de idempotencia: una compra por sesión pagada
+    session_id = Column(String, unique=True, nullable=False, index=True)
+    payment_intent_id = Column(String, index=True)
+    payment_status = Column(String, nullable=False)
+    filename = Column(String)
+    original_file = Column(String)
+    purchase_id = Column(Integer, ForeignKey("purchases.id"), unique=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class OutboundEmail(Base):
+    __tablename__ = "outbound_emails"
+
+    id = Column(Integer, primary_key=True, index=True)
+    to_address = Column(String, nullable=False)
+    subject = Column(String, nullable=False)
+    html = Column(Text, nullable=False)
+    # pending, sending, sent o failed
+    status = Column(String, nullable=False, default="pending", index=True)
+    attempts = Column(Integer, nullable=False, default=0)
+    # Próximo intento; mientras se envía, también es el fin del lease del worker
+    next_attempt_at = Column(DateTime, nullable=False, default=datetime.utcnow, index=True)
+    last_error = Column(String)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    sent_at = Column(DateTime)
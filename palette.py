@@ -0,0 +1,139 @@
+"""
+Thread palettes for the multi-color mode of ``generate_thread_image``.
+
+A colored thread on white paper absorbs part of the light in each channel, so
+an image is split into one darkness layer per thread color and every layer is
+solved like a grayscale image. The layers are then interleaved into a single
+build order in which every step is tagged with the color to use.
+"""
+import numpy as np
+
+# Thread colors as RGB, from the lightest to the darkest; later layers end up on top
+PALETTES = {
+    "cmyk": (("cyan", (0, 174, 239)), ("magenta", (236, 0, 140)), ("yellow", (255, 242, 0)), ("black", (0, 0, 0))),
+    "cmy": (("cyan", (0, 174, 239)), ("magenta", (236, 0, 140)), ("yellow", (255, 242, 0))),
+    "rgbk": (("red", (220, 20, 30)), ("green", (0, 140, 70)), ("blue", (20, 60, 200)), ("black", (0, 0, 0))),
+}
+
+# Lines of one color laid before switching to the next spool
+COLOR_CHUNK_LINES = 50
+
+# Projected gradient iterations used to split chromatic colors
+DECOMPOSE_ITERATIONS = 60
+
+def resolve_palette(palette):
+    """
+    Normalise a palette name or a list of colors.
+
+    Args:
+        palette (str | list): A key of ``PALETTES``, or ``(name, (r, g, b))`` pairs or bare ``(r, g, b)`` tuples
+
+    Returns:
+        list: ``(name, (r, g, b))`` pairs
+    """
+    if isinstance(palette, str):
+        if palette not in PALETTES:
+            raise ValueError(f"Unknown palette: {palette}")
+        return list(PALETTES[palette])
+
+    colors = []
+    for entry in palette:
+        if len(entry) == 2:
+            name, rgb = entry
+        else:
+            rgb = tuple(entry)
+            name = "#%02x%02x%02x" % rgb
+        if len(rgb) != 3 or not all(0 <= channel <= 255 for channel in rgb):
+            raise ValueError(f"Invalid thread color: {entry}")
+        colors.append((name, tuple(int(channel) for channel in rgb)))
+    if not colors or len(colors) > 255:
+        raise ValueError("A palette needs between 1 and 255 colors")
+    return colors
+
+def decompose(image_rgb, colors, iterations=DECOMPOSE_ITERATIONS):
+    """
+    Split an RGB image into one darkness layer per thread color.
+
+    Each pixel's absorbance ``255 - rgb`` is approximated as a non-negative mix
+    of the colors' absorbances. Neutral colors (greys and black) take the grey
+    component shared by all channels first, as in printing, and the remainder
+    is fitted to the chromatic colors by projected gradient descent.
+
+    Args:
+        image_rgb (np.ndarray): ``(height, width, 3)`` uint8 RGB image
+        colors (list): ``(name, (r, g, b))`` pairs from ``resolve_palette``
+        iterations (int, optional): Gradient steps for the chromatic fit
+
+    Returns:
+        np.ndarray: float64 ``(len(colors), height * width)`` layers in the 0-255
+            range of the grayscale solver's inverted image
+    """
+    target = 255.0 - image_rgb.reshape(-1, 3).astype(np.float64)
+    absorbance = np.array([[255.0 - channel for channel in rgb] for _, rgb in colors])
+    weights = np.zeros((len(target), len(colors)))
+
+    neutral = [i for i, row in enumerate(absorbance) if row.max() > 0 and np.ptp(row) == 0]
+    for i in neutral:
+        weights[:, i] = np.clip(target.min(axis=1) / absorbance[i, 0], 0.0, 1.0)
+        target -= weights[:, i:i + 1] * absorbance[i]
+
+    chromatic = [i for i in range(len(colors)) if i not in neutral and absorbance[i].max() > 0]
+    if chromatic:
+        basis = absorbance[chromatic]
+        step = 1.0 / np.linalg.eigvalsh(basis @ basis.T).max()
+        mix = np.zeros((len(target), len(chromatic)))
+        for _ in range(iterations):
+            mix -= step * ((mix @ basis - target) @ basis.T)
+            np.clip(mix, 0.0, 1.0, out=mix)
+        weights[:, chromatic] = mix
+
+    return 255.0 * weights.T
+
+def allocate_lines(total_lines, layers):
+    """Split ``total_lines`` across layers in proportion to their ink (largest remainder)."""
+    ink = np.maximum(layers, 0).sum(axis=1)
+    if ink.sum() == 0:
+        return [0] * len(layers)
+    shares = total_lines * ink / ink.sum()
+    counts = np.floor(shares).astype(int)
+    for i in np.argsort(counts - shares)[:total_lines - counts.sum()]:
+        counts[i] += 1
+    return counts.tolist()
+
+def interleave(sequences, chunk_lines=COLOR_CHUNK_LINES):
+    """
+    Merge per-color sequences into one build order tagged with colors.
+
+    Every color is laid in chunks of ``chunk_lines`` lines, and chunks are
+    ordered by how far through its own sequence each one starts, so all the
+    colors progress together. Ties keep palette order.
+
+    Args:
+        sequences (list): Per-color lists of pins, each starting at its start pin
+        chunk_lines (int, optional): Lines laid before switching color
+
+    Returns:
+        tuple: (pins, colors) as uint16 and uint8 arrays. The first entry of each
+            color is where its thread starts; every later entry draws a line from
+            the previous pin of the same color.
+    """
+    chunks = []
+    for color, sequence in enumerate(sequences):
+        lines = len(sequence) - 1
+        if lines <= 0:
+            continue
+        for start in range(0, lines, chunk_lines):
+            # The first chunk also carries the start pin
+            first = 0 if start == 0 else start + 1
+            chunks.append((start / lines, color, sequence[first:start + chunk_lines + 1]))
+
+    chunks.sort(key=lambda chunk: (chunk[0], chunk[1]))
+    pins = [pin for _, _, segment in chunks for pin in segment]
+    colors = [color for _, color, segment in chunks for _ in segment]
+    return np.asarray(pins, dtype=np.uint16), np.asarray(colors, dtype=np.uint8)
+
+def split(pins, colors, color_count):
+    """Per-color pin lists of an interleaved sequence, the inverse of ``interleave``."""
+    pins = np.asarray(pins)
+    colors = np.asarray(colors)
+    return [pins[colors == color].tolist() for color in range(color_count)]
@@ -0,0 +1,141 @@
+import numpy as np
+
+# Width of one thread in solver pixels. The old 50x supersampled canvas drew
+# threads 4 px thick, which rasterise to about 5 canvas px, i.e. 0.1 solver px.
+THREAD_WIDTH = 0.1
+
+# Sub-pixel samples taken along each line per output pixel of length
+SAMPLES_PER_PIXEL = 2
+
+# Upper bound on samples processed at once; this is what bounds render memory
+BATCH_SAMPLES = 1 << 17
+
+def accumulate_lines(density, start_points, end_points, thread_width, batch_samples=BATCH_SAMPLES):
+    """
+    Add the anti-aliased coverage of straight lines to a density image in place.
+
+    Each line is sampled every ``1 / SAMPLES_PER_PIXEL`` pixels and every sample
+    splats ``thread_width * step`` of coverage onto its four neighbouring pixels,
+    so the total added per pixel is the area of thread crossing it.
+
+    Args:
+        density (np.ndarray): float32 ``(height, width)`` accumulator
+        start_points (np.ndarray): ``(n, 2)`` line starts as ``(x, y)`` output pixels
+        end_points (np.ndarray): ``(n, 2)`` line ends as ``(x, y)`` output pixels
+        thread_width (float): Thread width in output pixels
+        batch_samples (int, optional): Maximum samples held in memory at once
+    """
+    height, width = density.shape
+    start_points = np.asarray(start_points, dtype=np.float64).reshape(-1, 2)
+    end_points = np.asarray(end_points, dtype=np.float64).reshape(-1, 2)
+    if len(start_points) == 0:
+        return density
+
+    lengths = np.hypot(*(end_points - start_points).T)
+    counts = np.ceil(lengths * SAMPLES_PER_PIXEL).astype(np.int64) + 1
+
+    # Padded by one pixel so the right/bottom taps never need clipping
+    padded = np.zeros((height + 1) * (width + 1), dtype=np.float64)
+
+    first = 0
+    while first < len(counts):
+        # Take as many whole lines as fit in the sample budget (at least one)
+        budget = np.cumsum(counts[first:])
+        last = first + max(int(np.searchsorted(budget, batch_samples, side='right')), 1)
+
+        batch_counts = counts[first:last]
+        line = np.repeat(np.arange(first, last), batch_counts)
+        offsets = np.cumsum(batch_counts) - batch_counts
+        t = (np.arange(batch_counts.sum()) - np.repeat(offsets, batch_counts) + 0.5) / counts[line]
+
+        points = start_points[line] + (end_points - start_points)[line] * t[:, None]
+        weights = thread_width * lengths[line] / counts[line]
+
+        x = np.clip(points[:, 0], 0, width - 1)
+        y = np.clip(points[:, 1], 0, height - 1)
+        x0 = np.floor(x).astype(np.int64)
+        y0 = np.floor(y).astype(np.int64)
+        fx = x - x0
+        fy = y - y0
+
+        base = y0 * (width + 1) + x0
+        for shift, tap in (
+            (0, (1 - fx) * (1 - fy)),
+            (1, fx * (1 - fy)),
+            (width + 1, (1 - fx) * fy),
+            (width + 2, fx * fy),
+        ):
+            padded += np.bincount(base + shift, weights=weights * tap, minlength=len(padded))
+
+        first = last
+
+    density += padded.reshape(height + 1, width + 1)[:height, :width].astype(density.dtype)
+    return density
+
+def density_to_image(density):
+    """Convert accumulated thread coverage into a white-background uint8 image."""
+    # Overlapping threads cover a pixel multiplicatively, like stacked translucent strands
+    return np.round(255 * np.exp(-density)).astype(np.uint8)
+
+def pin_points(pin_coords, scale):
+    """``(x, y)`` of every pin in output pixels, as the lines are drawn between them."""
+    return np.asarray(pin_coords, dtype=np.float64) * scale - 0.5
+
+def line_endpoints(line_sequence, pin_coords, scale):
+    """Start and end points, in output pixels, of consecutive pins in ``line_sequence``."""
+    pins = pin_points(pin_coords, scale)
+    sequence = np.asarray(line_sequence, dtype=np.int64)
+    return pins[sequence[:-1]], pins[sequence[1:]]
+
+def render_sequence(line_sequence, pin_coords, pixel_width, output_width=500):
+    """
+    Render a line sequence directly at the output resolution.
+
+    Memory is one float32 ``output_width`` squared accumulator plus a batch of
+    ``BATCH_SAMPLES`` samples, regardless of the number of lines.
+
+    Args:
+        line_sequence (list): Pins visited by the thread, in order
+        pin_coords (list): ``(x, y)`` of each pin in solver pixels
+        pixel_width (int): Width of the solver image
+        output_width (int, optional): Width of the rendered image. Defaults to 500.
+
+    Returns:
+        np.ndarray: uint8 ``output_width`` x ``output_width`` image
+    """
+    scale = output_width / pixel_width
+    density = np.zeros((output_width, output_width), dtype=np.float32)
+    start_points, end_points = line_endpoints(line_sequence, pin_coords, scale)
+    accumulate_lines(density, start_points, end_points, THREAD_WIDTH * scale)
+    return density_to_image(density)
+
+def render_color_sequences(sequences, colors, pin_coords, pixel_width, output_width=500):
+    """
+    Render one line sequence per thread color into a single color image.
+
+    Every color absorbs ``255 - channel`` of each channel in proportion to its
+    thread density, and overlapping threads multiply, so the result does not
+    depend on the order the colors were laid in.
+
+    Args:
+        sequences (list): Pins visited by each color's thread, in order
+        colors (list): ``(r, g, b)`` of each thread
+        pin_coords (list): ``(x, y)`` of each pin in solver pixels
+        pixel_width (int): Width of the solver image
+        output_width (int, optional): Width of the rendered image. Defaults to 500.
+
+    Returns:
+        np.ndarray: uint8 ``output_width`` x ``output_width`` x 3 image in BGR order, as OpenCV writes it
+    """
+    scale = output_width / pixel_width
+    optical_density = np.zeros((output_width, output_width, 3), dtype=np.float32)
+    density = np.zeros((output_width, output_width), dtype=np.float32)
+    for sequence, rgb in zip(sequences, colors):
+        if len(sequence) < 2:
+            continue
+        density.fill(0)
+        start_points, end_points = line_endpoints(sequence, pin_coords, scale)
+        accumulate_lines(density, start_points, end_points, THREAD_WIDTH * scale)
+        absorbance = (255.0 - np.asarray(rgb[::-1], dtype=np.float32)) / 255.0
+        optical_density += density[:, :, None] * absorbance
+    return density_to_image(optical_density)
@@ -0,0 +1,58 @@
+import hashlib
+import logging
+import os
+
+from sequence_format import SEQUENCE_EXTENSION
+
+logger = logging.getLogger(__name__)
+
+# Los resultados cacheados se nombran con el prefijo del digest
+KEY_LENGTH = 24
+
+class ResultCache:
+    """
+    Caché direccionada por contenido de los resultados del generador.
+
+    La clave es un digest de los bytes subidos, los parámetros del generador y
+    su versión. Los resultados se guardan en ``directory`` como
+    ``{clave}_output.png`` y ``{clave}.seq``, los mismos nombres que usan el
+    checkout y el registro, así que el manifiesto de ``storage`` es el índice.
+    Cada acierto marca el resultado como usado; el desalojo lo hace el
+    ``StorageManager``.
+    """
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.directory = storage.directory
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(content, **params):
+        """Digest de los bytes de la imagen y los parámetros que afectan al resultado"""
+        digest = hashlib.sha256(content)
+        for name in sorted(params):
+            digest.update(f"\0{name}={params[name]}".encode())
+        return digest.hexdigest()[:KEY_LENGTH]
+
+    def paths(self, key):
+        return (
+            os.path.join(self.directory, f"{key}_output.png"),
+            os.path.join(self.directory, f"{key}{SEQUENCE_EXTENSION}")
+        )
+
+    def lookup(self, key):
+        """Devolver ``(image_path, sequence_path)`` si el resultado existe, si no None"""
+        image_path, sequence_path = self.paths(key)
+        filenames = (os.path.basename(image_path), os.path.basename(sequence_path))
+        if all(self.storage.exists(filename) for filename in filenames):
+            self.hits += 1
+            self.storage.touch(*filenames)
+            logger.debug(f"Resultado cacheado encontrado: {key}")
+            return image_path, sequence_path
+
+        self.misses += 1
+        return None
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
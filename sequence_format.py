@@ -0,0 +1,160 @@
+"""
+Compact on-disk format for line sequences.
+
+A ``.seq`` file is a 16-byte little-endian header followed by the visited pins
+as packed uint16::
+
+    magic      4s   b"HSEQ"
+    version    H    FORMAT_VERSION
+    pins       H    pins on the circle
+    lines      I    lines drawn (the file holds lines + 1 pins)
+    solver     H    SOLVER_VERSION that produced the sequence
+    reserved   H    0
+
+A 4500-line sequence takes 9 KB instead of about 20 KB of JSON, and any window
+of steps can be read without parsing the rest. Sequences saved before this
+format existed are plain JSON lists and are still accepted by ``read_sequence``.
+
+Multi-color sequences use ``COLOR_FORMAT_VERSION``. The reserved field holds
+the number of thread colors, the header is followed by their RGB values (3
+bytes each), then the pins as uint16 and a uint8 color index per pin. Each
+color's first entry is where its thread starts, so ``lines`` is the number of
+entries minus the number of colors used.
+"""
+import json
+import os
+import struct
+
+import numpy as np
+
+MAGIC = b"HSEQ"
+FORMAT_VERSION = 1
+COLOR_FORMAT_VERSION = 2
+HEADER = struct.Struct("<4sHHIHH")
+
+SEQUENCE_EXTENSION = ".seq"
+LEGACY_EXTENSION = ".json"
+
+class LineSequence:
+    """
+    A line sequence with the metadata stored in its header.
+
+    Attributes:
+        pins (np.ndarray): uint16 pins visited by the thread, in order
+        pin_count (int | None): Pins on the circle; None for legacy JSON files
+        solver_version (int | None): Solver that produced it; None for legacy JSON files
+        colors (np.ndarray | None): uint8 palette index of every pin; None for single-color sequences
+        palette (list | None): ``(r, g, b)`` thread colors indexed by ``colors``
+    """
+
+    def __init__(self, pins, pin_count=None, solver_version=None, colors=None, palette=None):
+        self.pins = pins
+        self.pin_count = pin_count
+        self.solver_version = solver_version
+        self.colors = colors
+        self.palette = palette
+
+    def __len__(self):
+        return len(self.pins)
+
+    @property
+    def lines(self):
+        if self.colors is not None:
+            return len(self.pins) - len(np.unique(self.colors))
+        return max(len(self.pins) - 1, 0)
+
+    def _slice(self, offset, limit):
+        offset = max(offset, 0)
+        end = len(self.pins) if limit is None else offset + max(limit, 0)
+        return slice(offset, end)
+
+    def window(self, offset=0, limit=None):
+        """Pins ``offset`` to ``offset + limit`` as a list of ints."""
+        return self.pins[self._slice(offset, limit)].tolist()
+
+    def color_window(self, offset=0, limit=None):
+        """Color indices of the same window, or None for single-color sequences."""
+        if self.colors is None:
+            return None
+        return self.colors[self._slice(offset, limit)].tolist()
+
+    def to_bytes(self):
+        if self.colors is None:
+            header = HEADER.pack(MAGIC, FORMAT_VERSION, self.pin_count or 0, self.lines, self.solver_version or 0, 0)
+            return header + self.pins.astype("<u2").tobytes()
+
+        header = HEADER.pack(MAGIC, COLOR_FORMAT_VERSION, self.pin_count or 0, self.lines,
+                             self.solver_version or 0, len(self.palette))
+        palette = np.asarray(self.palette, dtype=np.uint8).reshape(-1, 3)
+        return header + palette.tobytes() + self.pins.astype("<u2").tobytes() + self.colors.astype(np.uint8).tobytes()
+
+def write_sequence(path, sequence, pin_count, solver_version, colors=None, palette=None):
+    """
+    Atomically write ``sequence`` to ``path`` in the packed format.
+
+    Args:
+        path (str): Destination, normally ending in ``SEQUENCE_EXTENSION``
+        sequence (list | np.ndarray): Pins visited by the thread, in order
+        pin_count (int): Pins on the circle, at most 65536
+        solver_version (int): Version of the solver that produced the sequence
+        colors (list | np.ndarray, optional): Palette index of every pin, for multi-color sequences
+        palette (list, optional): ``(r, g, b)`` thread colors; required with ``colors``
+    """
+    pins = np.asarray(sequence, dtype=np.int64)
+    if pin_count > 1 << 16 or (len(pins) and (pins.min() < 0 or pins.max() >= pin_count)):
+        raise ValueError("Sequence pins do not fit the packed uint16 format")
+
+    if colors is not None:
+        colors = np.asarray(colors, dtype=np.int64)
+        if palette is None or len(colors) != len(pins) or not 0 < len(palette) <= 255 \
+                or (len(colors) and (colors.min() < 0 or colors.max() >= len(palette))):
+            raise ValueError("Sequence colors do not match the palette")
+        colors = colors.astype(np.uint8)
+        palette = [tuple(int(channel) for channel in rgb) for rgb in palette]
+
+    data = LineSequence(pins.astype(np.uint16), pin_count, solver_version, colors, palette).to_bytes()
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+def read_sequence(path):
+    """
+    Read a packed ``.seq`` file or a legacy JSON list of pins.
+
+    Returns:
+        LineSequence: The sequence; header fields are None for legacy JSON files
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+
+    if data[:len(MAGIC)] != MAGIC:
+        return LineSequence(np.asarray(json.loads(data), dtype=np.uint16))
+
+    if len(data) < HEADER.size:
+        raise ValueError(f"Truncated sequence header: {path}")
+    _, version, pin_count, lines, solver_version, color_count = HEADER.unpack_from(data)
+    if version == COLOR_FORMAT_VERSION:
+        return _read_color_sequence(path, data, pin_count, lines, solver_version, color_count)
+    if version != FORMAT_VERSION:
+        raise ValueError(f"Unsupported sequence format version {version}: {path}")
+
+    pins = np.frombuffer(data, dtype="<u2", offset=HEADER.size)
+    if len(pins) != lines + 1:
+        raise ValueError(f"Sequence length does not match its header: {path}")
+    return LineSequence(pins.astype(np.uint16), pin_count, solver_version)
+
+def _read_color_sequence(path, data, pin_count, lines, solver_version, color_count):
+    body = HEADER.size + 3 * color_count
+    entries, remainder = divmod(len(data) - body, 3)
+    if color_count == 0 or entries < 0 or remainder:
+        raise ValueError(f"Truncated color sequence: {path}")
+
+    palette = [tuple(rgb) for rgb in np.frombuffer(data, dtype=np.uint8, count=3 * color_count,
+                                                   offset=HEADER.size).reshape(-1, 3).tolist()]
+    pins = np.frombuffer(data, dtype="<u2", count=entries, offset=body).astype(np.uint16)
+    colors = np.frombuffer(data, dtype=np.uint8, count=entries, offset=body + 2 * entries).copy()
+    sequence = LineSequence(pins, pin_count, solver_version, colors, palette)
+    if (entries and colors.max() >= color_count) or sequence.lines != lines:
+        raise ValueError(f"Sequence length does not match its header: {path}")
+    return sequence
@@ -0,0 +1,144 @@
+"""
+Partial renders of a line sequence: what the piece should look like after N steps.
+
+Thread coverage only ever adds up, so the coverage after N steps is the
+coverage of a keyframe plus the lines between it and step N. A
+``SnapshotRenderer`` keeps a keyframe every ``keyframe_steps`` steps and
+renders any step from the nearest one, drawing the lines it is missing (or
+erasing the ones it has too many), so a snapshot costs at most half a
+keyframe interval of lines however long the sequence is.
+
+Keyframes are float32, ``output_width² × 4`` bytes each (three times that for
+color), so a renderer keeps at most ``max_keyframe_bytes`` of them: when a
+new one would not fit, every other keyframe is dropped and the interval
+doubles.
+"""
+import os
+import threading
+
+import numpy as np
+
+from render import THREAD_WIDTH, accumulate_lines, density_to_image, pin_points
+
+# Steps between cached keyframes; each one holds a float32 image (three channels for color)
+SNAPSHOT_KEYFRAME_STEPS = int(os.getenv('HILOS_SNAPSHOT_KEYFRAME_STEPS', '250'))
+# Keyframe memory of one renderer; past it the keyframes are spaced further apart
+SNAPSHOT_KEYFRAME_BYTES = int(os.getenv('HILOS_SNAPSHOT_KEYFRAME_BYTES', str(16 * 1024 * 1024)))
+
+class SnapshotRenderer:
+    """
+    Render the first ``steps`` entries of one sequence, reusing cached keyframes.
+
+    Steps are entries of the sequence, as the viewer counts them: the first
+    step only places the thread on its start pin, and every later one draws a
+    line from the previous pin (of the same color, for multi-color sequences).
+    Keyframes are built lazily, up to the furthest step requested so far, and
+    the renderer is safe to share between threads.
+
+    Args:
+        sequence (LineSequence): The sequence, as returned by ``read_sequence``
+        pin_coords (list): ``(x, y)`` of each pin in solver pixels
+        pixel_width (int): Width of the solver image
+        output_width (int, optional): Width of the snapshots. Defaults to 500.
+        keyframe_steps (int, optional): Steps between keyframes. Defaults to ``SNAPSHOT_KEYFRAME_STEPS``.
+        max_keyframe_bytes (int, optional): Memory the keyframes may use; at least two are always kept.
+            Defaults to ``SNAPSHOT_KEYFRAME_BYTES``.
+    """
+
+    def __init__(self, sequence, pin_coords, pixel_width, output_width=500, keyframe_steps=SNAPSHOT_KEYFRAME_STEPS,
+                 max_keyframe_bytes=SNAPSHOT_KEYFRAME_BYTES):
+        scale = output_width / pixel_width
+        self.output_width = output_width
+        self.keyframe_steps = max(1, keyframe_steps)
+        self.thread_width = THREAD_WIDTH * scale
+        self.points = pin_points(pin_coords, scale)
+        self.pins = np.asarray(sequence.pins, dtype=np.int64)
+
+        # Entry each step draws its line from, or -1 where a thread starts
+        self.previous = np.arange(len(self.pins)) - 1
+        if sequence.colors is None:
+            self.colors = None
+            self.absorbance = None
+            shape = (output_width, output_width)
+        else:
+            self.colors = np.asarray(sequence.colors, dtype=np.int64)
+            last = {}
+            for entry, color in enumerate(self.colors.tolist()):
+                self.previous[entry] = last.get(color, -1)
+                last[color] = entry
+            # BGR absorbance of each thread, as in render_color_sequences
+            self.absorbance = (255.0 - np.asarray(sequence.palette, dtype=np.float32)[:, ::-1]) / 255.0
+            shape = (output_width, output_width, 3)
+
+        self._keyframes = [np.zeros(shape, dtype=np.float32)]
+        self.max_keyframes = max(2, max_keyframe_bytes // self._keyframes[0].nbytes)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.pins)
+
+    @property
+    def keyframe_bytes(self):
+        """Memory held by the keyframes built so far."""
+        return sum(keyframe.nbytes for keyframe in self._keyframes)
+
+    def _draw(self, density, begin, end, sign=1.0):
+        """Add (or with ``sign=-1`` remove) the lines of steps ``begin`` to ``end`` on ``density``."""
+        entries = np.arange(begin, end)
+        entries = entries[self.previous[entries] >= 0]
+        if len(entries) == 0:
+            return
+        start_points = self.points[self.pins[self.previous[entries]]]
+        end_points = self.points[self.pins[entries]]
+
+        if self.colors is None:
+            accumulate_lines(density, start_points, end_points, sign * self.thread_width)
+            return
+
+        layer = np.zeros(density.shape[:2], dtype=np.float32)
+        for color in np.unique(self.colors[entries]):
+            chosen = self.colors[entries] == color
+            layer.fill(0)
+            accumulate_lines(layer, start_points[chosen], end_points[chosen], sign * self.thread_width)
+            density += layer[:, :, None] * self.absorbance[color]
+
+    def density(self, steps):
+        """
+        Thread coverage after the first ``steps`` steps.
+
+        Returns:
+            np.ndarray: float32 coverage owned by the caller, as ``density_to_image`` takes it
+        """
+        steps = min(max(steps, 0), len(self.pins))
+
+        with self._lock:
+            while True:
+                interval = self.keyframe_steps
+                index, remainder = divmod(steps, interval)
+                if index < len(self._keyframes):
+                    break
+                if len(self._keyframes) >= self.max_keyframes:
+                    # Keyframe i of the coarser spacing is keyframe 2i of this one
+                    self._keyframes = self._keyframes[::2]
+                    self.keyframe_steps *= 2
+                    continue
+                keyframe = self._keyframes[-1].copy()
+                first = (len(self._keyframes) - 1) * interval
+                self._draw(keyframe, first, first + interval)
+                self._keyframes.append(keyframe)
+            # The next keyframe is only used when an earlier request already built it
+            erase = remainder > interval // 2 and index + 1 < len(self._keyframes)
+            keyframe = self._keyframes[index + 1 if erase else index]
+
+        density = keyframe.copy()
+        if erase:
+            self._draw(density, steps, min((index + 1) * interval, len(self.pins)), sign=-1.0)
+            # Rounding can leave erased pixels a hair below zero
+            np.maximum(density, 0, out=density)
+        else:
+            self._draw(density, index * interval, steps)
+        return density
+
+    def image(self, steps):
+        """uint8 snapshot after the first ``steps`` steps: grayscale, or BGR for multi-color sequences."""
+        return density_to_image(self.density(steps))
@@ -42,44 +42,57 @@ document.addEventListener('DOMContentLoaded', () => {
         progressStatus.textContent = status;
     }
 
-    // Función para simular progreso estimado (15-17 segundos)
-    function simulateProgress() {
-        const totalTime = 35000; // 35 segundos promedio
-        const updateInterval = 100; // Actualizar cada 100ms
-        const totalUpdates = totalTime / updateInterval;
-        let currentUpdate = 0;
-
-        const phases = [
-            { end: 0.1, status: '✨ Analizando tu obra maestra...' },
-            { end: 0.25, status: '🎨 Creando la paleta mágica...' },
-            { end: 0.4, status: '📐 Calculando coordenadas artísticas...' },
-            { end: 0.6, status: '🧵 Tejiendo los primeros hilos...' },
-            { end: 0.8, status: '🎭 Agregando toques de magia...' },
-            { end: 0.95, status: '✨ Dando los últimos retoques...' },
-            { end: 1.0, status: '🎉 ¡Tu imagen está casi lista!' }
-        ];
-
-        const progressInterval = setInterval(() => {
-            currentUpdate++;
-            const progress = Math.min((currentUpdate / totalUpdates) * 100, 99);
-
-            // Determinar el estado actual
-            let currentStatus = 'Procesando...';
-            for (const phase of phases) {
-                if (progress / 100 <= phase.end) {
-                    currentStatus = phase.status;
-                    break;
-                }
+    // Mensajes según el avance real del trabajo
+    const phases = [
+        { end: 0.1, status: '✨ Analizando tu obra maestra...' },
+        { end: 0.25, status: '🎨 Creando la paleta mágica...' },
+        { end: 0.4, status: '📐 Calculando coordenadas artísticas...' },
+        { end: 0.6, status: '🧵 Tejiendo los primeros hilos...' },
+        { end: 0.8, status: '🎭 Agregando toques de magia...' },
+        { end: 0.95, status: '✨ Dando los últimos retoques...' },
+        { end: 1.0, status: '🎉 ¡Tu imagen está casi lista!' }
+    ];
+
+    function statusForProgress(progress) {
+        for (const phase of phases) {
+            if (progress <= phase.end) {
+                return phase.status;
             }
+        }
+        return 'Procesando...';
+    }
 
-            updateProgress(Math.floor(progress), currentStatus);
-
-            if (currentUpdate >= totalUpdates) {
-                clearInterval(progressInterval);
-            }
-        }, updateInterval);
+    // Seguir el progreso de un trabajo con Server-Sent Events hasta que termine.
+    // EventSource se reconecta solo; el estado vive en el servidor.
+    function waitForJob(eventsUrl) {
+        return new Promise((resolve, reject) => {
+            const source = new EventSource(eventsUrl);
+
+            source.onmessage = (event) => {
+                const job = JSON.parse(event.data);
+
+                if (job.status === 'queued') {
+                    updateProgress(0, '⏳ Esperando turno...');
+                } else if (job.status === 'running') {
+                    const progress = Math.min(job.progress, 0.99);
+                    updateProgress(Math.floor(progress * 100), statusForProgress(progress));
+                } else if (job.status === 'done') {
+                    source.close();
+                    resolve(job);
+                } else if (job.status === 'failed') {
+                    source.close();
+                    reject(new Error(job.error || 'Error generando imagen'));
+                }
+            };
 
-        return progressInterval;
+            source.addEventListener('error', (event) => {
+                // Un evento "error" con datos indica que el trabajo ya no existe
+                if (event.data !== undefined) {
+                    source.close();
+                    reject(new Error('Trabajo no encontrado'));
+                }
+            });
+        });
     }
 
     // Manejar el envío del formulario de generación de imagen
@@ -94,14 +107,11 @@ document.addEventListener('DOMContentLoaded', () => {
         // Inicializar barra de progreso
         updateProgress(0, '🚀 Preparando la magia...');
 
-        // Iniciar simulación de progreso
-        const progressInterval = simulateProgress();
-
         const formData = new FormData();
         formData.append('file', imageInput.files[0]);
 
         try {
-            const response = await fetch(`/generate-thread-image/`, {
+            const response = await fetch(`/api/jobs`, {
                 method: 'POST',
                 body: formData
             });
@@ -111,30 +121,23 @@ document.addEventListener('DOMContentLoaded', () => {
                 throw new Error(errorText || 'Error generando imagen');
             }
 
-            const blob = await response.blob();
-            const imageUrl = URL.createObjectURL(blob);
-            resultImg.src = imageUrl;
-            resultImg.style.display = 'block';
+            const { events_url, result_url } = await response.json();
+            const job = await waitForJob(events_url);
 
-            const contentDisposition = response.headers.get('content-disposition');
-            const filename = contentDisposition
-                ? contentDisposition.split('filename=')[1].replace(/['"]/g, '')
-                : `${Date.now()}_output.png`;
+            // Miniatura en WebP (o PNG si el navegador no lo admite): unos KB en lugar del render completo
+            resultImg.src = `${result_url}?format=image&size=thumb`;
+            resultImg.style.display = 'block';
 
             currentImageData = {
-                filename: filename,
+                filename: job.image_filename,
                 originalFile: imageInput.files[0].name
             };
 
-            // Detener simulación y mostrar 100%
-            clearInterval(progressInterval);
             updateProgress(100, '🎨✨ ¡Tu obra maestra está lista! ✨🎨');
 
             document.getElementById('buyButton').style.display = 'block';
             document.getElementById('purchaseInfo').style.display = 'block';
         } catch (error) {
-            // Detener simulación en caso de error
-            clearInterval(progressInterval);
             console.error(error.message);
             updateProgress(0, '😔 Ups, algo salió mal...');
         } finally {
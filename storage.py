@@ -0,0 +1,291 @@
+"""
+Ciclo de vida de los archivos generados en thread_outputs.
+
+Ejemplos:
+    python storage.py report
+    python storage.py sweep --dry-run
+    python storage.py sweep --quota-mb 200 --max-age-days 3
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+
+from sequence_format import LEGACY_EXTENSION, SEQUENCE_EXTENSION
+
+logger = logging.getLogger(__name__)
+
+# Espacio máximo de los archivos generados; HILOS_RESULT_CACHE_MAX_BYTES es el nombre anterior
+STORAGE_QUOTA_BYTES = int(os.getenv(
+    'HILOS_STORAGE_QUOTA_BYTES', os.getenv('HILOS_RESULT_CACHE_MAX_BYTES', str(500 * 1024 * 1024))))
+
+# Edad a partir de la cual una vista previa que nadie compró se borra aunque sobre espacio
+ORPHAN_MAX_AGE = float(os.getenv('HILOS_ORPHAN_MAX_AGE', str(7 * 24 * 3600)))
+
+# Una vista previa recién generada nunca se borra: el cliente puede estar pagándola
+ORPHAN_GRACE_PERIOD = float(os.getenv('HILOS_ORPHAN_GRACE_PERIOD', '1800'))
+
+# Segundos entre barridos en segundo plano
+STORAGE_SWEEP_INTERVAL = float(os.getenv('HILOS_STORAGE_SWEEP_INTERVAL', '900'))
+
+# Imagen, sus variantes WebP y miniatura, secuencia binaria y secuencia JSON antigua de cada resultado
+ARTIFACT_PATTERN = re.compile(r'^(.+?)(_output\.png|_output\.webp|_thumb\.webp|_thumb\.png|\.seq|\.json)$')
+
+class Artifact:
+    """Los archivos de un mismo resultado (``{nombre}_output.png``, sus variantes y su secuencia)"""
+
+    def __init__(self, name):
+        self.name = name
+        self.files = {}
+        self.mtime = 0.0
+
+    @property
+    def size(self):
+        return sum(self.files.values())
+
+    def add(self, filename, size, mtime):
+        self.files[filename] = size
+        self.mtime = max(self.mtime, mtime)
+
+class StorageManager:
+    """
+    Manifiesto en memoria de los resultados guardados y su desalojo.
+
+    El manifiesto se indexa por nombre de archivo, así que saber si un
+    resultado existe no toca el disco. Se reconstruye en cada barrido y se
+    actualiza al registrar resultados nuevos; si un archivo no está (otro
+    proceso lo acaba de escribir) se revisa el disco como respaldo.
+
+    ``referenced_files`` devuelve los nombres de archivo que usa alguna compra;
+    esos nunca se borran. El resto son vistas previas huérfanas, que se borran
+    al superar ``orphan_max_age`` o, de la menos usada a la más usada, mientras
+    se exceda ``quota_bytes``.
+    """
+
+    def __init__(self, directory, referenced_files=None, quota_bytes=STORAGE_QUOTA_BYTES,
+                 orphan_max_age=ORPHAN_MAX_AGE, grace_period=ORPHAN_GRACE_PERIOD):
+        self.directory = directory
+        self.referenced_files = referenced_files or (lambda: set())
+        self.quota_bytes = quota_bytes
+        self.orphan_max_age = orphan_max_age
+        self.grace_period = grace_period
+        self.reclaimed_bytes = 0
+        self._artifacts = {}
+        self._owners = {}
+        self._lock = threading.Lock()
+        self._task = None
+
+    # Manifiesto
+
+    def scan(self):
+        """Reconstruir el manifiesto a partir del directorio"""
+        artifacts = {}
+        owners = {}
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                match = ARTIFACT_PATTERN.match(entry.name)
+                if not match or not entry.is_file():
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                artifact = artifacts.setdefault(match.group(1), Artifact(match.group(1)))
+                artifact.add(entry.name, stat.st_size, stat.st_mtime)
+                owners[entry.name] = artifact.name
+
+        with self._lock:
+            self._artifacts = artifacts
+            self._owners = owners
+
+    def add(self, *paths):
+        """Registrar archivos recién escritos en el directorio"""
+        for path in paths:
+            filename = os.path.basename(path)
+            match = ARTIFACT_PATTERN.match(filename)
+            if not match:
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, filename))
+            except FileNotFoundError:
+                continue
+            with self._lock:
+                artifact = self._artifacts.setdefault(match.group(1), Artifact(match.group(1)))
+                artifact.add(filename, stat.st_size, stat.st_mtime)
+                self._owners[filename] = artifact.name
+
+    def exists(self, filename):
+        with self._lock:
+            if filename in self._owners:
+                return True
+        if os.path.isfile(os.path.join(self.directory, filename)):
+            self.add(filename)
+            return True
+        return False
+
+    def touch(self, *filenames):
+        """Marcar archivos como recién usados, para que el desalojo LRU los deje al final"""
+        now = time.time()
+        for filename in filenames:
+            try:
+                os.utime(os.path.join(self.directory, filename), (now, now))
+            except FileNotFoundError:
+                continue
+            with self._lock:
+                artifact = self._artifacts.get(self._owners.get(filename))
+                if artifact is not None:
+                    artifact.mtime = now
+
+    def sequence_filename(self, name):
+        """Archivo de secuencia de un resultado: el binario, o el JSON de compras antiguas"""
+        for filename in (f"{name}{SEQUENCE_EXTENSION}", f"{name}{LEGACY_EXTENSION}"):
+            if self.exists(filename):
+                return filename
+        return None
+
+    @property
+    def total_bytes(self):
+        with self._lock:
+            return sum(artifact.size for artifact in self._artifacts.values())
+
+    # Desalojo
+
+    def _remove(self, artifact):
+        removed = 0
+        for filename, size in artifact.files.items():
+            try:
+                os.remove(os.path.join(self.directory, filename))
+                removed += size
+            except FileNotFoundError:
+                pass
+        with self._lock:
+            self._artifacts.pop(artifact.name, None)
+            for filename in artifact.files:
+                self._owners.pop(filename, None)
+        return removed
+
+    def sweep(self, dry_run=False, now=None):
+        """
+        Borrar las vistas previas huérfanas viejas y, si hace falta, las menos usadas.
+
+        Args:
+            dry_run (bool, optional): Solo informar lo que se borraría. Defaults to False.
+
+        Returns:
+            dict: Resumen con el espacio usado antes y después y lo recuperado
+        """
+        now = time.time() if now is None else now
+        self.scan()
+        referenced = self.referenced_files()
+
+        with self._lock:
+            artifacts = list(self._artifacts.values())
+        total = sum(artifact.size for artifact in artifacts)
+        orphans = [artifact for artifact in artifacts if not referenced.intersection(artifact.files)]
+        evictable = sorted(
+            (artifact for artifact in orphans if now - artifact.mtime >= self.grace_period),
+            key=lambda artifact: artifact.mtime
+        )
+
+        report = {
+            "directory": self.directory,
+            "artifacts": len(artifacts),
+            "referenced": len(artifacts) - len(orphans),
+            "orphans": len(orphans),
+            "bytes_before": total,
+            "quota_bytes": self.quota_bytes,
+            "expired": 0,
+            "evicted_for_quota": 0,
+            "bytes_reclaimed": 0,
+            "dry_run": dry_run,
+        }
+
+        for artifact in evictable:
+            expired = now - artifact.mtime >= self.orphan_max_age
+            if not expired and total <= self.quota_bytes:
+                # Ordenados por uso: los que siguen son más recientes y tampoco han caducado
+                break
+            size = artifact.size if dry_run else self._remove(artifact)
+            total -= size
+            report["bytes_reclaimed"] += size
+            report["expired" if expired else "evicted_for_quota"] += 1
+
+        report["bytes_after"] = total
+        if not dry_run:
+            self.reclaimed_bytes += report["bytes_reclaimed"]
+        if report["bytes_reclaimed"]:
+            logger.info(f"Almacenamiento: {report['bytes_reclaimed']} bytes recuperados en {self.directory}")
+        return report
+
+    def enforce_quota(self):
+        """Barrer solo si el manifiesto ya excede la cuota; pensado para después de cada generación"""
+        if self.total_bytes > self.quota_bytes:
+            return self.sweep()
+        return None
+
+    # Barrido periódico
+
+    async def _run_periodically(self, interval):
+        while True:
+            try:
+                await asyncio.to_thread(self.sweep)
+            except Exception as e:
+                logger.error(f"Error en el barrido de almacenamiento: {str(e)}")
+            await asyncio.sleep(interval)
+
+    def start(self, interval=STORAGE_SWEEP_INTERVAL):
+        self._task = asyncio.create_task(self._run_periodically(interval))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+def purchased_files(session_factory):
+    """Función que lista los nombres de archivo usados por alguna compra (activa o no)"""
+    from models import Purchase
+
+    def referenced_files():
+        db = session_factory()
+        try:
+            rows = db.query(Purchase.image_path, Purchase.json_path).all()
+        finally:
+            db.close()
+        return {os.path.basename(path) for row in rows for path in row if path}
+
+    return referenced_files
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Report on or clean up generated thread outputs.")
+    parser.add_argument('command', choices=('report', 'sweep'))
+    parser.add_argument('--directory', default='thread_outputs')
+    parser.add_argument('--quota-mb', type=float, default=STORAGE_QUOTA_BYTES / (1024 * 1024))
+    parser.add_argument('--max-age-days', type=float, default=ORPHAN_MAX_AGE / 86400)
+    parser.add_argument('--grace-minutes', type=float, default=ORPHAN_GRACE_PERIOD / 60)
+    parser.add_argument('--dry-run', action='store_true', help="Report what sweep would delete without deleting")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    from database import SessionLocal
+
+    args = parse_args(argv)
+    manager = StorageManager(
+        args.directory,
+        referenced_files=purchased_files(SessionLocal),
+        quota_bytes=int(args.quota_mb * 1024 * 1024),
+        orphan_max_age=args.max_age_days * 86400,
+        grace_period=args.grace_minutes * 60,
+    )
+    report = manager.sweep(dry_run=args.dry_run or args.command == 'report')
+    print(json.dumps(report, indent=2))
+    return 0
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main())
@@ -0,0 +1,99 @@
+"""
+Replay Stripe webhook events against a local server, signed like Stripe does.
+
+Useful to exercise /stripe/webhook and the registration flow without a Stripe
+account or the Stripe CLI. The server must run with the same
+STRIPE_WEBHOOK_SECRET passed here.
+
+Examples:
+    python stripe_stub.py --secret whsec_test --filename 0123abcd_output.png
+    python stripe_stub.py --secret whsec_test --session-id cs_test_1 --repeat 3
+    python stripe_stub.py --secret whsec_test --payload event.json
+"""
+import argparse
+import hashlib
+import hmac
+import json
+import sys
+import time
+import urllib.error
+import urllib.request
+import uuid
+
+def checkout_session_event(session_id=None, filename="", original_file="", payment_intent=None,
+                           payment_status="paid", event_type="checkout.session.completed"):
+    """A minimal ``checkout.session.*`` event with the fields the app reads."""
+    session_id = session_id or f"cs_test_{uuid.uuid4().hex}"
+    return {
+        "id": f"evt_{uuid.uuid4().hex}",
+        "object": "event",
+        "type": event_type,
+        "created": int(time.time()),
+        "data": {
+            "object": {
+                "id": session_id,
+                "object": "checkout.session",
+                "mode": "payment",
+                "payment_intent": payment_intent or f"pi_{uuid.uuid4().hex}",
+                "payment_status": payment_status,
+                "metadata": {"filename": filename, "original_file": original_file},
+            }
+        },
+    }
+
+def sign_payload(payload, secret, timestamp=None):
+    """``Stripe-Signature`` header for ``payload`` (bytes), using Stripe's v1 scheme."""
+    timestamp = int(time.time()) if timestamp is None else timestamp
+    signed = f"{timestamp}.".encode() + payload
+    signature = hmac.new(secret.encode(), signed, hashlib.sha256).hexdigest()
+    return f"t={timestamp},v1={signature}"
+
+def replay(url, event, secret, timeout=10):
+    """
+    POST ``event`` to ``url`` with a valid signature.
+
+    Returns:
+        tuple: (HTTP status, response body as text)
+    """
+    payload = json.dumps(event).encode()
+    request = urllib.request.Request(
+        url,
+        data=payload,
+        method="POST",
+        headers={"Content-Type": "application/json", "Stripe-Signature": sign_payload(payload, secret)},
+    )
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return response.status, response.read().decode()
+    except urllib.error.HTTPError as e:
+        return e.code, e.read().decode()
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Replay signed Stripe webhook events against a local server.")
+    parser.add_argument("--url", default="http://localhost:8000/stripe/webhook")
+    parser.add_argument("--secret", required=True, help="Same value as the server's STRIPE_WEBHOOK_SECRET")
+    parser.add_argument("--payload", help="JSON file with an event to replay instead of a generated one")
+    parser.add_argument("--session-id", help="Checkout session id (default: random)")
+    parser.add_argument("--filename", default="", help="Generated image filename stored in the session metadata")
+    parser.add_argument("--payment-status", default="paid")
+    parser.add_argument("--repeat", type=int, default=1, help="Send the same event this many times")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.payload:
+        with open(args.payload, "r") as f:
+            event = json.load(f)
+    else:
+        event = checkout_session_event(args.session_id, args.filename, payment_status=args.payment_status)
+
+    failed = False
+    for _ in range(args.repeat):
+        status, body = replay(args.url, event, args.secret)
+        print(f"{status} {body}", file=sys.stderr)
+        failed = failed or status >= 400
+    print(event["data"]["object"]["id"])
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
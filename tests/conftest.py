@@ -0,0 +1,45 @@
+"""
+Shared setup for the tests.
+
+database.py and app.py read their configuration at import time, and app.py
+uses paths relative to the working directory (static/, thread_outputs/), so
+the environment and a scratch working directory are set up here, before any
+test module imports them. Nothing touches hilos.db or the real Stripe API.
+"""
+import os
+import shutil
+import sys
+import tempfile
+
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+WEBHOOK_SECRET = "whsec_test"
+
+WORK_DIR = tempfile.mkdtemp(prefix="hilos_tests_")
+for name in ("static", "thread_viewer"):
+    os.symlink(os.path.join(REPO_DIR, name), os.path.join(WORK_DIR, name))
+
+os.environ.update({
+    "DATABASE_URL": f"sqlite:///{os.path.join(WORK_DIR, 'test.db')}",
+    "STRIPE_WEBHOOK_SECRET": WEBHOOK_SECRET,
+    "STRIPE_SECRET_KEY": "sk_test_tests",
+    "STRIPE_API_BASE": "http://127.0.0.1:9",
+    "HILOS_GENERATION_MODE": "thread",
+    "HILOS_PROFILE_DIR": os.path.join(WORK_DIR, "profiles"),
+    "HILOS_JOBS_DIR": os.path.join(WORK_DIR, "thread_outputs", "jobs"),
+})
+_previous_dir = os.getcwd()
+os.chdir(WORK_DIR)
+
+def pytest_sessionfinish(session, exitstatus):
+    os.chdir(_previous_dir)
+    shutil.rmtree(WORK_DIR, ignore_errors=True)
+
+@pytest.fixture(scope="session")
+def app_module():
+    """The app module; its startup hooks (generation pool, outbox worker, sweeps) are not run."""
+    import app
+    return app
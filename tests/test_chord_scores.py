@@ -0,0 +1,38 @@
+import numpy as np
+
+from geometry import get_geometry
+from hilos import LINE_WIDTH, MIN_DISTANCE, ChordScores, solve_lines
+
+PINS = 80
+PIXEL_WIDTH = 100
+
+def rescan(chords, residual):
+    return np.concatenate([chords.score(residual, pin) for pin in range(chords.pin_no)])
+
+def draw(chords, residual, scores, lines):
+    solver = solve_lines(chords, residual, chord_scores=scores)
+    for _ in range(lines):
+        next(solver)
+
+def test_integer_residual_scores_stay_exact():
+    chords = get_geometry(PINS, PIXEL_WIDTH, MIN_DISTANCE)
+    residual = np.random.default_rng(0).integers(0, 256, PIXEL_WIDTH * PIXEL_WIDTH).astype(np.float64)
+    scores = ChordScores(chords, residual)
+
+    draw(chords, residual, scores, 200)
+
+    assert scores.refresh_lines is None
+    assert np.array_equal(scores.scores, rescan(chords, residual))
+
+def test_float_residual_scores_are_recomputed():
+    chords = get_geometry(PINS, PIXEL_WIDTH, MIN_DISTANCE)
+    residual = np.random.default_rng(0).uniform(0, 255, PIXEL_WIDTH * PIXEL_WIDTH)
+    scores = ChordScores(chords, residual, refresh_lines=50)
+
+    draw(chords, residual, scores, 150)
+
+    assert scores.refresh_lines == 50
+    assert np.array_equal(scores.scores, rescan(chords, residual))
+
+    draw(chords, residual, scores, 20)
+    np.testing.assert_allclose(scores.scores, rescan(chords, residual), rtol=0, atol=1e-6 * LINE_WIDTH)
@@ -0,0 +1,149 @@
+import smtplib
+from datetime import datetime, timedelta
+
+import pytest
+
+import email_outbox
+from database import SessionLocal, engine
+from email_outbox import EmailOutbox, SmtpSettings, enqueue_email
+from models import Base, OutboundEmail
+
+class FakeConnection:
+    """Stands in for ``SmtpConnection``: records what it sends and raises the queued errors first."""
+
+    def __init__(self, settings, errors=()):
+        self.settings = settings
+        self.server = None
+        self.errors = list(errors)
+        self.sent = []
+        self.closed = 0
+
+    def send(self, to_address, subject, html):
+        self.server = object()
+        if self.errors:
+            error = self.errors.pop(0)
+            if error is not None:
+                raise error
+        self.sent.append(to_address)
+
+    def close(self):
+        self.server = None
+        self.closed += 1
+
+@pytest.fixture(autouse=True)
+def empty_outbox():
+    Base.metadata.create_all(bind=engine)
+    db = SessionLocal()
+    try:
+        db.query(OutboundEmail).delete()
+        db.commit()
+    finally:
+        db.close()
+
+def make_outbox(**kwargs):
+    settings = SmtpSettings("127.0.0.1", 25, from_address="hilos@example.com", starttls=False)
+    return EmailOutbox(SessionLocal, settings=settings, connection_factory=FakeConnection, **kwargs)
+
+def enqueue(*addresses):
+    db = SessionLocal()
+    try:
+        emails = [enqueue_email(db, address, "Tu imagen de hilos", "<p>Hola</p>") for address in addresses]
+        db.commit()
+        return [email.id for email in emails]
+    finally:
+        db.close()
+
+def load(email_id):
+    db = SessionLocal()
+    try:
+        return db.get(OutboundEmail, email_id)
+    finally:
+        db.close()
+
+def test_drain_sends_pending_emails():
+    ids = enqueue("a@example.com", "b@example.com")
+    connection = FakeConnection(None)
+
+    assert make_outbox().drain(connection) == 2
+
+    assert connection.sent == ["a@example.com", "b@example.com"]
+    for email_id in ids:
+        email = load(email_id)
+        assert email.status == "sent"
+        assert email.attempts == 1
+        assert email.sent_at is not None
+    assert make_outbox().claim_batch() == []
+
+def test_transient_error_is_retried_with_backoff(monkeypatch):
+    monkeypatch.setattr(email_outbox.random, "uniform", lambda low, high: 1.0)
+    (email_id,) = enqueue("a@example.com")
+    outbox = make_outbox()
+
+    before = datetime.utcnow()
+    outbox.send_batch(FakeConnection(None, [smtplib.SMTPDataError(451, b"Try again later")]), outbox.claim_batch())
+
+    email = load(email_id)
+    assert email.status == "pending"
+    assert email.attempts == 1
+    assert "Try again later" in email.last_error
+    assert email.next_attempt_at >= before + timedelta(seconds=email_outbox.retry_delay(1))
+    # Not due yet, so no worker picks it up
+    assert outbox.claim_batch() == []
+
+def test_connection_error_retries_the_rest_of_the_batch():
+    ids = enqueue("a@example.com", "b@example.com", "c@example.com")
+    outbox = make_outbox()
+    connection = FakeConnection(None, [None, smtplib.SMTPServerDisconnected("Connection unexpectedly closed")])
+
+    outbox.send_batch(connection, outbox.claim_batch())
+
+    assert connection.sent == ["a@example.com"]
+    assert connection.closed == 1
+    assert [load(email_id).status for email_id in ids] == ["sent", "pending", "pending"]
+
+def test_expired_lease_is_reclaimed():
+    (email_id,) = enqueue("a@example.com")
+    outbox = make_outbox()
+
+    # A worker claims the email and dies before recording the result
+    assert [email["id"] for email in outbox.claim_batch()] == [email_id]
+    assert load(email_id).status == "sending"
+    assert outbox.claim_batch() == []
+
+    db = SessionLocal()
+    try:
+        db.query(OutboundEmail).filter(OutboundEmail.id == email_id) \
+            .update({"next_attempt_at": datetime.utcnow() - timedelta(seconds=1)})
+        db.commit()
+    finally:
+        db.close()
+
+    assert [email["id"] for email in outbox.claim_batch()] == [email_id]
+
+def test_email_fails_after_max_attempts(monkeypatch):
+    monkeypatch.setattr(email_outbox, "retry_delay", lambda attempts: 0)
+    (email_id,) = enqueue("a@example.com")
+    errors = [smtplib.SMTPDataError(451, b"Try again later")] * 5
+    connection = FakeConnection(None, errors)
+
+    assert make_outbox(max_attempts=3).drain(connection) == 0
+
+    email = load(email_id)
+    assert email.status == "failed"
+    assert email.attempts == 3
+    assert len(connection.errors) == 2
+
+@pytest.mark.parametrize("error", [
+    smtplib.SMTPRecipientsRefused({"a@example.com": (550, b"No such user")}),
+    smtplib.SMTPDataError(554, b"Message rejected"),
+])
+def test_permanent_error_fails_on_first_attempt(error):
+    (email_id,) = enqueue("a@example.com")
+    outbox = make_outbox()
+
+    outbox.send_batch(FakeConnection(None, [error]), outbox.claim_batch())
+
+    email = load(email_id)
+    assert email.status == "failed"
+    assert email.attempts == 1
+    assert outbox.claim_batch() == []
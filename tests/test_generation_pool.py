@@ -0,0 +1,53 @@
+import asyncio
+import os
+from concurrent.futures.process import BrokenProcessPool
+
+import pytest
+
+from generation_pool import GenerationPool
+
+# A tiny geometry keeps the workers' warm-up short
+PINS = 16
+PIXEL_WIDTH = 64
+
+def crash():
+    """Die like a worker killed by the OOM killer."""
+    os._exit(1)
+
+def run(pool, fn, *args):
+    async def main():
+        return await pool.run(fn, *args)
+    return asyncio.run(main())
+
+@pytest.mark.parametrize("mode", ["process", "thread"])
+def test_ready_waits_for_warm_up_without_blocking_the_loop(mode):
+    pool = GenerationPool(workers=1, mode=mode)
+
+    async def main():
+        pool.start(pins=PINS, pixel_width=PIXEL_WIDTH)
+        ticks = 0
+        ready = asyncio.ensure_future(pool.ready())
+        while not ready.done():
+            ticks += 1
+            await asyncio.sleep(0.001)
+        await ready
+        return ticks
+
+    try:
+        assert asyncio.run(main()) > 0
+        assert run(pool, pow, 2, 10) == 1024
+    finally:
+        pool.shutdown()
+
+def test_pool_recovers_from_a_dead_worker():
+    pool = GenerationPool(workers=1, mode="process")
+    pool.start(pins=PINS, pixel_width=PIXEL_WIDTH)
+    try:
+        with pytest.raises(BrokenProcessPool):
+            run(pool, crash)
+        # Later generations go to a new pool instead of failing until a restart
+        assert run(pool, pow, 2, 10) == 1024
+        assert run(pool, pow, 3, 3) == 27
+        assert pool.pending == 0
+    finally:
+        pool.shutdown()
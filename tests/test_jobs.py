@@ -0,0 +1,59 @@
+import os
+import time
+
+from jobs import JobStore
+
+def age(store, job_id, seconds):
+    """Backdate a job as if it was last written ``seconds`` ago."""
+    job = store.get(job_id)
+    job['updated_at'] -= seconds
+    store._write(job)
+    past = time.time() - seconds
+    os.utime(store._path(job_id), (past, past))
+
+def test_prune_removes_only_expired_finished_jobs(tmp_path):
+    store = JobStore(str(tmp_path))
+    expired = store.create(status='done')
+    running = store.create(status='running')
+    recent = store.create(status='failed')
+    age(store, expired['id'], 7200)
+    age(store, running['id'], 7200)
+
+    store.prune(max_age=3600)
+
+    assert store.get(expired['id']) is None
+    assert store.get(running['id']) is not None
+    assert store.get(recent['id']) is not None
+
+def test_prune_if_due_runs_at_most_once_per_interval(tmp_path):
+    store = JobStore(str(tmp_path), prune_interval=60)
+    first = store.create(status='done')
+    age(store, first['id'], 2 * 24 * 3600)
+
+    assert store.prune_if_due()
+    assert store.get(first['id']) is None
+
+    second = store.create(status='done')
+    age(store, second['id'], 2 * 24 * 3600)
+    assert not store.prune_if_due()
+    assert store.get(second['id']) is not None
+
+    store._last_prune -= 61
+    assert store.prune_if_due()
+    assert store.get(second['id']) is None
+
+def test_prune_ignores_jobs_removed_concurrently(tmp_path, monkeypatch):
+    store = JobStore(str(tmp_path))
+    job = store.create(status='done')
+    age(store, job['id'], 2 * 24 * 3600)
+    remove = os.remove
+
+    def remove_twice(path):
+        # Another worker prunes the same file first
+        remove(path)
+        remove(path)
+
+    monkeypatch.setattr(os, 'remove', remove_twice)
+    store.prune()
+
+    assert store.get(job['id']) is None
@@ -0,0 +1,51 @@
+import asyncio
+import os
+
+from metrics import REGISTRY, Profiler, record_generation
+
+def sample(name):
+    for line in REGISTRY.render().splitlines():
+        if line.startswith(name + " "):
+            return float(line.rsplit(" ", 1)[1])
+    return 0.0
+
+def test_record_generation_keeps_counts_out_of_phase_durations():
+    lines = sample("hilos_generation_lines_total")
+    searched = sample("hilos_generation_searched_lines_total")
+
+    record_generation({"decode": 0.01, "solve": 1.5, "lines": 4500, "searched_lines": 120})
+
+    rendered = REGISTRY.render()
+    assert 'phase="solve"' in rendered
+    assert 'phase="lines"' not in rendered
+    assert 'phase="searched_lines"' not in rendered
+    assert sample("hilos_generation_lines_total") == lines + 4500
+    assert sample("hilos_generation_searched_lines_total") == searched + 120
+
+def test_profiler_samples_one_request_at_a_time(tmp_path):
+    profiler = Profiler(directory=str(tmp_path))
+    profiler.sample_rate = 1.0
+    first, second = str(tmp_path / "first.prof"), str(tmp_path / "second.prof")
+
+    async def request(path, started, release):
+        with profiler.profile(path):
+            started.set()
+            await release.wait()
+
+    async def main():
+        started, release = asyncio.Event(), asyncio.Event()
+        task = asyncio.create_task(request(first, started, release))
+        await started.wait()
+        # A concurrent request is neither sampled nor profiled
+        assert not profiler.should_sample()
+        second_started = asyncio.Event()
+        second_task = asyncio.create_task(request(second, second_started, release))
+        await second_started.wait()
+        release.set()
+        await asyncio.gather(task, second_task)
+
+    asyncio.run(main())
+
+    assert os.path.exists(first)
+    assert not os.path.exists(second)
+    assert profiler.should_sample()
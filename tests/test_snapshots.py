@@ -0,0 +1,39 @@
+import numpy as np
+
+from geometry import pin_circle, pin_coordinates
+from sequence_format import LineSequence
+from snapshots import SnapshotRenderer
+
+PINS = 80
+PIXEL_WIDTH = 100
+OUTPUT_WIDTH = 64
+
+def make_renderer(sequence, **kwargs):
+    pin_coords = pin_coordinates(PINS, *pin_circle(PIXEL_WIDTH))
+    return SnapshotRenderer(sequence, pin_coords, PIXEL_WIDTH, OUTPUT_WIDTH, keyframe_steps=10, **kwargs)
+
+def test_keyframe_memory_is_bounded():
+    pins = np.random.default_rng(0).integers(0, PINS, 400).astype(np.uint16)
+    sequence = LineSequence(pins, pin_count=PINS)
+    keyframe_bytes = OUTPUT_WIDTH * OUTPUT_WIDTH * 4
+    bounded = make_renderer(sequence, max_keyframe_bytes=5 * keyframe_bytes)
+    unbounded = make_renderer(sequence, max_keyframe_bytes=len(pins) * keyframe_bytes)
+
+    for steps in (400, 17, 250, 399, 3, 160):
+        np.testing.assert_allclose(bounded.density(steps), unbounded.density(steps), atol=1e-4)
+        assert bounded.keyframe_bytes <= 5 * keyframe_bytes
+
+    # 400 steps in at most 5 keyframes: the interval doubled from 10 to 160
+    assert bounded.keyframe_steps == 160
+    assert unbounded.keyframe_steps == 10
+
+def test_color_keyframes_count_three_channels():
+    pins = np.random.default_rng(1).integers(0, PINS, 200).astype(np.uint16)
+    colors = np.repeat(np.arange(2, dtype=np.uint8), 100)
+    sequence = LineSequence(pins, pin_count=PINS, colors=colors, palette=[(0, 255, 255), (0, 0, 0)])
+    keyframe_bytes = OUTPUT_WIDTH * OUTPUT_WIDTH * 3 * 4
+    renderer = make_renderer(sequence, max_keyframe_bytes=4 * keyframe_bytes)
+
+    assert renderer.max_keyframes == 4
+    renderer.image(len(sequence))
+    assert renderer.keyframe_bytes <= 4 * keyframe_bytes
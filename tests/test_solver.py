@@ -0,0 +1,35 @@
+import time
+
+import numpy as np
+
+import hilos
+from geometry import get_geometry
+from hilos import MIN_DISTANCE, StoppingPolicy, solve_layer
+
+PINS = 80
+PIXEL_WIDTH = 100
+
+def test_lookahead_searches_under_a_generous_deadline():
+    chords = get_geometry(PINS, PIXEL_WIDTH, MIN_DISTANCE)
+    residual = np.random.default_rng(0).integers(0, 256, PIXEL_WIDTH * PIXEL_WIDTH).astype(np.float64)
+    stats = {}
+
+    sequence = solve_layer(chords, residual, 300, deadline=time.monotonic() + 30, beam_width=3, lookahead=2,
+                           stats=stats, finish_seconds_per_line=1e-5)
+
+    assert len(sequence) == 301
+    assert stats["searched"] > 0
+
+def test_headroom_reserves_the_greedy_cost_of_the_remaining_lines(monkeypatch):
+    monkeypatch.setattr(hilos.time, "monotonic", lambda: 100.0)
+    stopping = StoppingPolicy(4000, deadline=101.0, finish_seconds_per_line=5e-5)
+    stopping.lines = 1000
+    stopping.greedy_seconds_per_line = 1e-4
+
+    # 3000 greedy lines (0.375 s with the margin) and the render (0.2 s) leave room for a 5 ms search
+    assert stopping.has_headroom(5e-3)
+    # But not for a search costing what is left after the reserve
+    assert not stopping.has_headroom(0.5)
+
+    stopping.greedy_seconds_per_line = 3e-4
+    assert not stopping.has_headroom(5e-3)
@@ -0,0 +1,165 @@
+import asyncio
+import json
+import threading
+import uuid
+from types import SimpleNamespace
+
+import pytest
+from fastapi.testclient import TestClient
+
+from conftest import WEBHOOK_SECRET
+from models import CheckoutPayment, OutboundEmail, Purchase
+from sequence_format import write_sequence
+from stripe_stub import checkout_session_event, sign_payload
+
+@pytest.fixture
+def client(app_module):
+    return TestClient(app_module.app)
+
+@pytest.fixture
+def preview(app_module):
+    """An unpurchased result in thread_outputs, as /generate-thread-image/ leaves it."""
+    name = uuid.uuid4().hex[:24]
+    image_path = f"{app_module.OUTPUT_DIR}/{name}_output.png"
+    sequence_path = f"{app_module.OUTPUT_DIR}/{name}.seq"
+    with open(image_path, "wb") as f:
+        f.write(b"\x89PNG\r\n\x1a\n")
+    write_sequence(sequence_path, [0, 90, 45, 135], pin_count=180, solver_version=1)
+    app_module.storage.add(image_path, sequence_path)
+    return f"{name}_output.png"
+
+def post_event(client, event, secret=WEBHOOK_SECRET):
+    payload = json.dumps(event).encode()
+    return client.post("/stripe/webhook", content=payload, headers={
+        "Content-Type": "application/json",
+        "Stripe-Signature": sign_payload(payload, secret),
+    })
+
+def registration(session_id):
+    return {
+        "session_id": session_id,
+        "name": "Cliente de prueba",
+        "email": f"{uuid.uuid4().hex[:12]}@example.com",
+        "phone": "5555555555",
+        "address": "Calle 1, Ciudad",
+    }
+
+def count(app_module, model, **filters):
+    db = app_module.SessionLocal()
+    try:
+        return db.query(model).filter_by(**filters).count()
+    finally:
+        db.close()
+
+def test_signed_event_records_paid_session(client, app_module, preview):
+    event = checkout_session_event(filename=preview, original_file="photo.jpg")
+    session_id = event["data"]["object"]["id"]
+
+    response = post_event(client, event)
+
+    assert response.status_code == 200
+    assert response.json() == {"received": True}
+    db = app_module.SessionLocal()
+    try:
+        payment = db.query(CheckoutPayment).filter_by(session_id=session_id).one()
+        assert payment.payment_status == "paid"
+        assert payment.filename == preview
+        assert payment.original_file == "photo.jpg"
+        assert payment.purchase_id is None
+    finally:
+        db.close()
+
+def test_bad_signature_is_rejected(client, app_module, preview):
+    event = checkout_session_event(filename=preview)
+
+    response = post_event(client, event, secret="whsec_wrong")
+
+    assert response.status_code == 400
+    assert count(app_module, CheckoutPayment, session_id=event["data"]["object"]["id"]) == 0
+
+def test_replayed_event_is_recorded_once(client, app_module, preview):
+    event = checkout_session_event(filename=preview)
+
+    assert post_event(client, event).status_code == 200
+    assert post_event(client, event).status_code == 200
+
+    assert count(app_module, CheckoutPayment, session_id=event["data"]["object"]["id"]) == 1
+
+def test_late_unpaid_event_does_not_undo_a_payment(client, app_module, preview):
+    paid = checkout_session_event(filename=preview, event_type="checkout.session.async_payment_succeeded")
+    session_id = paid["data"]["object"]["id"]
+    # The completed event of a delayed payment method arrives after the payment succeeded
+    late = checkout_session_event(session_id, filename=preview, payment_status="unpaid",
+                                  payment_intent=paid["data"]["object"]["payment_intent"])
+
+    assert post_event(client, paid).status_code == 200
+    assert post_event(client, late).status_code == 200
+
+    db = app_module.SessionLocal()
+    try:
+        assert db.query(CheckoutPayment).filter_by(session_id=session_id).one().payment_status == "paid"
+    finally:
+        db.close()
+    assert client.post("/complete-registration", json=registration(session_id)).status_code == 200
+
+def test_repeated_registration_creates_one_purchase(client, app_module, preview):
+    event = checkout_session_event(filename=preview)
+    session_id = event["data"]["object"]["id"]
+    payment_intent = event["data"]["object"]["payment_intent"]
+    assert post_event(client, event).status_code == 200
+
+    first = client.post("/complete-registration", json=registration(session_id))
+    second = client.post("/complete-registration", json=registration(session_id))
+
+    assert first.status_code == second.status_code == 200
+    assert first.json()["viewer_url"] == second.json()["viewer_url"]
+    assert count(app_module, Purchase, payment_intent_id=payment_intent) == 1
+    assert count(app_module, CheckoutPayment, session_id=session_id) == 1
+
+def test_concurrent_registrations_create_one_purchase(client, app_module, preview):
+    event = checkout_session_event(filename=preview)
+    session_id = event["data"]["object"]["id"]
+    payment_intent = event["data"]["object"]["payment_intent"]
+    assert post_event(client, event).status_code == 200
+
+    viewer_urls = []
+    barrier = threading.Barrier(2)
+
+    def register():
+        barrier.wait()
+        viewer_urls.append(client.post("/complete-registration", json=registration(session_id)).json()["viewer_url"])
+
+    threads = [threading.Thread(target=register) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(set(viewer_urls)) == 1
+    assert count(app_module, Purchase, payment_intent_id=payment_intent) == 1
+    # Only the registration that created the purchase queues its confirmation
+    link = viewer_urls[0].rsplit("/", 1)[-1]
+    db = app_module.SessionLocal()
+    try:
+        assert db.query(OutboundEmail).filter(OutboundEmail.html.contains(link)).count() == 1
+    finally:
+        db.close()
+
+def test_checkout_session_is_created_off_the_event_loop(client, app_module, preview, monkeypatch):
+    calls = []
+
+    def create(**params):
+        try:
+            asyncio.get_running_loop()
+            calls.append("event loop")
+        except RuntimeError:
+            calls.append(params["metadata"]["filename"])
+        return SimpleNamespace(url="https://checkout.stripe.test/c/pay/cs_test")
+
+    monkeypatch.setattr(app_module.stripe.checkout.Session, "create", create)
+
+    response = client.post("/create-checkout-session", json={"imageData": {"filename": preview}})
+
+    assert response.status_code == 200
+    assert response.json() == {"checkout_url": "https://checkout.stripe.test/c/pay/cs_test"}
+    assert calls == [preview]
@@ -0,0 +1,54 @@
+import uuid
+
+import pytest
+from fastapi.testclient import TestClient
+
+from models import Purchase, User
+from sequence_format import write_sequence
+
+@pytest.fixture
+def client(app_module):
+    return TestClient(app_module.app)
+
+def make_purchase(app_module, sequence, **kwargs):
+    """A purchase of a result whose sequence is ``sequence``, and its unique link."""
+    name = uuid.uuid4().hex[:24]
+    sequence_path = f"{app_module.OUTPUT_DIR}/{name}.seq"
+    write_sequence(sequence_path, sequence, pin_count=180, solver_version=1, **kwargs)
+    db = app_module.SessionLocal()
+    try:
+        user = User(name="Cliente de prueba", email=f"{name[:12]}@example.com", phone="5555555555",
+                    address="Calle 1, Ciudad")
+        db.add(user)
+        db.flush()
+        purchase = Purchase(user_id=user.id, image_path=f"{app_module.OUTPUT_DIR}/{name}_output.png",
+                            json_path=sequence_path)
+        db.add(purchase)
+        db.commit()
+        return purchase.unique_link
+    finally:
+        db.close()
+
+def test_color_sequence_steps_carry_their_thread(client, app_module):
+    link = make_purchase(app_module, [0, 90, 45, 10, 100, 20], colors=[0, 0, 0, 1, 1, 0],
+                         palette=[(0, 174, 239), (236, 0, 140)])
+
+    bootstrap = client.get(f"/api/viewer/{link}?offset=1&limit=3").json()
+    steps = client.get(f"/api/viewer/{link}/steps?offset=3&limit=3").json()
+
+    assert bootstrap["sequence"] == [90, 45, 10]
+    assert bootstrap["colors"] == [0, 0, 1]
+    assert bootstrap["palette"] == ["#00aeef", "#ec008c"]
+    assert steps["sequence"] == [10, 100, 20]
+    assert steps["colors"] == [1, 1, 0]
+
+def test_single_color_sequence_has_no_palette(client, app_module):
+    link = make_purchase(app_module, [0, 90, 45, 135])
+
+    bootstrap = client.get(f"/api/viewer/{link}").json()
+    steps = client.get(f"/api/viewer/{link}/steps?offset=2").json()
+
+    assert bootstrap["sequence"] == [0, 90, 45, 135]
+    assert bootstrap["colors"] is None
+    assert bootstrap["palette"] is None
+    assert steps["colors"] is None
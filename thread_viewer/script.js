@@ -1,52 +1,148 @@
-async function loadUserName() {
-    try {
-        const pathParts = window.location.pathname.split('/');
-        const uniqueLink = pathParts[pathParts.length - 1];
+function showUserName(name) {
+    const userNameSpan = document.getElementById('user-name');
+    if (userNameSpan) {
+        userNameSpan.textContent = `${name}`;
+    }
+}
 
-        const response = await fetch(`/api/user-data/${uniqueLink}`);
-        if (!response.ok) {
-            throw new Error('No se pudo cargar el nombre del usuario');
-        }
+function showThreadImage(imageUrl) {
+    const imgElement = document.getElementById('thread-image-preview');
+    if (imgElement) {
+        imgElement.src = imageUrl;
+        imgElement.style.display = 'block'; // Mostrar la imagen una vez cargada
+    }
+}
 
-        const userData = await response.json();
-        const userNameSpan = document.getElementById('user-name');
-        if (userNameSpan) {
-            userNameSpan.textContent = `${userData.name}`;
+// Espera antes de pedir la vista parcial, para no pedir una por cada paso al avanzar rápido
+const SNAPSHOT_DELAY = 300;
+
+function createPreview(finalUrl, snapshotUrl) {
+    // La vista previa muestra cómo debe verse la pieza en el paso actual, o el resultado final
+    const toggle = document.getElementById('preview-toggle');
+    let showFinal = false;
+    let step = 0;
+    let timer;
+
+    function update() {
+        clearTimeout(timer);
+        if (showFinal) {
+            showThreadImage(finalUrl);
+            return;
         }
-    } catch (error) {
-        console.error('Error cargando nombre de usuario:', error);
+        timer = setTimeout(() => showThreadImage(`${snapshotUrl}?step=${step}`), SNAPSHOT_DELAY);
+    }
+
+    if (toggle) {
+        toggle.addEventListener('click', () => {
+            showFinal = !showFinal;
+            toggle.textContent = showFinal ? 'Ver paso actual' : 'Ver resultado final';
+            update();
+        });
     }
+
+    return {
+        showStep(index) {
+            // El paso actual ya está colocado: la vista incluye los primeros index + 1 pasos
+            step = index + 1;
+            update();
+        }
+    };
 }
 
-async function loadThreadImage() {
-    try {
-        const pathParts = window.location.pathname.split('/');
-        const uniqueLink = pathParts[pathParts.length - 1];
+// Pasos que se piden por solicitud; se carga solo la página del progreso guardado y sus vecinas
+const STEPS_PAGE = 500;
+
+function createStepPager(stepsUrl, totalSteps, firstOffset, firstSteps, firstColors) {
+    const pages = new Map(); // número de página -> {sequence, colors}
+    const pending = new Map(); // número de página -> promesa en curso
+
+    pages.set(Math.floor(firstOffset / STEPS_PAGE), { sequence: firstSteps, colors: firstColors });
 
-        const imgElement = document.getElementById('thread-image-preview');
-        if (imgElement) {
-            imgElement.src = `/api/thread-image/${uniqueLink}`;
-            imgElement.style.display = 'block'; // Mostrar la imagen una vez cargada
+    function loadPage(page) {
+        if (pages.has(page) || page < 0 || page * STEPS_PAGE >= totalSteps) {
+            return Promise.resolve();
         }
-    } catch (error) {
-        console.error('Error cargando imagen de hilos:', error);
+        if (!pending.has(page)) {
+            const request = fetch(`${stepsUrl}?offset=${page * STEPS_PAGE}&limit=${STEPS_PAGE}`)
+                .then(response => {
+                    if (!response.ok) {
+                        throw new Error('No se pudieron cargar los pasos de la secuencia');
+                    }
+                    return response.json();
+                })
+                .then(data => pages.set(page, { sequence: data.sequence, colors: data.colors }))
+                .finally(() => pending.delete(page));
+            pending.set(page, request);
+        }
+        return pending.get(page);
     }
+
+    return {
+        length: totalSteps,
+
+        get(index) {
+            const page = pages.get(Math.floor(index / STEPS_PAGE));
+            return page ? page.sequence[index % STEPS_PAGE] : undefined;
+        },
+
+        // Índice en la paleta del hilo del paso, o undefined en piezas de un solo color
+        color(index) {
+            const page = pages.get(Math.floor(index / STEPS_PAGE));
+            return page && page.colors ? page.colors[index % STEPS_PAGE] : undefined;
+        },
+
+        async ensure(index) {
+            const page = Math.floor(index / STEPS_PAGE);
+            await loadPage(page);
+            // Adelantar las páginas vecinas para que avanzar o retroceder no espere a la red
+            loadPage(page + 1).catch(error => console.error(error));
+            loadPage(page - 1).catch(error => console.error(error));
+        }
+    };
 }
 
-async function loadThreadSequence() {
+async function loadViewer() {
     try {
         // Obtener el unique_link de la URL
         const pathParts = window.location.pathname.split('/');
         const uniqueLink = pathParts[pathParts.length - 1];
 
-        // Cargar el JSON específico para este link
-        const response = await fetch(`/api/thread-data/${uniqueLink}`);
+        // Obtener el paso guardado de localStorage
+        const savedIndex = localStorage.getItem(`threadProgress_${uniqueLink}`);
+        const savedPage = Math.floor((savedIndex ? parseInt(savedIndex) : 0) / STEPS_PAGE);
+
+        // Nombre, pines, imagen y la página de pasos del progreso guardado en una sola solicitud
+        let response = await fetch(`/api/viewer/${uniqueLink}?offset=${savedPage * STEPS_PAGE}&limit=${STEPS_PAGE}`);
         if (!response.ok) {
-            throw new Error('No se pudo cargar la secuencia de hilos');
+            throw new Error('No se pudieron cargar los datos del visualizador');
         }
 
-        const threadSequence = await response.json();
+        let viewerData = await response.json();
+        if (viewerData.sequence.length === 0) {
+            // El progreso guardado quedó fuera de la secuencia; empezar desde el principio
+            response = await fetch(`/api/viewer/${uniqueLink}?offset=0&limit=${STEPS_PAGE}`);
+            if (!response.ok) {
+                throw new Error('No se pudieron cargar los datos del visualizador');
+            }
+            viewerData = await response.json();
+        }
+
+        showUserName(viewerData.name);
+        // La vista previa mide 250 px: basta la miniatura
+        showThreadImage(viewerData.thumbnail_url);
 
+        const threadSequence = createStepPager(
+            viewerData.steps_url, viewerData.total_steps, viewerData.offset, viewerData.sequence, viewerData.colors
+        );
+        const preview = createPreview(viewerData.thumbnail_url, viewerData.snapshot_url);
+        loadThreadSequence(uniqueLink, threadSequence, viewerData.pins, preview, viewerData.palette);
+    } catch (error) {
+        console.error('Error cargando el visualizador:', error);
+    }
+}
+
+function loadThreadSequence(uniqueLink, threadSequence, totalPins, preview, palette) {
+    try {
         // Obtener el paso guardado de localStorage
         const savedIndex = localStorage.getItem(`threadProgress_${uniqueLink}`);
         let currentIndex = savedIndex ? parseInt(savedIndex) : 0;
@@ -56,7 +152,6 @@ async function loadThreadSequence() {
             currentIndex = 0;
         }
 
-        const totalPins = 180; // Ajustado a 180 pines
         const quartersCount = 4;
         const pinsPerQuarter = totalPins / quartersCount; // Esto será 45
 
@@ -98,11 +193,35 @@ async function loadThreadSequence() {
             }
         }
 
+        function threadChanges(index) {
+            // El paso anterior puede estar en una página que todavía no llega; entonces no se avisa
+            const previous = index > 0 ? threadSequence.color(index - 1) : undefined;
+            return previous !== undefined && threadSequence.color(index) !== previous;
+        }
+
+        function renderThreadColor() {
+            // Solo las piezas de varios colores traen paleta
+            const threadColor = document.getElementById('thread-color');
+            const color = threadSequence.color(currentIndex);
+            if (!threadColor || !palette || color === undefined) {
+                return;
+            }
+            threadColor.style.display = 'flex';
+            document.getElementById('thread-color-swatch').style.backgroundColor = palette[color];
+            document.getElementById('thread-color-label').textContent = threadChanges(currentIndex)
+                ? `Cambia al hilo ${color + 1}`
+                : `Hilo ${color + 1}`;
+            threadColor.classList.toggle('changed', threadChanges(currentIndex));
+        }
+
         function speakCurrentStep() {
             if (isAutoPlaying && 'speechSynthesis' in window) {
-                const { quarter, localIndex } = getQuarterAndLocalIndex(threadSequence[currentIndex]);
+                const { quarter, localIndex } = getQuarterAndLocalIndex(threadSequence.get(currentIndex));
                 const colorName = getQuarterColorName(quarter);
-                const utterance = new SpeechSynthesisUtterance(`Paso ${currentIndex + 1}. Color ${colorName}, pin ${localIndex}.`);
+                const threadChange = palette && threadChanges(currentIndex)
+                    ? ` Cambia al hilo ${threadSequence.color(currentIndex) + 1}.`
+                    : '';
+                const utterance = new SpeechSynthesisUtterance(`Paso ${currentIndex + 1}.${threadChange} Color ${colorName}, pin ${localIndex}.`);
                 utterance.lang = 'es-ES'; // Establecer el idioma a español
                 speechSynthesis.cancel(); // Detener cualquier habla anterior
                 speechSynthesis.speak(utterance);
@@ -113,7 +232,15 @@ async function loadThreadSequence() {
             localStorage.setItem(`threadProgress_${uniqueLink}`, currentIndex);
         }
 
-        function renderSequence() {
+        async function renderSequence() {
+            // Cargar la página del paso actual si todavía no está
+            try {
+                await threadSequence.ensure(currentIndex);
+            } catch (error) {
+                console.error('Error cargando pasos:', error);
+                return;
+            }
+
             const quarters = document.querySelectorAll('.quarter');
             const quarterNumbers = document.querySelectorAll('.quarter-number');
             const progressCounter = document.getElementById('progress-counter');
@@ -122,7 +249,7 @@ async function loadThreadSequence() {
             quarters.forEach(quarter => quarter.classList.remove('active'));
             quarterNumbers.forEach(number => number.textContent = '');
 
-            const { quarter, localIndex } = getQuarterAndLocalIndex(threadSequence[currentIndex]);
+            const { quarter, localIndex } = getQuarterAndLocalIndex(threadSequence.get(currentIndex));
 
             // Actualizar contador de progreso
             progressCounter.textContent = `Paso ${currentIndex + 1} de ${threadSequence.length}`;
@@ -141,6 +268,8 @@ async function loadThreadSequence() {
                     }
                 }
             }
+            renderThreadColor(); // Mostrar el hilo del paso en piezas de varios colores
+            preview.showStep(currentIndex); // Mostrar cómo debe verse la pieza en este paso
             saveProgress(); // Guardar el progreso cada vez que se renderiza la secuencia
             speakCurrentStep(); // Leer el paso actual
         }
@@ -216,7 +345,5 @@ async function loadThreadSequence() {
 
 // Call the functions when the page loads
 document.addEventListener('DOMContentLoaded', () => {
-    loadUserName();
-    loadThreadImage();
-    loadThreadSequence();
+    loadViewer();
 });
\ No newline at end of file
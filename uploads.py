@@ -0,0 +1,80 @@
+import json
+import os
+
+from fastapi import HTTPException
+
+# Tamaño máximo de una subida (bytes), incluido el sobre multipart
+MAX_UPLOAD_BYTES = int(os.getenv('HILOS_MAX_UPLOAD_BYTES', str(20 * 1024 * 1024)))
+
+# Tamaño de los bloques con los que se lee una subida
+UPLOAD_CHUNK_SIZE = 256 * 1024
+
+def upload_too_large(max_bytes=MAX_UPLOAD_BYTES):
+    return HTTPException(
+        status_code=413,
+        detail=f"La imagen excede el tamaño máximo de {max_bytes // (1024 * 1024)} MB"
+    )
+
+class UploadSizeLimitMiddleware:
+    """
+    Rechazar con 413 las subidas demasiado grandes mientras llegan.
+
+    Se revisa primero ``Content-Length``; si falta o miente, se cuentan los bytes
+    recibidos y se corta en cuanto se pasa del límite, antes de que el parser
+    multipart termine de leer (y de volcar a disco) el resto del cuerpo.
+    """
+
+    def __init__(self, app, max_bytes=MAX_UPLOAD_BYTES, paths=()):
+        self.app = app
+        self.max_bytes = max_bytes
+        self.paths = set(paths)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST" or scope["path"] not in self.paths:
+            await self.app(scope, receive, send)
+            return
+
+        content_length = dict(scope["headers"]).get(b"content-length", b"")
+        if content_length.isdigit() and int(content_length) > self.max_bytes:
+            await self.reject(send)
+            return
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    # FastAPI deja pasar las HTTPException del parseo del cuerpo
+                    raise upload_too_large(self.max_bytes)
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+    async def reject(self, send):
+        exception = upload_too_large(self.max_bytes)
+        body = json.dumps({"detail": exception.detail}, ensure_ascii=False).encode()
+        await send({
+            "type": "http.response.start",
+            "status": exception.status_code,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+                (b"connection", b"close"),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
+
+async def read_upload(file, max_bytes=MAX_UPLOAD_BYTES):
+    """Leer una subida en bloques a memoria, sin pasar de ``max_bytes``"""
+    content = bytearray()
+    while True:
+        chunk = await file.read(UPLOAD_CHUNK_SIZE)
+        if not chunk:
+            break
+        content += chunk
+        if len(content) > max_bytes:
+            raise upload_too_large(max_bytes)
+    return bytes(content)
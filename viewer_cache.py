@@ -0,0 +1,61 @@
+import collections
+import os
+import threading
+import time
+
+# Segundos que una compra resuelta se sirve sin volver a consultar la base de datos
+VIEWER_CACHE_TTL = float(os.getenv('HILOS_VIEWER_CACHE_TTL', '300'))
+
+# Entradas máximas por caché (compras y secuencias por separado)
+VIEWER_CACHE_SIZE = int(os.getenv('HILOS_VIEWER_CACHE_SIZE', '1024'))
+
+class TTLCache:
+    """
+    Caché LRU en memoria cuyas entradas caducan a los ``ttl`` segundos.
+
+    Es por proceso: con varios workers de uvicorn cada uno tiene la suya, y el
+    TTL acota cuánto puede tardar en verse un cambio hecho en otro proceso.
+    """
+
+    def __init__(self, max_entries=VIEWER_CACHE_SIZE, ttl=VIEWER_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Devolver el valor guardado o None si no existe o ya caducó"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= now:
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self)}